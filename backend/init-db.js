@@ -101,6 +101,7 @@ const objects_table = {
         'type_id',
         'parent_id',
         'last_seen',
+        'cluster_id',
         {
             name: 'slug_parent',
             indexFunction: [r.row('slug'), r.row('parent_id')]
@@ -116,6 +117,14 @@ const objects_table = {
         {
             name: 'parent_type',
             indexFunction: [r.row('parent_id'), r.row('type_id')]
+        },
+        {
+            name: 'type_created',
+            indexFunction: [r.row('type_id'), r.row('created_at'), r.row('id')]
+        },
+        {
+            name: 'parent_created',
+            indexFunction: [r.row('parent_id'), r.row('created_at'), r.row('id')]
         }
     ])
 };
@@ -132,10 +141,33 @@ const events_table = {
         {
             name: 'interested_ids',
             multi: true
+        },
+        {
+            name: 'interested_created',
+            indexFunction: function(event) {
+                return event('interested_ids').map(function(interested_id) {
+                    return [interested_id, event('created_at'), event('id')];
+                });
+            },
+            multi: true
         }
     ])
 };
 
+//--------------------------------------
+// Object configs
+//--------------------------------------
+
+const object_configs_table = {
+    name: 'object_config',
+    indexes: [
+        {
+            name: 'depends_on',
+            multi: true
+        }
+    ]
+};
+
 require('rethinkdb-init')(r);
 
 r.init(db.config(), [
@@ -144,6 +176,7 @@ r.init(db.config(), [
     user_api_tokens_table,
     google_users_table,
     objects_table,
+    object_configs_table,
     events_table
 ]).then(ensure_settings).then(conn => {
     conn.close();
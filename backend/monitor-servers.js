@@ -10,14 +10,18 @@ const HEARTBEAT_INTERVAL = 30; // seconds
 
 var mark_offline_servers = function() {
     logger.info('Start offline servers check');
-    r.table('object').between(0, r.now().sub(HEARTBEAT_INTERVAL * 2), { index: 'last_seen' }).update({ status: 'offline' }).run(db.conn, (err, result) => {
-        if (err) {
-            logger.error('Error updating offline servers');
-            logger.error(err);
-        } else {
-            logger.debug('Updated offline servers:', result);
-        }
-    });
+    // Servers that are already offline are skipped so that their modified_at
+    // (which conditional GETs of the Python API rely on) stays as is
+    r.table('object').between(0, r.now().sub(HEARTBEAT_INTERVAL * 2), { index: 'last_seen' })
+        .filter(r.row('status').ne('offline'))
+        .update({ status: 'offline', modified_at: r.now() }).run(db.conn, (err, result) => {
+            if (err) {
+                logger.error('Error updating offline servers');
+                logger.error(err);
+            } else {
+                logger.debug('Updated offline servers:', result);
+            }
+        });
 };
 
 db.connect().then(() => {
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+'''Measures how long it takes to find the action that handles a request.
+
+Compares scanning `dir()` of the type class on every request (the way
+`ObjectTreeNode` used to dispatch) with the dispatch table that
+`TypeClassesRegistry` builds when a type class is registered.
+
+Run from the python-backend directory:
+
+    python benchmarks/bench_action_dispatch.py
+'''
+import timeit
+from warehaus_api.hardware.all_type_classes import all_type_classes
+from warehaus_api.hardware.type_class import OBJECT_ACTION
+from warehaus_api.hardware.type_class import TYPE_ACTION
+from warehaus_api.hardware.type_class import get_object_action
+from warehaus_api.hardware.type_class import get_type_action
+from warehaus_api.hardware.servers import Server
+
+NUMBER = 10000
+REPEAT = 5
+
+def scan_type_class(type_class, get_action, action_name, method):
+    for attr in dir(type_class):
+        action = getattr(type_class, attr)
+        action_info = get_action(action)
+        if action_info is None:
+            continue
+        if action_info['name'] == action_name and action_info['method'] == method:
+            return action
+
+def measure(title, func):
+    best = min(timeit.repeat(func, number=NUMBER, repeat=REPEAT))
+    print '{:<40} {:8.2f} us/request'.format(title, best / NUMBER * 1e6)
+
+def main():
+    type_key = Server.type_key()
+    server = all_type_classes[type_key]
+    cases = (
+        ('GET config.json', OBJECT_ACTION, get_object_action, 'config.json', 'GET'),
+        ('POST heartbeat', TYPE_ACTION, get_type_action, 'heartbeat', 'POST'),
+    )
+    for title, kind, get_action, action_name, method in cases:
+        assert scan_type_class(server, get_action, action_name, method) == all_type_classes.find_action(type_key, kind, action_name, method)
+        measure(title + ' (dir() scan)',
+                lambda: scan_type_class(server, get_action, action_name, method))
+        measure(title + ' (dispatch table)',
+                lambda: all_type_classes.find_action(type_key, kind, action_name, method))
+
+if __name__ == '__main__':
+    main()
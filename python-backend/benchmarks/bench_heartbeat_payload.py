@@ -0,0 +1,137 @@
+#!/usr/bin/python
+'''Measures the size and cost of heartbeat payloads of a 64-core host,
+sent as plain JSON and with `Content-Encoding: gzip`.
+
+Without arguments only the bytes-on-wire and the local encode/decode
+times are measured. To measure request latency as well, pass the URL
+of the heartbeat action of a server type object, for example:
+
+    python benchmarks/bench_heartbeat_payload.py http://localhost/api/v1/labs/lab/~/servers/heartbeat
+'''
+import sys
+import json
+import time
+import zlib
+import urllib2
+
+NUM_CORES = 64
+REPEAT = 20
+
+CPU_FLAGS = ('fpu vme de pse tsc msr pae mce cx8 apic sep mtrr pge mca cmov pat pse36 clflush dts acpi mmx fxsr '
+             'sse sse2 ss ht tm pbe syscall nx pdpe1gb rdtscp lm constant_tsc arch_perfmon pebs bts rep_good nopl '
+             'xtopology nonstop_tsc aperfmperf eagerfpu pni pclmulqdq dtes64 monitor ds_cpl vmx smx est tm2 ssse3 '
+             'fma cx16 xtpr pdcm pcid dca sse4_1 sse4_2 x2apic movbe popcnt tsc_deadline_timer aes xsave avx f16c '
+             'rdrand lahf_lm abm 3dnowprefetch epb cat_l3 cdp_l3 intel_pt tpr_shadow vnmi flexpriority ept vpid '
+             'fsgsbase tsc_adjust bmi1 hle avx2 smep bmi2 erms invpcid rtm cqm rdt_a rdseed adx smap xsaveopt cqm_llc')
+
+def make_cpu(index):
+    return {
+        'processor': str(index),
+        'vendor_id': 'GenuineIntel',
+        'cpu family': '6',
+        'model': '79',
+        'model name': 'Intel(R) Xeon(R) CPU E5-2686 v4 @ 2.30GHz',
+        'stepping': '1',
+        'microcode': '0xb000037',
+        'cpu MHz': '{0:.3f}'.format(2300 + index * 0.137),
+        'cache size': '46080 KB',
+        'physical id': str(index // 32),
+        'siblings': '32',
+        'core id': str(index % 16),
+        'cpu cores': '16',
+        'apicid': str(index * 2),
+        'initial apicid': str(index * 2),
+        'fpu': 'yes',
+        'fpu_exception': 'yes',
+        'cpuid level': '13',
+        'wp': 'yes',
+        'flags': CPU_FLAGS,
+        'bogomips': '4600.13',
+        'clflush size': '64',
+        'cache_alignment': '64',
+        'address sizes': '46 bits physical, 48 bits virtual',
+        'power management': '',
+    }
+
+def make_provider_info():
+    macs = {}
+    for index in range(8):
+        mac = '0a:1b:2c:3d:4e:{0:02x}'.format(index)
+        macs[mac] = {
+            'device-number': str(index),
+            'interface-id': 'eni-{0:08x}'.format(index),
+            'local-hostname': 'ip-10-0-0-{0}.ec2.internal'.format(index),
+            'local-ipv4s': '10.0.0.{0}'.format(index),
+            'mac': mac,
+            'owner-id': '123456789012',
+            'security-group-ids': 'sg-0123abcd',
+            'security-groups': 'default',
+            'subnet-id': 'subnet-0123abcd',
+            'subnet-ipv4-cidr-block': '10.0.0.0/24',
+            'vpc-id': 'vpc-0123abcd',
+            'vpc-ipv4-cidr-block': '10.0.0.0/16',
+        }
+    return {
+        'provider': 'aws',
+        'ami-id': 'ami-0123abcd',
+        'instance-id': 'i-0123456789abcdef0',
+        'instance-type': 'm4.16xlarge',
+        'placement': {'availability-zone': 'us-east-1a'},
+        'network': {'interfaces': {'macs': macs}},
+    }
+
+def make_heartbeat():
+    return dict(
+        hostname = 'bench-64-cores',
+        errors   = [],
+        info     = dict(
+            hw_cpu         = [make_cpu(index) for index in range(NUM_CORES)],
+            hw_mem         = dict(MemTotal=270000000000, MemFree=250000000000, MemAvailable=260000000000),
+            hw_fs          = {'/': dict(dev='/dev/xvda1', total_bytes=8 << 30, used_bytes=2 << 30, available_bytes=6 << 30)},
+            hw_net         = [dict(dev='eth{0}'.format(index), mac='0a:1b:2c:3d:4e:{0:02x}'.format(index),
+                                   inet=['10.0.0.{0}/24'.format(index)]) for index in range(8)],
+            hw_pci_devices = [dict(address='00:{0:02x}.0'.format(index), type='Ethernet controller',
+                                   vendor='Intel Corporation', name='82599 Virtual Function') for index in range(40)],
+            hw_disks       = [dict(name='xvd' + chr(ord('a') + index), size=100 << 30, type='disk') for index in range(4)],
+            provider_info  = make_provider_info(),
+        ),
+    )
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def gzip_decompress(data, chunk_size=64 * 1024):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return ''.join([decompressor.decompress(data[offset:offset + chunk_size])
+                    for offset in xrange(0, len(data), chunk_size)] + [decompressor.flush()])
+
+def best_time(func):
+    times = []
+    for _ in xrange(REPEAT):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+def post(url, body, headers):
+    request = urllib2.Request(url, body, headers)
+    urllib2.urlopen(request, timeout=30).read()
+
+def main():
+    heartbeat = make_heartbeat()
+    plain = json.dumps(heartbeat)
+    compressed = gzip_compress(plain)
+    print 'plain JSON:      {0:9d} bytes'.format(len(plain))
+    print 'gzip JSON:       {0:9d} bytes ({1:.1f}x smaller)'.format(len(compressed), float(len(plain)) / len(compressed))
+    print 'agent compress:  {0:9.2f} ms'.format(best_time(lambda: gzip_compress(json.dumps(heartbeat))) * 1000)
+    print 'server plain:    {0:9.2f} ms (parse)'.format(best_time(lambda: json.loads(plain)) * 1000)
+    print 'server gzip:     {0:9.2f} ms (decompress + parse)'.format(best_time(lambda: json.loads(gzip_decompress(compressed))) * 1000)
+    if len(sys.argv) > 1:
+        url = sys.argv[1]
+        print 'request plain:   {0:9.2f} ms'.format(best_time(lambda: post(url, plain, {'Content-Type': 'application/json'})) * 1000)
+        print 'request gzip:    {0:9.2f} ms'.format(best_time(lambda: post(url, compressed, {'Content-Type': 'application/json',
+                                                                                              'Content-Encoding': 'gzip'})) * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+'''Measures encoding the configs of a server and of a cluster of 8 such
+servers with every JSON encoder available (see `available_encoders`).
+
+Servers have the `agent_info` of a 64-core host (see
+`bench_heartbeat_payload.py`) and a child object with timestamps for
+every network interface, PCI device and disk. The encoder used before
+times were encoded natively (stdlib `json` converting every time with
+`str()`) is measured as the baseline.
+
+Run from the python-backend directory:
+
+    python benchmarks/bench_json_encoders.py
+'''
+import json
+import timeit
+from uuid import uuid4
+from datetime import datetime
+from bench_heartbeat_payload import make_heartbeat
+from warehaus_api.db.times import now
+from warehaus_api.serialization import available_encoders
+
+NUMBER = 100
+REPEAT = 5
+CLUSTER_SIZE = 8
+
+class BaselineJSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return str(obj)
+        return json.JSONEncoder.default(self, obj)
+
+def baseline_dumps(data):
+    return json.dumps(data, cls=BaselineJSONEncoder)
+
+def make_child(server_id, slug, data):
+    return dict(
+        data,
+        id           = str(uuid4()),
+        created_at   = now(),
+        modified_at  = now(),
+        slug         = slug,
+        display_name = slug,
+        type_id      = str(uuid4()),
+        parent_id    = server_id,
+        user_attrs   = {},
+    )
+
+def make_server_config(index):
+    info = make_heartbeat()['info']
+    server_id = str(uuid4())
+    return dict(
+        id           = server_id,
+        type_id      = str(uuid4()),
+        slug         = 'server-{}'.format(index),
+        display_name = 'server-{}'.format(index),
+        user_attrs   = dict(rack='r{}'.format(index), owner_team='infra'),
+        provider     = info['provider_info'],
+        hw           = dict(
+            cpu  = info['hw_cpu'],
+            mem  = info['hw_mem'],
+            fs   = info['hw_fs'],
+            net  = [make_child(server_id, net['dev'], net) for net in info['hw_net']],
+            pci  = [make_child(server_id, pci['address'], pci) for pci in info['hw_pci_devices']],
+            disk = [make_child(server_id, disk['name'], disk) for disk in info['hw_disks']],
+        ),
+    )
+
+def make_cluster_config():
+    return dict(
+        id           = str(uuid4()),
+        slug         = 'cluster',
+        display_name = 'Cluster',
+        user_attrs   = {},
+        servers      = [make_server_config(index) for index in range(CLUSTER_SIZE)],
+        status       = 'online',
+        ownerships   = [dict(owner_id=str(uuid4()), obtained_at=now(), username='user')],
+        lab          = dict(id=str(uuid4()), slug='lab', display_name='Lab'),
+    )
+
+def measure(title, func):
+    best = min(timeit.repeat(func, number=NUMBER, repeat=REPEAT))
+    print '{:<40} {:8.2f} ms/document'.format(title, best / NUMBER * 1e3)
+
+def main():
+    encoders = available_encoders()
+    for doc_title, doc in (('server config', make_server_config(0)), ('cluster config', make_cluster_config())):
+        outputs = set(dumps(doc) for _, dumps in encoders)
+        assert len(outputs) == 1, 'Encoders differ'
+        print '{} ({} KB)'.format(doc_title, len(outputs.pop()) // 1024)
+        measure('  baseline (json, str() times)', lambda: baseline_dumps(doc))
+        for name, dumps in encoders:
+            measure('  ' + name, lambda: dumps(doc))
+
+if __name__ == '__main__':
+    main()
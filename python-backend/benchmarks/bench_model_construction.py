@@ -0,0 +1,59 @@
+#!/usr/bin/python
+'''Measures constructing and serializing many `Object` models.
+
+Constructs 100k objects the way query results are wrapped (writable and
+read-only models) and reports the time, the peak memory growth of the
+process and the size of a model instance itself. Plain dicts are
+measured as the baseline.
+
+Run from the python-backend directory:
+
+    python benchmarks/bench_model_construction.py
+'''
+import sys
+import time
+import resource
+from uuid import uuid4
+from warehaus_api.db.times import now
+from warehaus_api.serialization import dumps
+from warehaus_api.hardware.models import Object
+
+NUM_OBJECTS = 100000
+
+def make_docs():
+    type_id = str(uuid4())
+    parent_id = str(uuid4())
+    return [dict(
+        id           = str(uuid4()),
+        created_at   = now(),
+        modified_at  = now(),
+        slug         = 'object-{}'.format(index),
+        display_name = 'Object {}'.format(index),
+        type_id      = type_id,
+        parent_id    = parent_id,
+        status       = 'online',
+    ) for index in xrange(NUM_OBJECTS)]
+
+def max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure(title, wrap, docs):
+    rss_before = max_rss_kb()
+    start = time.time()
+    objs = [wrap(doc) for doc in docs]
+    constructed = time.time()
+    for obj in objs:
+        dumps(obj)
+    serialized = time.time()
+    print '{:<20} construct {:7.1f} ms  serialize {:7.1f} ms  peak rss +{:7d} KB  instance {:4d} bytes'.format(
+        title, (constructed - start) * 1e3, (serialized - constructed) * 1e3,
+        max_rss_kb() - rss_before, sys.getsizeof(objs[0]))
+
+def main():
+    # Measure with the largest footprint last, since peak rss only grows
+    measure('plain dict', dict, make_docs())
+    measure('read-only model', Object.query.read_only.wrap, make_docs())
+    measure('writable model', lambda doc: Object(**doc), make_docs())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/python
+'''Measures serializing a server document with the `agent_info` of a
+64-core host (see `bench_heartbeat_payload.py`).
+
+Compares encoding a copy of the document from `as_dict()` of a writable
+model with handing the document of a read-only model to the encoder.
+
+Run from the python-backend directory:
+
+    python benchmarks/bench_model_serialization.py
+'''
+import timeit
+from uuid import uuid4
+from bench_heartbeat_payload import make_heartbeat
+from warehaus_api.db.times import now
+from warehaus_api.serialization import dumps
+from warehaus_api.hardware.models import Object
+
+NUMBER = 200
+REPEAT = 5
+
+def make_server_doc():
+    heartbeat = make_heartbeat()
+    return dict(
+        id           = str(uuid4()),
+        created_at   = now(),
+        modified_at  = now(),
+        slug         = heartbeat['hostname'],
+        display_name = heartbeat['hostname'],
+        type_id      = str(uuid4()),
+        parent_id    = str(uuid4()),
+        status       = 'online',
+        last_seen    = now(),
+        agent_info   = heartbeat['info'],
+    )
+
+def measure(title, func):
+    best = min(timeit.repeat(func, number=NUMBER, repeat=REPEAT))
+    print '{:<40} {:8.2f} ms/document'.format(title, best / NUMBER * 1e3)
+
+def main():
+    doc = make_server_doc()
+    assert dumps(Object(**doc).as_dict()) == dumps(Object.query.read_only.wrap(doc))
+    measure('writable model, as_dict()', lambda: dumps(Object(**doc).as_dict()))
+    measure('writable model, encoded directly', lambda: dumps(Object(**doc)))
+    measure('read-only model', lambda: dumps(Object.query.read_only.wrap(doc)))
+
+if __name__ == '__main__':
+    main()
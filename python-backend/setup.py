@@ -18,7 +18,6 @@ setup(
     install_requires = [
         'Flask == 0.10.1',
         'Flask-JWT == 0.3.2',
-        'Flask-RethinkDB == 0.2',
         'flask-restful == 0.3.5',
         'python-slugify == 1.1.4',
         'blinker == 1.4',
@@ -27,6 +26,13 @@ setup(
         'gunicorn',
         'pytz',
         'rethinkdb',
+        'simplejson',
         'setuptools',
     ],
+
+    entry_points = {
+        'console_scripts': [
+            'warehaus-event-retention = warehaus_api.events.retention:main',
+        ],
+    },
 )
@@ -1,27 +1,46 @@
-import json
-from datetime import datetime
 from flask import Flask
 from flask import make_response
 from flask_restful import Api
+from flask_restful import Resource
 from .logs import log_to_console
+from .metrics import metrics
+from .serialization import dumps
 from .db import init_db
+from .db.session import get_query_count
 from .settings import database_config
 from .settings import full_config
 from .auth import init_auth
+from .auth.identities import init_identity_cache
+from .auth.roles import require_admin
+from .hardware.models import init_type_cache
+from .hardware.config_store import init_config_store
+from .hardware.attr_indexes import init_attr_indexes
+from .hardware.heartbeats import init_heartbeat_queue
+from .events.writer import init_event_writer
+from .events.archive import init_event_archive
 from .hardware.resources import ObjectTreeRoot
 from .hardware.resources import ObjectTreeNode
 
-class CustomJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return str(obj)
-        return json.JSONEncoder.default(self, obj)
+class Metrics(Resource):
+    '''Returns the metrics collected by the worker process that handles
+    the request. Served at `~metrics`, which can't be the slug of a lab.
+    '''
+    def get(self):
+        require_admin()
+        return metrics.snapshot()
+
+def add_query_count(response):
+    '''Tells tests how many queries a request made. Only registered when
+    `QUERY_COUNT_HEADER` is set.
+    '''
+    response.headers['X-Query-Count'] = str(get_query_count())
+    return response
 
 def init_api(app):
     api = Api(app)
     @api.representation('application/json')
     def output_json(data, code, headers=None):
-        resp = make_response(json.dumps(data, cls=CustomJSONEncoder), code)
+        resp = make_response(dumps(data), code)
         resp.headers.extend(headers or {})
         return resp
     return api
@@ -29,17 +48,35 @@ def init_api(app):
 def app_routes(app):
     api = init_api(app)
     app.config['BUNDLE_ERRORS'] = True
+    if app.config['QUERY_COUNT_HEADER']:
+        app.after_request(add_query_count)
     api.add_resource(ObjectTreeRoot, '/api/v1/labs',             methods=['GET', 'POST'])
+    api.add_resource(Metrics,        '/api/v1/labs/~metrics',    methods=['GET'])
     api.add_resource(ObjectTreeNode, '/api/v1/labs/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE'])
 
-def create_app():
+def create_db_app():
+    '''Returns an app that is configured and connected to the database but
+    doesn't serve requests, for background processes.
+    '''
     app = Flask(__name__)
     app.config.from_object(database_config())
     with app.app_context():
         init_db(app)
         app.config.from_object(full_config())
+    return app
+
+def create_app():
+    app = create_db_app()
+    with app.app_context():
         init_auth(app)
         app_routes(app)
+    init_type_cache(app)
+    init_config_store(app)
+    init_attr_indexes(app)
+    init_identity_cache(app)
+    init_heartbeat_queue(app)
+    init_event_writer(app)
+    init_event_archive(app)
     return app
 
 def create_app_with_console_logging():
@@ -6,6 +6,7 @@ from flask import current_app
 from flask_jwt import JWT
 from .models import User
 from .roles import roles
+from .identities import identity_cache
 
 logger = getLogger(__name__)
 
@@ -14,7 +15,7 @@ def identify(payload):
     jwt_subject = payload.get('sub', None)
     if jwt_subject is None:
         return None
-    return User.query.get(jwt_subject)
+    return identity_cache.get(('jwt', jwt_subject), lambda: User.query.get(jwt_subject))
 
 def payload_handler(identity):
     iat = datetime.utcnow()
@@ -0,0 +1,155 @@
+import time
+from collections import OrderedDict
+from ..metrics import metrics
+from ..db.changes import ChangesWatcher
+from .models import User
+from .models import ApiToken
+
+class IdentityCache(object):
+    '''A process-local cache of the users that requests authenticate as,
+    keyed by what they authenticate with: `('token', api_token)` or
+    `('jwt', subject)`.
+
+    Entries expire after `ttl` seconds and at most `max_size` entries
+    are kept, evicting the least recently used. Changes feeds on the
+    `user` and `user_api_token` tables (see `ChangesWatcher`) drop the
+    entries of changed users and tokens, so revocations apply right
+    away rather than after the TTL. The cache is only used while both
+    feeds are ready.
+
+    Users are returned as read-only models shared between requests.
+    '''
+    FEEDS = ('user', 'user_api_token')
+
+    def __init__(self, name):
+        super(IdentityCache, self).__init__()
+        self.ttl = 0
+        self.max_size = 0
+        self._entries = OrderedDict() # key -> (expires at, user doc)
+        self._keys_by_user = {}
+        self._ready_feeds = set()
+        # Bumped on every invalidation, so lookups that raced with one
+        # don't store what they read
+        self._generation = 0
+        self._hits = metrics.counter(name + '.hits')
+        self._misses = metrics.counter(name + '.misses')
+        self._invalidations = metrics.counter(name + '.invalidations')
+        metrics.gauge(name + '.size', lambda: len(self._entries))
+        metrics.gauge(name + '.hit_ratio', self._hit_ratio)
+
+    def configure(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+
+    @property
+    def ready(self):
+        return (self.ttl > 0) and (len(self._ready_feeds) == len(self.FEEDS))
+
+    def _hit_ratio(self):
+        lookups = self._hits.value + self._misses.value
+        return (float(self._hits.value) / lookups) if lookups else 0.0
+
+    #----------------------------------------------------------------#
+    # Feed callbacks                                                 #
+    #----------------------------------------------------------------#
+
+    def on_ready(self, feed):
+        self._ready_feeds.add(feed)
+
+    def on_lost(self, feed):
+        self._ready_feeds.discard(feed)
+        self._generation += 1
+        self._entries.clear()
+        self._keys_by_user.clear()
+
+    def on_user_change(self, old_val, new_val):
+        for doc in (old_val, new_val):
+            if doc is not None:
+                self._invalidate_user(doc['id'])
+
+    def on_api_token_change(self, old_val, new_val):
+        for doc in (old_val, new_val):
+            if doc is not None:
+                self._invalidate_key(('token', doc['id']))
+
+    def _invalidate_user(self, user_id):
+        self._generation += 1
+        for key in self._keys_by_user.pop(user_id, ()):
+            self._invalidations.inc()
+            self._entries.pop(key, None)
+
+    def _invalidate_key(self, key):
+        self._generation += 1
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._invalidations.inc()
+            self._keys_by_user.get(entry[1]['id'], set()).discard(key)
+
+    #----------------------------------------------------------------#
+    # Lookups                                                        #
+    #----------------------------------------------------------------#
+
+    def _get_cached(self, key):
+        entry = self._entries.get(key, None)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            self._invalidate_key(key)
+            return None
+        # Move the entry to the end, where the most recently used are
+        del self._entries[key]
+        self._entries[key] = entry
+        return entry[1]
+
+    def _store(self, key, doc):
+        self._entries.pop(key, None)
+        self._entries[key] = (time.time() + self.ttl, doc)
+        self._keys_by_user.setdefault(doc['id'], set()).add(key)
+        while len(self._entries) > self.max_size:
+            evicted_key, (_, evicted_doc) = self._entries.popitem(last=False)
+            self._keys_by_user.get(evicted_doc['id'], set()).discard(evicted_key)
+
+    def get(self, key, lookup):
+        '''Returns the user cached for `key`, or calls `lookup` to get it
+        from the database. Returns `None` if there's no such user, which
+        is never cached.
+        '''
+        if not self.ready:
+            return lookup()
+        doc = self._get_cached(key)
+        if doc is not None:
+            self._hits.inc()
+            return User.query.read_only.wrap(doc)
+        self._misses.inc()
+        generation = self._generation
+        user = lookup()
+        if (user is not None) and (generation == self._generation):
+            self._store(key, user.as_dict())
+        return user
+
+identity_cache = IdentityCache('identity_cache')
+
+_watchers = (
+    ChangesWatcher(
+        name       = 'identity_cache.user',
+        make_query = lambda: User.query.table(),
+        on_change  = identity_cache.on_user_change,
+        on_ready   = lambda: identity_cache.on_ready('user'),
+        on_lost    = lambda: identity_cache.on_lost('user'),
+    ),
+    ChangesWatcher(
+        name       = 'identity_cache.user_api_token',
+        make_query = lambda: ApiToken.query.table(),
+        on_change  = identity_cache.on_api_token_change,
+        on_ready   = lambda: identity_cache.on_ready('user_api_token'),
+        on_lost    = lambda: identity_cache.on_lost('user_api_token'),
+    ),
+)
+
+def init_identity_cache(app):
+    identity_cache.configure(
+        ttl      = app.config['AUTH_CACHE_TTL'],
+        max_size = app.config['AUTH_CACHE_SIZE'],
+    )
+    for watcher in _watchers:
+        watcher.start(app)
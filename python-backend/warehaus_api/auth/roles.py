@@ -5,6 +5,7 @@ from flask import abort as flask_abort
 from flask_jwt import current_identity
 from flask_jwt import jwt_required
 from flask_jwt import JWTError
+from ..metrics import metrics
 from .auth_token import attempt_auth_token_login
 
 logger = getLogger(__name__)
@@ -24,7 +25,13 @@ def _check_roles(*role_names):
 def _check_jwt_roles(*role_names):
     _check_roles(*role_names)
 
+_auth_latency = metrics.timer('auth.latency')
+
 def _require_roles(*role_names):
+    with _auth_latency.time():
+        _authenticate(*role_names)
+
+def _authenticate(*role_names):
     role_names = tuple(role_names)
     if attempt_auth_token_login():
         _check_roles(*role_names)
@@ -0,0 +1,62 @@
+import gevent
+from logging import getLogger
+from .db import db
+
+logger = getLogger(__name__)
+
+class ChangesWatcher(object):
+    '''Follows a RethinkDB changes feed in a background greenlet.
+
+    `make_query` returns the query to follow (without calling `changes()`
+    on it). `on_change` is called with `(old_val, new_val)` for every
+    change. When `include_initial` is set the current documents are
+    first reported as changes with `old_val=None`.
+    `on_ready` is called once the feed is fully initialized, and
+    `on_lost` is called whenever the feed stops (the watcher then
+    reconnects after `RETRY_INTERVAL` seconds). Consumers should not
+    trust anything they learned from the feed between `on_lost` and
+    the next `on_ready`.
+    '''
+    RETRY_INTERVAL = 5
+
+    def __init__(self, name, make_query, on_change, on_ready=None, on_lost=None, include_initial=False):
+        super(ChangesWatcher, self).__init__()
+        self.name = name
+        self.make_query = make_query
+        self.on_change = on_change
+        self.on_ready = on_ready
+        self.on_lost = on_lost
+        self.include_initial = include_initial
+        self._greenlet = None
+
+    def start(self, app):
+        if self._greenlet is not None:
+            return
+        self._greenlet = gevent.spawn(self._run_forever, app)
+
+    def _run_forever(self, app):
+        while True:
+            try:
+                self._follow(app)
+            except Exception:
+                logger.exception('Changes feed {!r} failed'.format(self.name))
+            finally:
+                if self.on_lost is not None:
+                    self.on_lost()
+            gevent.sleep(self.RETRY_INTERVAL)
+
+    def _follow(self, app):
+        with app.app_context():
+            conn = db.connect()
+        try:
+            feed = self.make_query().changes(include_initial=self.include_initial, include_states=True).run(conn)
+            for change in feed:
+                if 'state' in change:
+                    if change['state'] == 'ready':
+                        logger.info('Changes feed {!r} is ready'.format(self.name))
+                        if self.on_ready is not None:
+                            self.on_ready()
+                    continue
+                self.on_change(change.get('old_val'), change.get('new_val'))
+        finally:
+            conn.close()
@@ -1,3 +1,241 @@
-from flask_rethinkdb import RethinkDB
+import time
+import gevent
+import rethinkdb as r
+from collections import deque
+from logging import getLogger
+from gevent.lock import BoundedSemaphore
+from ..metrics import metrics
+from .exceptions import PoolTimeoutError
+
+logger = getLogger(__name__)
+
+class ConnectionPool(object):
+    '''A bounded pool of RethinkDB connections shared by the greenlets of
+    a worker process.
+
+    At most `max_size` connections are checked out at the same time;
+    greenlets that need a connection beyond that wait up to
+    `checkout_timeout` seconds for one to be checked in. Idle connections
+    are reused in LIFO order, so the least recently used ones stay idle
+    and are closed once they've been idle for `max_idle_time` seconds.
+    Connections that were idle for more than `health_check_interval`
+    seconds are pinged before being handed out, and connections that
+    were closed or fail the ping are replaced with new ones.
+    '''
+    def __init__(self, name, connect, max_size, max_idle_time, checkout_timeout, health_check_interval):
+        super(ConnectionPool, self).__init__()
+        self.connect = connect
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self._slots = BoundedSemaphore(max_size)
+        self._idle = deque() # (connection, checked in at)
+        self._in_use = 0
+        self._checkouts = metrics.counter(name + '.checkouts')
+        self._connects = metrics.counter(name + '.connects')
+        self._evictions = metrics.counter(name + '.evictions')
+        self._timeouts = metrics.counter(name + '.timeouts')
+        self._wait_time = metrics.timer(name + '.wait_time')
+        metrics.gauge(name + '.idle', lambda: len(self._idle))
+        metrics.gauge(name + '.in_use', lambda: self._in_use)
+
+    def _close(self, conn):
+        try:
+            conn.close(noreply_wait=False)
+        except Exception:
+            logger.exception('Could not close a database connection')
+
+    def _evict_idle(self):
+        # The oldest idle connections are on the left
+        deadline = time.time() - self.max_idle_time
+        while self._idle and self._idle[0][1] < deadline:
+            conn, _ = self._idle.popleft()
+            self._evictions.inc()
+            self._close(conn)
+
+    def _is_healthy(self, conn, checked_in_at):
+        if not conn.is_open():
+            return False
+        if time.time() - checked_in_at < self.health_check_interval:
+            return True
+        try:
+            r.expr(1).run(conn)
+            return True
+        except r.ReqlError:
+            return False
+
+    def _get_connection(self):
+        self._evict_idle()
+        while self._idle:
+            conn, checked_in_at = self._idle.pop()
+            if self._is_healthy(conn, checked_in_at):
+                return conn
+            self._evictions.inc()
+            self._close(conn)
+        self._connects.inc()
+        return self.connect()
+
+    def checkout(self):
+        '''Returns a connection which must be returned with `checkin`.
+        Raises `PoolTimeoutError` if no connection is available within
+        `checkout_timeout` seconds.
+        '''
+        start = time.time()
+        acquired = self._slots.acquire(timeout=self.checkout_timeout)
+        self._wait_time.record(time.time() - start)
+        if not acquired:
+            self._timeouts.inc()
+            raise PoolTimeoutError('Timed out waiting for a database connection ({} in use)'.format(self._in_use))
+        try:
+            conn = self._get_connection()
+        except:
+            self._slots.release()
+            raise
+        self._in_use += 1
+        self._checkouts.inc()
+        return conn
+
+    def checkin(self, conn, reusable=True):
+        '''Returns `conn` to the pool. Connections that are not `reusable`
+        (for example, after a query failed in the middle) are closed.
+        '''
+        self._in_use -= 1
+        try:
+            if reusable and conn.is_open():
+                self._idle.append((conn, time.time()))
+            else:
+                self._close(conn)
+            self._evict_idle()
+        finally:
+            self._slots.release()
+
+def _is_reusable_after(error):
+    # Errors reported by the server come with a complete response, any
+    # other error might leave the connection in the middle of one
+    return isinstance(error, (r.ReqlRuntimeError, r.ReqlCompileError))
+
+class _Lease(object):
+    '''A connection checked out for a greenlet, shared by all of its
+    queries and open cursors until the last of them is done.
+    '''
+    def __init__(self, greenlet, conn):
+        super(_Lease, self).__init__()
+        self.greenlet = greenlet
+        self.conn = conn
+        self.users = 0
+        self.reusable = True
+
+class _PooledCursor(object):
+    '''Iterates a cursor and releases its lease once the cursor is
+    exhausted, closed or garbage collected.
+    '''
+    def __init__(self, db, lease, cursor):
+        super(_PooledCursor, self).__init__()
+        self._db = db
+        self._lease = lease
+        self._cursor = cursor
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._lease is None:
+            raise StopIteration()
+        try:
+            return self._cursor.next()
+        except StopIteration:
+            self._release(reusable=True)
+            raise
+        except Exception as error:
+            self._release(reusable=_is_reusable_after(error))
+            raise
+
+    def close(self):
+        if self._lease is not None:
+            # Stop the cursor so the connection can be used by other
+            # queries
+            self._cursor.close()
+            self._release(reusable=True)
+
+    def _release(self, reusable):
+        lease, self._lease = self._lease, None
+        self._db._release(lease, reusable)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            logger.exception('Could not close a database cursor')
+
+class RethinkDB(object):
+    '''Runs queries with connections from a `ConnectionPool`. A connection
+    is checked out when a greenlet runs a query and checked in as soon as
+    the result was read, so slow clients don't hold connections while
+    their request body is read or their response is sent. Queries that
+    return a cursor keep their connection until the cursor is exhausted
+    or closed, and other queries of the same greenlet share it meanwhile.
+
+    `connect` opens a new connection outside the pool, for long-lived
+    uses like changes feeds.
+    '''
+    def __init__(self):
+        super(RethinkDB, self).__init__()
+        self.pool = None
+        self._leases = {} # greenlet -> _Lease
+
+    def init_app(self, app):
+        config = app.config
+        def connect():
+            return r.connect(host     = config['RETHINKDB_HOST'] or 'localhost',
+                             port     = config['RETHINKDB_PORT'] or 28015,
+                             auth_key = config['RETHINKDB_AUTH'],
+                             db       = config['RETHINKDB_DB'])
+        self.pool = ConnectionPool(
+            name                  = 'db_pool',
+            connect               = connect,
+            max_size              = config['RETHINKDB_POOL_SIZE'],
+            max_idle_time         = config['RETHINKDB_POOL_MAX_IDLE_TIME'],
+            checkout_timeout      = config['RETHINKDB_POOL_CHECKOUT_TIMEOUT'],
+            health_check_interval = config['RETHINKDB_POOL_HEALTH_CHECK_INTERVAL'],
+        )
+
+    def connect(self):
+        return self.pool.connect()
+
+    def _acquire(self):
+        greenlet = gevent.getcurrent()
+        lease = self._leases.get(greenlet, None)
+        if lease is None:
+            lease = _Lease(greenlet, self.pool.checkout())
+            self._leases[greenlet] = lease
+        lease.users += 1
+        return lease
+
+    def _release(self, lease, reusable):
+        lease.users -= 1
+        lease.reusable = lease.reusable and reusable
+        if lease.users == 0:
+            if self._leases.get(lease.greenlet, None) is lease:
+                del self._leases[lease.greenlet]
+            self.pool.checkin(lease.conn, reusable=lease.reusable)
+
+    def run(self, query):
+        '''Runs `query` and returns its result. Raises `PoolTimeoutError`
+        if no connection is available (see `ConnectionPool.checkout`).
+        '''
+        lease = self._acquire()
+        try:
+            result = query.run(lease.conn)
+        except Exception as error:
+            self._release(lease, reusable=_is_reusable_after(error))
+            raise
+        except:
+            self._release(lease, reusable=False)
+            raise
+        if isinstance(result, r.net.Cursor):
+            return _PooledCursor(self, lease, result)
+        self._release(lease, reusable=True)
+        return result
 
 db = RethinkDB()
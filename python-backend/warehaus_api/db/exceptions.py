@@ -1,2 +1,9 @@
+from werkzeug.exceptions import ServiceUnavailable
+
 class RethinkDBError(Exception):
     pass
+
+class PoolTimeoutError(RethinkDBError, ServiceUnavailable):
+    '''Raised when no database connection is available in time. Requests
+    that fail with it get `SERVICE_UNAVAILABLE`.
+    '''
@@ -3,38 +3,125 @@ import rethinkdb as r
 from copy import deepcopy
 from logging import getLogger
 from flask import abort as flask_abort
-from .db import db
 from .times import now
 from .exceptions import RethinkDBError
 from .fields import Field
+from .session import run_query
+from .session import current_session
+from .session import new_id
 
 logger = getLogger(__name__)
 
 class Query(object):
-    def __init__(self, model_type):
+    def __init__(self, model_type, is_read_only=False):
         super(Query, self).__init__()
         self.model_type = model_type
+        self.is_read_only = is_read_only
+
+    @property
+    def read_only(self):
+        '''The same query but returning read-only models (see
+        `Model.read_only`). Use it for documents that are only read, for
+        example when they're serialized into a response.
+        '''
+        return Query(self.model_type, is_read_only=True)
+
+    def table(self):
+        return r.table(self.model_type._table_name)
+
+    def run(self, query):
+        return run_query(query)
+
+    def wrap(self, doc):
+        if self.is_read_only:
+            return self.model_type.read_only(doc)
+        return self.model_type(**doc)
 
     def get(self, *args, **kwargs):
-        doc = r.table(self.model_type._table_name).get(*args, **kwargs).run(db.conn)
+        doc = self.run(self.table().get(*args, **kwargs))
         if doc is None:
             return None
-        return self.model_type(**doc)
+        return self.wrap(doc)
 
     def _run_query_and_wrap_objects(self, query):
-        return (self.model_type(**doc) for doc in query.run(db.conn))
+        return (self.wrap(doc) for doc in self.run(query))
 
     def all(self):
-        return self._run_query_and_wrap_objects(r.table(self.model_type._table_name))
+        return self._run_query_and_wrap_objects(self.table())
 
     def get_all(self, *args, **kwargs):
-        return self._run_query_and_wrap_objects(r.table(self.model_type._table_name).get_all(*args, **kwargs))
+        return self._run_query_and_wrap_objects(self.table().get_all(*args, **kwargs))
 
     def between(self, *args, **kwargs):
-        return self._run_query_and_wrap_objects(r.table(self.model_type._table_name).between(*args, **kwargs))
+        return self._run_query_and_wrap_objects(self.table().between(*args, **kwargs))
 
     def filter(self, *args, **kwargs):
-        return self._run_query_and_wrap_objects(r.table(self.model_type._table_name).filter(*args, **kwargs))
+        return self._run_query_and_wrap_objects(self.table().filter(*args, **kwargs))
+
+    def page(self, index, prefix, after=None, fields=None, limit=None, filter=None):
+        '''Returns a cursor of the documents found in the compound `index`
+        with `prefix` as its first value, ordered by the rest of the index.
+        The other values of the index are expected to be `created_at` and
+        `id`, so documents are returned in the order they were created.
+
+        `after` is a list of the `created_at` and `id` of the last document
+        of the previous page, and can hold ReQL expressions. Only the
+        `fields` of the documents are returned (along with `id` and
+        `created_at` so the caller can continue to the next page), and at
+        most `limit` documents. `filter` is a predicate that's applied
+        before the limit.
+        '''
+        lower = [prefix, r.minval, r.minval] if after is None else [prefix] + list(after)
+        query = self.table().between(lower, [prefix, r.maxval, r.maxval], index=index, left_bound='open')
+        query = query.order_by(index=index)
+        if filter is not None:
+            query = query.filter(filter)
+        if fields is not None:
+            query = query.pluck(*(set(fields) | set(['id', 'created_at'])))
+        if limit is not None:
+            query = query.limit(limit)
+        return self.run(query)
+
+    def insert_many(self, objs):
+        '''Inserts all of the new objects in `objs` with a single query, or
+        adds them to the active session.
+        '''
+        objs = list(objs)
+        if not objs:
+            return
+        session = current_session()
+        if session is not None:
+            for obj in objs:
+                obj._insert_into(session)
+            return
+        result = self.run(self.table().insert([obj._data for obj in objs]))
+        if result['inserted'] != len(objs):
+            raise RethinkDBError('Expected {} insertions, instead: {!r}'.format(len(objs), result))
+        generated_keys = iter(result.get('generated_keys', ()))
+        for obj in objs:
+            if 'id' not in obj:
+                obj._data['id'] = next(generated_keys)
+            obj._dirty_data = {}
+
+    def delete_many(self, objs):
+        '''Deletes all `objs` with a single query.'''
+        objs = list(objs)
+        if not objs:
+            return
+        for obj in objs:
+            if 'id' not in obj._data or obj._data['id'] is None:
+                raise RethinkDBError('Attempt to delete a document not in the database')
+            assert not obj._dirty_data, 'Trying to delete a dirty object'
+        session = current_session()
+        if session is not None:
+            for obj in objs:
+                session.delete(self.model_type._table_name, obj._data.pop('id'))
+            return
+        result = self.run(self.table().get_all(*[obj._data['id'] for obj in objs]).delete())
+        if result['deleted'] != len(objs):
+            raise RethinkDBError('Expected {} deletions, instead: {!r}'.format(len(objs), result))
+        for obj in objs:
+            del obj._data['id']
 
     def get_one_or_none(self, *args, **kwargs):
         error = kwargs.pop('error', None)
@@ -54,70 +141,135 @@ class Query(object):
             flask_abort(httplib.INTERNAL_SERVER_ERROR, error)
         return obj
 
+def _default_factory(field):
+    if callable(field.default):
+        return field.default
+    return lambda: field.default
+
+# Fields of all models. They're the same for every model so they're
+# shared rather than created for every model class.
+_COMMON_FIELDS = (
+    Field(field_name='id'),
+    Field(field_name='created_at', default=now),
+    Field(field_name='modified_at', default=now),
+)
+
 class ModelType(type):
+    '''Creates model classes. Besides `_fields`, every model class gets:
+    - `_field_names`: a frozenset of the names of its fields.
+    - `_default_factories`: a tuple of `(field_name, factory)` for each
+      field with a default value, where `factory()` returns the default.
+    - Empty `__slots__`, so models only have the storage defined in
+      `Model.__slots__` and no per-instance `__dict__`.
+    '''
     def __new__(mcs, name, bases, attrs):
-        for forbidden in ('_data', '_dirty_data', '_fields', '_table_name'):
+        for forbidden in ('_data', '_dirty_data', '_is_read_only', '_fields', '_field_names', '_default_factories', '_table_name'):
             if forbidden in attrs:
                 raise TypeError("Model subclasses should not provide a '{}' attribute of their own".format(forbidden))
         if 'id' in attrs:
             raise TypeError("An 'id' is automatically created in {} classes, please don't create one manually".format(name))
         attrs['_table_name'] = attrs.get('TABLE_NAME', name.lower())
-        attrs['_fields'] = {
-            'id'          : Field(field_name='id'),
-            'created_at'  : Field(field_name='created_at', default=now),
-            'modified_at' : Field(field_name='modified_at', default=now),
-        }
+        attrs['_fields'] = {field.field_name: field for field in _COMMON_FIELDS}
         for attr, obj in tuple(attrs.iteritems()):
             if isinstance(obj, Field):
                 del attrs[attr]
                 obj.field_name = attr
                 attrs['_fields'][attr] = obj
+        attrs['_field_names'] = frozenset(attrs['_fields'])
+        attrs['_default_factories'] = tuple((field_name, _default_factory(field))
+                                            for field_name, field in attrs['_fields'].iteritems()
+                                            if field.has_default_value())
+        attrs.setdefault('__slots__', ())
         typeobj = type.__new__(mcs, name, bases, attrs)
         typeobj.query = Query(typeobj)
         return typeobj
 
 class Model(object):
     __metaclass__ = ModelType
+    __slots__ = ('_data', '_dirty_data', '_is_read_only')
     _allow_additional_items = False
 
+    # Fields that are updated too often to count as modifications of the
+    # document: updates that only change them don't touch `modified_at`
+    UNVERSIONED_FIELDS = frozenset()
+
     def __init__(self, **kwargs):
         super(Model, self).__init__()
-        self._check_extraneous_fields(**kwargs)
-        self._data = dict(kwargs)
-        for field_name, field in self._fields.iteritems():
-            if field_name not in kwargs and field.has_default_value():
-                self._data[field_name] = field.default_value()
+        self._check_extraneous_fields(kwargs)
+        # kwargs is a new dict on every call so we can keep it as is
+        for field_name, default_factory in self._default_factories:
+            if field_name not in kwargs:
+                kwargs[field_name] = default_factory()
+        self._data = kwargs
         self._dirty_data = {}
+        self._is_read_only = False
+
+    @classmethod
+    def read_only(cls, doc):
+        '''Returns a read-only model for `doc`, a document returned by the
+        database. `doc` is used as is: it's not copied, missing fields are
+        not filled with their defaults and changes are not tracked. Trying
+        to modify, save or delete a read-only model raises `TypeError`.
+        '''
+        obj = cls.__new__(cls)
+        obj._data = doc
+        obj._dirty_data = None
+        obj._is_read_only = True
+        return obj
+
+    def _check_writable(self):
+        if self._is_read_only:
+            raise TypeError('{} object is read-only'.format(type(self).__name__))
 
-    def _check_extraneous_fields(self, **kwargs):
+    def _check_extraneous_fields(self, fields):
         if self._allow_additional_items:
             return
-        extraneous_fields = set(kwargs) - set(self._fields)
+        extraneous_fields = [field_name for field_name in fields if field_name not in self._field_names]
         if extraneous_fields:
             raise TypeError("{} doesn't have the following attributes: {}".format(
                 type(self).__name__, ', '.join(extraneous_fields)))
 
     def update(self, **kwargs):
-        self._check_extraneous_fields()
+        self._check_writable()
+        self._check_extraneous_fields(kwargs)
         for field_name, new_value in kwargs.iteritems():
             self[field_name] = new_value
 
+    def _insert_into(self, session):
+        if 'id' not in self._data:
+            self._data['id'] = new_id()
+        # The document is copied since later changes are sent as updates
+        session.insert(self._table_name, dict(self._data))
+        self._dirty_data = {}
+
     def _insert(self):
-        result = r.table(self._table_name).insert(self._data).run(db.conn)
+        session = current_session()
+        if session is not None:
+            self._insert_into(session)
+            return
+        result = run_query(r.table(self._table_name).insert(self._data))
         if result['inserted'] != 1:
             raise RethinkDBError('Expected 1 insertion, instead: {!r}'.format(result))
         if 'id' not in self:
             [self._data['id']] = result['generated_keys']
 
     def _update(self):
-        self._dirty_data['modified_at'] = now()
-        result = r.table(self._table_name).get(self._data['id']).update(self._dirty_data).run(db.conn)
+        if not self.UNVERSIONED_FIELDS.issuperset(self._dirty_data):
+            self._dirty_data['modified_at'] = now()
+        session = current_session()
+        if session is not None:
+            session.update(self._table_name, self._data['id'], self._dirty_data)
+            self._data.update(self._dirty_data)
+            self._dirty_data = {}
+            return
+        result = run_query(r.table(self._table_name).get(self._data['id']).update(self._dirty_data))
         if result['replaced'] != 1:
             raise RethinkDBError('Expected 1 replacement, instead: {!r}'.format(result))
         self._data.update(self._dirty_data)
         self._dirty_data = {}
 
     def save(self, force_insert=False):
+        self._check_writable()
         if force_insert or ('id' not in self._data):
             self._insert()
         elif self._dirty_data:
@@ -127,28 +279,39 @@ class Model(object):
             self._update()
 
     def delete(self):
+        self._check_writable()
         if 'id' not in self._data or self._data['id'] is None:
             raise RethinkDBError('Attempt to delete a document not in the database')
         assert not self._dirty_data, 'Trying to delete a dirty object'
-        result = r.table(self._table_name).get(self._data['id']).delete().run(db.conn)
+        session = current_session()
+        if session is not None:
+            session.delete(self._table_name, self._data.pop('id'))
+            return
+        result = run_query(r.table(self._table_name).get(self._data['id']).delete())
         if result['deleted'] != 1:
             raise RethinkDBError('Expected 1 deletion, instead: {!r}'.format(result))
         del self._data['id']
 
     def _attr_allowed(self, attr):
-        return (attr in self._fields) or (self._allow_additional_items and not attr.startswith('_'))
+        return (attr in self._field_names) or (self._allow_additional_items and not attr.startswith('_'))
 
     def __getattr__(self, attr):
+        # Only called for attributes that aren't found normally, which
+        # includes all fields since they're not stored as attributes.
         if self._attr_allowed(attr):
-            if attr not in self._data:
-                if attr in self._fields:
-                    self._data[attr] = self._fields[attr].default_value()
-            if attr in self._data:
-                return self._data[attr]
-        return super(Model, self).__getattr__(attr)
+            data = self._data
+            if attr in data:
+                return data[attr]
+            if attr in self._field_names:
+                value = self._fields[attr].default_value()
+                if not self._is_read_only:
+                    data[attr] = value
+                return value
+        raise AttributeError("{!r} object has no attribute {!r}".format(type(self).__name__, attr))
 
     def __setattr__(self, attr, value):
         if self._attr_allowed(attr):
+            self._check_writable()
             if (attr in self._data) and not isinstance(value, r.ast.Literal) and (value == self._data[attr]):
                 return
             self._data[attr] = value
@@ -170,4 +333,17 @@ class Model(object):
         return iter(self._fields)
 
     def as_dict(self):
+        '''Returns the data of the model. Callers may modify the result of
+        writable models, which is a copy. Read-only models return their
+        document itself.
+        '''
+        if self._is_read_only:
+            return self._data
         return deepcopy(self._data)
+
+    def data_view(self):
+        '''Returns the data of the model without copying it, for callers
+        that only read it (like the JSON encoder). The result must not be
+        modified.
+        '''
+        return self._data
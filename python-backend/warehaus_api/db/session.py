@@ -0,0 +1,192 @@
+import rethinkdb as r
+from uuid import uuid4
+from logging import getLogger
+from contextlib import contextmanager
+from flask import g
+from flask import has_app_context
+from .db import db
+from .exceptions import RethinkDBError
+
+logger = getLogger(__name__)
+
+#----------------------------------------------------------------#
+# Query counting                                                 #
+#----------------------------------------------------------------#
+
+def count_query():
+    '''Counts the queries sent to the database while handling the current
+    request (see `get_query_count`).
+    '''
+    if has_app_context():
+        g.query_count = get_query_count() + 1
+
+def get_query_count():
+    return g.get('query_count', 0)
+
+def _run(query):
+    count_query()
+    return db.run(query)
+
+#----------------------------------------------------------------#
+# Sessions                                                       #
+#----------------------------------------------------------------#
+
+def new_id():
+    '''Returns an id for a new document. Documents saved in a session get
+    their id when they're saved rather than when they're inserted.
+    '''
+    return str(uuid4())
+
+class Session(object):
+    '''Collects the inserts, updates and deletes of models and sends them
+    to the database together when flushed, with one query per table and
+    kind of write.
+
+    Writes are flushed in the order inserts, updates and then deletes.
+    Queries run while a session is active flush the session first if
+    they use a table with pending writes (see `run_query`), so queries
+    always see the writes made before them, while other queries leave
+    the writes to be sent together.
+
+    Work that must follow the writes, like invalidating what was derived
+    from the written documents, can be added with `after_flush`.
+    '''
+    def __init__(self):
+        super(Session, self).__init__()
+        self._clear()
+
+    def _clear(self):
+        # table_name -> list of documents/update terms/ids
+        self._inserts = {}
+        self._updates = {}
+        self._deletes = {}
+        self._table_order = []
+        self._after_flush = {} # func -> set of values
+        self._hook_tables = set()
+
+    def _pending(self, writes, table_name):
+        if table_name not in self._table_order:
+            self._table_order.append(table_name)
+        return writes.setdefault(table_name, [])
+
+    def insert(self, table_name, doc):
+        self._pending(self._inserts, table_name).append(doc)
+
+    def update(self, table_name, doc_id, changes):
+        # Updates are kept as separate terms rather than merged per
+        # document, since `update` merges nested objects and `r.literal`
+        # is only valid as the argument of `update`.
+        self._pending(self._updates, table_name).append(r.table(table_name).get(doc_id).update(changes))
+
+    def delete(self, table_name, doc_id):
+        self._pending(self._deletes, table_name).append(doc_id)
+
+    def after_flush(self, func, values, table_name=None):
+        '''Calls `func` with a set of all `values` given for it once the
+        pending writes are flushed. If `func` writes to `table_name`,
+        queries of that table flush the session first.
+        '''
+        self._after_flush.setdefault(func, set()).update(values)
+        if table_name is not None:
+            self._hook_tables.add(table_name)
+
+    def has_pending_writes(self, table_names):
+        '''Returns whether any of `table_names` has pending writes, or
+        whether anything is pending when `table_names` is `None`.
+        '''
+        pending = set(self._table_order) | self._hook_tables
+        if table_names is None:
+            return bool(pending)
+        return not pending.isdisjoint(table_names)
+
+    def __len__(self):
+        return sum(len(writes) for pending in (self._inserts, self._updates, self._deletes)
+                   for writes in pending.itervalues())
+
+    def flush(self):
+        '''Sends all pending writes to the database. Raises `RethinkDBError`
+        if any write didn't apply to the expected number of documents.
+        '''
+        if not len(self) and not self._after_flush:
+            return
+        inserts, updates, deletes, table_order = self._inserts, self._updates, self._deletes, self._table_order
+        after_flush = self._after_flush
+        self._clear()
+        for table_name in table_order:
+            docs = inserts.get(table_name, ())
+            if docs:
+                result = _run(r.table(table_name).insert(docs))
+                if result['inserted'] != len(docs):
+                    raise RethinkDBError('Expected {} insertions into {!r}, instead: {!r}'.format(len(docs), table_name, result))
+        for table_name in table_order:
+            terms = updates.get(table_name, ())
+            if terms:
+                results = _run(r.expr(terms))
+                if any(result['replaced'] != 1 for result in results):
+                    raise RethinkDBError('Expected {} replacements in {!r}, instead: {!r}'.format(len(terms), table_name, results))
+        for table_name in table_order:
+            doc_ids = deletes.get(table_name, ())
+            if doc_ids:
+                result = _run(r.table(table_name).get_all(*doc_ids).delete())
+                if result['deleted'] != len(doc_ids):
+                    raise RethinkDBError('Expected {} deletions from {!r}, instead: {!r}'.format(len(doc_ids), table_name, result))
+        for func, values in after_flush.iteritems():
+            func(values)
+
+def current_session():
+    '''Returns the active session or `None` if there's none.'''
+    if not has_app_context():
+        return None
+    return g.get('db_session', None)
+
+@contextmanager
+def session_scope():
+    '''Runs the body with an active session and flushes it at the end. The
+    session is flushed even if the body fails, so writes made before the
+    failure are kept just like without a session.
+    '''
+    if current_session() is not None:
+        yield current_session()
+        return
+    session = Session()
+    g.db_session = session
+    try:
+        yield session
+    except:
+        g.db_session = None
+        try:
+            session.flush()
+        except Exception:
+            logger.exception('Could not flush the session of a failed request')
+        raise
+    g.db_session = None
+    session.flush()
+
+def query_tables(query):
+    '''Returns the names of the tables `query` uses, or `None` when some
+    table name is only known once the query runs.
+    '''
+    table_names = set()
+    terms = [query]
+    while terms:
+        term = terms.pop()
+        if not isinstance(term, r.ast.RqlQuery):
+            continue
+        if isinstance(term, r.ast.Table):
+            # The name is the last argument, after the database if any
+            name = term._args[-1]
+            if not isinstance(name, r.ast.Datum) or not isinstance(name.data, basestring):
+                return None
+            table_names.add(name.data)
+        terms.extend(term._args)
+        terms.extend(term.optargs.itervalues())
+    return table_names
+
+def run_query(query):
+    '''Runs `query`, flushing the active session first if the query uses a
+    table with pending writes.
+    '''
+    session = current_session()
+    if (session is not None) and session.has_pending_writes(query_tables(query)):
+        session.flush()
+    return _run(query)
@@ -1,7 +1,59 @@
+import re
+import json
+import calendar
 from datetime import datetime
+from datetime import timedelta
 from pytz import timezone
 
 UTC = timezone('UTC')
 
 def now():
     return datetime.now(UTC)
+
+def epoch_time(dt):
+    '''Returns the datetime `dt` as seconds since the epoch, rounded to
+    milliseconds like RethinkDB keeps times.
+    '''
+    return round(calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6, 3)
+
+ISO8601_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2})(?::(\d{2})(\.\d+)?)?(?:(Z)|([+-])(\d{2}):(\d{2}))$')
+
+def parse_iso8601(value):
+    '''Returns the ISO 8601 time `value`, which must have a timezone, as
+    a datetime in UTC. Raises `ValueError` for any other format.
+    '''
+    match = ISO8601_RE.match(value)
+    if match is None:
+        raise ValueError('Not an ISO 8601 time with a timezone: {!r}'.format(value))
+    year, month, day, hour, minute, second, fraction, zulu, sign, tz_hours, tz_minutes = match.groups()
+    dt = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second or 0),
+                  int(round(float(fraction or 0) * 1e6)), UTC)
+    if not zulu:
+        offset = timedelta(hours=int(tz_hours), minutes=int(tz_minutes))
+        dt = dt - offset if sign == '+' else dt + offset
+    return dt
+
+#----------------------------------------------------------------#
+# Times in JSON files                                            #
+#----------------------------------------------------------------#
+
+# Documents kept in local files write times in the format of the
+# RethinkDB time pseudo-type, so they can be inserted back as is.
+
+class TimeEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return {
+                '$reql_type$' : 'TIME',
+                'epoch_time'  : epoch_time(obj),
+                'timezone'    : '+00:00',
+            }
+        return json.JSONEncoder.default(self, obj)
+
+def decode_time(obj):
+    '''An `object_hook` for `json.loads` that reads times written with
+    `TimeEncoder`.
+    '''
+    if obj.get('$reql_type$', None) == 'TIME':
+        return datetime.fromtimestamp(obj['epoch_time'], UTC)
+    return obj
@@ -0,0 +1,151 @@
+import os
+import json
+import gzip
+from glob import glob
+from datetime import datetime
+from datetime import timedelta
+from logging import getLogger
+from ..metrics import metrics
+from ..db.times import UTC
+from ..db.times import epoch_time
+from ..db.times import TimeEncoder
+from ..db.times import decode_time
+
+logger = getLogger(__name__)
+
+SEGMENT_FILE_PATTERN = 'events-{}.jsonl.gz'
+INDEX_FILE_PATTERN = 'events-{}.index.json'
+DAY_FORMAT = '%Y-%m-%d'
+
+def day_of(dt):
+    '''Returns the UTC day of the datetime `dt` as a string.'''
+    return dt.astimezone(UTC).strftime(DAY_FORMAT)
+
+def day_start(day):
+    return datetime.strptime(day, DAY_FORMAT).replace(tzinfo=UTC)
+
+def _sort_key(doc):
+    # The order of the `interested_created` index
+    return (epoch_time(doc['created_at']), doc['id'])
+
+def _write_atomically(path, write):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_path, path)
+
+class EventArchive(object):
+    '''Events moved out of the database, kept in local files with one
+    segment per UTC day.
+
+    A segment is a gzipped JSON lines file of the events created on that
+    day, newest first. Next to every segment is a small index file that
+    counts the events of every id in `interested_ids`, so reading the
+    events of an object only opens the segments that have some. Index
+    files are written after their segments, and segments with no index
+    file are ignored.
+    '''
+    def __init__(self, name):
+        super(EventArchive, self).__init__()
+        self.archive_dir = None
+        self._indexes = {} # day -> (mtime, index)
+        self._archived = metrics.counter(name + '.archived')
+        self._segment_reads = metrics.counter(name + '.segment_reads')
+
+    def configure(self, archive_dir):
+        self.archive_dir = archive_dir
+
+    @property
+    def enabled(self):
+        return self.archive_dir is not None
+
+    def _path(self, pattern, day):
+        return os.path.join(self.archive_dir, pattern.format(day))
+
+    def days(self):
+        '''Returns the days that have segments, oldest first.'''
+        prefix, suffix = INDEX_FILE_PATTERN.split('{}')
+        names = (os.path.basename(path) for path in glob(self._path(INDEX_FILE_PATTERN, '*')))
+        return sorted(name[len(prefix):-len(suffix)] for name in names)
+
+    def _index(self, day):
+        path = self._path(INDEX_FILE_PATTERN, day)
+        mtime = os.path.getmtime(path)
+        cached = self._indexes.get(day, None)
+        if (cached is None) or (cached[0] != mtime):
+            with open(path, 'rb') as f:
+                cached = (mtime, json.load(f))
+            self._indexes[day] = cached
+        return cached[1]
+
+    def _read_segment(self, day):
+        self._segment_reads.inc()
+        with gzip.open(self._path(SEGMENT_FILE_PATTERN, day), 'rb') as segment:
+            return [json.loads(line, object_hook=decode_time) for line in segment]
+
+    def archive_day(self, day, docs):
+        '''Adds the events `docs`, which were created on `day`, to the
+        segment of that day. Events already in the segment are replaced,
+        so archiving the same events again is harmless.
+        '''
+        merged = {}
+        if os.path.exists(self._path(INDEX_FILE_PATTERN, day)):
+            merged.update((doc['id'], doc) for doc in self._read_segment(day))
+        merged.update((doc['id'], doc) for doc in docs)
+        merged = sorted(merged.itervalues(), key=_sort_key, reverse=True)
+        counts = {}
+        for doc in merged:
+            for interested_id in doc.get('interested_ids', None) or ():
+                counts[interested_id] = counts.get(interested_id, 0) + 1
+        def write_segment(f):
+            with gzip.GzipFile(fileobj=f, mode='wb') as segment:
+                for doc in merged:
+                    segment.write(json.dumps(doc, cls=TimeEncoder) + '\n')
+        def write_index(f):
+            json.dump(dict(count=len(merged), interested_ids=counts), f)
+        if not os.path.isdir(self.archive_dir):
+            os.makedirs(self.archive_dir)
+        _write_atomically(self._path(SEGMENT_FILE_PATTERN, day), write_segment)
+        _write_atomically(self._path(INDEX_FILE_PATTERN, day), write_index)
+        self._archived.inc(len(docs))
+
+    def read_page(self, interested_id, limit, before=None, since=None, until=None):
+        '''Returns up to `limit` archived events of `interested_id`, newest
+        first. The arguments are like in `get_events_page`, except that
+        `since` and `until` are datetimes.
+        '''
+        before_key = None if before is None else (before[1], before[0])
+        since_epoch = None if since is None else epoch_time(since)
+        until_epoch = None if until is None else epoch_time(until)
+        events = []
+        for day in reversed(self.days()):
+            start = epoch_time(day_start(day))
+            if (since_epoch is not None) and (start + timedelta(days=1).total_seconds() <= since_epoch):
+                break
+            if ((until_epoch is not None) and (start > until_epoch)) or ((before_key is not None) and (start > before_key[0])):
+                continue
+            try:
+                if interested_id not in self._index(day)['interested_ids']:
+                    continue
+                segment = self._read_segment(day)
+            except (IOError, OSError):
+                logger.exception('Could not read the archived events of {}'.format(day))
+                continue
+            for doc in segment:
+                key = _sort_key(doc)
+                if (since_epoch is not None) and (key[0] < since_epoch):
+                    break
+                if ((until_epoch is not None) and (key[0] > until_epoch)) or ((before_key is not None) and (key >= before_key)):
+                    continue
+                if interested_id in doc['interested_ids']:
+                    events.append(doc)
+                    if len(events) == limit:
+                        return events
+        return events
+
+event_archive = EventArchive('event_archive')
+
+def init_event_archive(app):
+    event_archive.configure(app.config['EVENT_ARCHIVE_DIR'])
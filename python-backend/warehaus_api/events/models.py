@@ -1,4 +1,6 @@
 from .. import db
+from ..db.session import new_id
+from .writer import event_writer
 
 class Event(db.Model):
     obj_id  = db.Field() # The object for which this event was created about
@@ -15,11 +17,24 @@ class Event(db.Model):
     interested_ids = db.Field()
 
 def create_event(obj_id, user_id, interested_ids, title, content=''):
+    '''Creates an event and returns its id. Events are written in the
+    background by the event writer (see `EventWriter`) when it's enabled.
+    Repeated ids in `interested_ids` are stored once.
+    '''
+    unique_ids = []
+    for interested_id in interested_ids:
+        if interested_id not in unique_ids:
+            unique_ids.append(interested_id)
     event = Event(
+        id             = new_id(),
         obj_id         = obj_id,
         user_id        = user_id,
-        interested_ids = interested_ids,
+        interested_ids = unique_ids,
         title          = title,
         content        = content,
     )
-    event.save()
+    if event_writer.enabled:
+        event_writer.write(event.data_view())
+    else:
+        event.save()
+    return event.id
@@ -0,0 +1,64 @@
+import time
+import rethinkdb as r
+from datetime import timedelta
+from logging import getLogger
+from argparse import ArgumentParser
+from ..logs import log_to_console
+from ..db.times import now
+from ..db.session import run_query
+from ..app import create_db_app
+from .models import Event
+from .archive import day_of
+from .archive import day_start
+from .archive import event_archive
+from .archive import init_event_archive
+
+logger = getLogger(__name__)
+
+def archive_old_events(archive, retention_days, batch_size):
+    '''Moves the events created before the day `retention_days` days ago
+    from the database to `archive`, a day at a time. Events are deleted
+    only after their day was archived, so stopping in the middle loses
+    nothing. Returns the number of archived events.
+    '''
+    cutoff = day_start(day_of(now() - timedelta(days=retention_days)))
+    total = 0
+    while True:
+        oldest = list(run_query(Event.query.table().between(r.minval, cutoff, index='created_at')
+                                .order_by(index='created_at').limit(1)))
+        if not oldest:
+            return total
+        day = day_of(oldest[0]['created_at'])
+        end = min(day_start(day) + timedelta(days=1), cutoff)
+        docs = list(run_query(Event.query.table().between(day_start(day), end, index='created_at')))
+        logger.info('Archiving {} events of {}'.format(len(docs), day))
+        archive.archive_day(day, docs)
+        doc_ids = [doc['id'] for doc in docs]
+        for offset in xrange(0, len(doc_ids), batch_size):
+            run_query(Event.query.table().get_all(*doc_ids[offset:offset + batch_size]).delete())
+        total += len(docs)
+
+def main():
+    parser = ArgumentParser(description='Moves old events from the database to the event archive')
+    parser.add_argument('--once', action='store_true', help='Archive once and exit instead of every interval')
+    args = parser.parse_args()
+    log_to_console()
+    app = create_db_app()
+    init_event_archive(app)
+    retention_days = app.config['EVENT_RETENTION_DAYS']
+    while True:
+        if retention_days > 0:
+            with app.app_context():
+                try:
+                    total = archive_old_events(event_archive, retention_days, app.config['EVENT_RETENTION_BATCH_SIZE'])
+                    logger.info('Archived {} events older than {} days'.format(total, retention_days))
+                except Exception:
+                    logger.exception('Could not archive old events')
+                    if args.once:
+                        raise
+        if args.once:
+            break
+        time.sleep(app.config['EVENT_RETENTION_INTERVAL'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+import rethinkdb as r
+from ..db.times import epoch_time
+from ..db.session import run_query
+from .models import Event
+from .archive import event_archive
+
+# A multi index of `[interested_id, created_at, id]` for every id in the
+# `interested_ids` of an event (see backend/init-db.js)
+INTERESTED_CREATED_INDEX = 'interested_created'
+
+def get_events_page(interested_id, limit, before=None, since=None, until=None):
+    '''Returns a list of up to `limit` events that `interested_id` is
+    interested in, newest first.
+
+    `before` is a tuple of `(id, created_at)` of the last event of the
+    previous page, where `created_at` is in seconds since the epoch.
+    `since` and `until` are datetimes that limit the creation times of
+    the events.
+
+    Pages continue into the event archive once the events in the
+    database run out (see `EventArchive`).
+    '''
+    lower = [interested_id, r.minval if since is None else since, r.minval]
+    if before is None:
+        upper = [interested_id, r.maxval if until is None else until, r.maxval]
+    else:
+        before_id, before_created_at = before
+        upper = [interested_id, r.epoch_time(before_created_at), before_id]
+    query = Event.query.table().between(lower, upper, index=INTERESTED_CREATED_INDEX,
+                                        left_bound='closed', right_bound='open')
+    query = query.order_by(index=r.desc(INTERESTED_CREATED_INDEX)).limit(limit)
+    events = list(run_query(query))
+    if (len(events) < limit) and event_archive.enabled:
+        if events:
+            before = (events[-1]['id'], epoch_time(events[-1]['created_at']))
+        # Events are deleted from the database only after they're archived,
+        # so the same event might be found in both
+        seen_ids = set(event['id'] for event in events)
+        archived = event_archive.read_page(interested_id, limit, before=before, since=since, until=until)
+        events.extend([event for event in archived if event['id'] not in seen_ids][:limit - len(events)])
+    return events
@@ -0,0 +1,265 @@
+import os
+import json
+import errno
+import fcntl
+import atexit
+import gevent
+import rethinkdb as r
+from glob import glob
+from uuid import uuid4
+from logging import getLogger
+from gevent.event import Event as GeventEvent
+from ..metrics import metrics
+from ..db.times import TimeEncoder
+from ..db.times import decode_time
+from ..db.session import run_query
+
+logger = getLogger(__name__)
+
+#----------------------------------------------------------------#
+# Spill files                                                    #
+#----------------------------------------------------------------#
+
+# Events are spilled as JSON lines, with times written by `TimeEncoder`.
+
+SPILL_FILE_PATTERN = 'events-{}.jsonl'
+
+# Errors of a non-blocking `flock` of a file locked by another process
+_LOCKED_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EACCES)
+
+def _lock_if_current(spill_file, path):
+    '''Locks `spill_file` without blocking, and returns whether it's
+    locked and still the file at `path`: another process might have
+    replayed and removed it right before it was locked.
+    '''
+    try:
+        fcntl.flock(spill_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as error:
+        if error.errno in _LOCKED_ERRNOS:
+            return False
+        raise
+    try:
+        stat = os.stat(path)
+    except OSError as error:
+        if error.errno == errno.ENOENT:
+            return False
+        raise
+    opened = os.fstat(spill_file.fileno())
+    return (stat.st_dev, stat.st_ino) == (opened.st_dev, opened.st_ino)
+
+class _SpillFile(object):
+    '''An append-only file of events owned by one process. The file is
+    locked as long as the process is alive so that other processes only
+    replay spill files of processes that exited.
+
+    Other processes may lock a new file before its owner does, while
+    they look for abandoned files to replay, so the file gets a new name
+    whenever it can't be locked as is.
+    '''
+    MAX_OPEN_ATTEMPTS = 10
+
+    def __init__(self, spill_dir):
+        super(_SpillFile, self).__init__()
+        self.spill_dir = spill_dir
+        self.path = None
+        self._file = None
+
+    def _open(self):
+        for _ in xrange(self.MAX_OPEN_ATTEMPTS):
+            path = os.path.join(self.spill_dir, SPILL_FILE_PATTERN.format('{}-{}'.format(os.getpid(), uuid4().hex)))
+            spill_file = open(path, 'a')
+            try:
+                if _lock_if_current(spill_file, path):
+                    self.path, self._file = path, spill_file
+                    return
+            except:
+                spill_file.close()
+                raise
+            spill_file.close()
+        raise IOError('Could not lock a new spill file in {}'.format(self.spill_dir))
+
+    def append(self, docs):
+        if self._file is None:
+            self._open()
+        self._file.write(''.join(json.dumps(doc, cls=TimeEncoder) + '\n' for doc in docs))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+def _read_abandoned_spill_file(path):
+    '''Returns the events in the spill file at `path` and the file, which
+    stays locked until it's closed. Returns `None` if the file belongs
+    to a live process or was already replayed by another process.
+    '''
+    try:
+        spill_file = open(path, 'r+')
+    except IOError as error:
+        if error.errno == errno.ENOENT:
+            return None
+        raise
+    try:
+        is_locked = _lock_if_current(spill_file, path)
+    except:
+        spill_file.close()
+        raise
+    if not is_locked:
+        spill_file.close()
+        return None
+    docs = []
+    for line in spill_file:
+        try:
+            docs.append(json.loads(line, object_hook=decode_time))
+        except ValueError:
+            # The last line might be partial if the process died while
+            # writing it
+            logger.warning('Skipping a corrupt line in {}'.format(path))
+    return docs, spill_file
+
+def _remove_spill_file(path):
+    try:
+        os.unlink(path)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+
+#----------------------------------------------------------------#
+# Writer                                                         #
+#----------------------------------------------------------------#
+
+class EventWriter(object):
+    '''Writes events in the background so that actions don't wait for
+    them.
+
+    Events are buffered in memory and inserted in bulk by a background
+    greenlet, either `flush_interval` seconds after the last insert or
+    as soon as `batch_size` events are buffered. Events get their ids
+    when they're created and are inserted with `conflict='replace'`, so
+    writing the same event twice is harmless.
+
+    When an insert fails or takes longer than `insert_timeout` seconds
+    the events are appended to a local spill file instead, and so are
+    events still buffered when the process exits. Spill files of
+    processes that exited are inserted again when a process starts.
+    '''
+    def __init__(self, name, table_name):
+        super(EventWriter, self).__init__()
+        self.table_name = table_name
+        self.app = None
+        self._buffer = []
+        self._flush_now = GeventEvent()
+        self._greenlet = None
+        self._spill_file = None
+        self._buffered = metrics.counter(name + '.buffered')
+        self._written = metrics.counter(name + '.written')
+        self._spilled = metrics.counter(name + '.spilled')
+        self._replayed = metrics.counter(name + '.replayed')
+        self._insert_latency = metrics.timer(name + '.insert_latency')
+        metrics.gauge(name + '.buffer_size', lambda: len(self._buffer))
+
+    def configure(self, app, batch_size, flush_interval, insert_timeout, spill_dir):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.insert_timeout = insert_timeout
+        self.spill_dir = spill_dir
+
+    @property
+    def enabled(self):
+        return self.app is not None
+
+    def write(self, doc):
+        '''Buffers the event `doc`, which must already have an id. Never
+        fails the caller.
+        '''
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._run)
+            atexit.register(self._spill_buffer)
+        self._buffer.append(doc)
+        self._buffered.inc()
+        if len(self._buffer) >= self.batch_size:
+            self._flush_now.set()
+
+    def _run(self):
+        while True:
+            self._flush_now.wait(timeout=self.flush_interval)
+            self._flush_now.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Could not flush events')
+
+    def _insert(self, docs):
+        with gevent.Timeout(self.insert_timeout):
+            with self.app.app_context():
+                with self._insert_latency.time():
+                    result = run_query(r.table(self.table_name).insert(docs, conflict='replace'))
+        if result['inserted'] + result['replaced'] + result['unchanged'] != len(docs):
+            raise ValueError('Expected {} insertions, instead: {!r}'.format(len(docs), result))
+
+    def flush(self):
+        '''Inserts all buffered events, or spills them if that fails.'''
+        while self._buffer:
+            docs, self._buffer = self._buffer[:self.batch_size], self._buffer[self.batch_size:]
+            try:
+                self._insert(docs)
+            except (Exception, gevent.Timeout):
+                logger.exception('Could not insert {} events, spilling them'.format(len(docs)))
+                self._spill(docs)
+            else:
+                self._written.inc(len(docs))
+
+    #----------------------------------------------------------------#
+    # Spilling                                                       #
+    #----------------------------------------------------------------#
+
+    def _spill(self, docs):
+        try:
+            if self._spill_file is None:
+                if not os.path.isdir(self.spill_dir):
+                    os.makedirs(self.spill_dir)
+                self._spill_file = _SpillFile(self.spill_dir)
+            self._spill_file.append(docs)
+            self._spilled.inc(len(docs))
+        except (IOError, OSError):
+            logger.exception('Could not spill events, dropping them: {!r}'.format(docs))
+
+    def _spill_buffer(self):
+        if self._buffer:
+            docs, self._buffer = self._buffer, []
+            self._spill(docs)
+
+    def replay(self):
+        '''Inserts the events of spill files left by processes that exited.
+        Files are removed once all their events were inserted.
+        '''
+        for path in sorted(glob(os.path.join(self.spill_dir, SPILL_FILE_PATTERN.format('*')))):
+            try:
+                abandoned = _read_abandoned_spill_file(path)
+            except (IOError, OSError):
+                logger.exception('Could not read spilled events from {}'.format(path))
+                continue
+            if abandoned is None:
+                continue
+            docs, spill_file = abandoned
+            logger.info('Replaying {} spilled events from {}'.format(len(docs), path))
+            try:
+                for offset in xrange(0, len(docs), self.batch_size):
+                    self._insert(docs[offset:offset + self.batch_size])
+                _remove_spill_file(path)
+            except (Exception, gevent.Timeout):
+                logger.exception('Could not replay spilled events from {}'.format(path))
+                return
+            finally:
+                spill_file.close()
+            self._replayed.inc(len(docs))
+
+event_writer = EventWriter('event_writer', table_name='event')
+
+def init_event_writer(app):
+    event_writer.configure(
+        app            = app,
+        batch_size     = app.config['EVENT_WRITER_BATCH_SIZE'],
+        flush_interval = app.config['EVENT_WRITER_FLUSH_INTERVAL'],
+        insert_timeout = app.config['EVENT_WRITER_INSERT_TIMEOUT'],
+        spill_dir      = app.config['EVENT_WRITER_SPILL_DIR'],
+    )
+    gevent.spawn(event_writer.replay)
@@ -1,18 +1,52 @@
 from .type_class import TypeClass
+from .type_class import OBJECT_ACTION
+from .type_class import TYPE_ACTION
+from .type_class import get_object_action
+from .type_class import get_type_action
 
 class TypeClassesRegistry(object):
     def __init__(self):
         super(TypeClassesRegistry, self).__init__()
         self._type_classes = {}
+        # (type_key, kind, action_name, method) -> bound action
+        self._actions = {}
+        # (type_key, kind, action_name) -> set of supported methods
+        self._action_methods = {}
 
     def register_type(self, type_class):
         if not isinstance(type_class, TypeClass):
             raise TypeError('You can only register subclasses of TypeClass')
-        self._type_classes[type_class.type_key()] = type_class
+        type_key = type_class.type_key()
+        self._type_classes[type_key] = type_class
+        self._register_actions(type_key, type_class)
+
+    def _register_actions(self, type_key, type_class):
+        for attr in dir(type_class):
+            action = getattr(type_class, attr)
+            for kind, get_action in ((OBJECT_ACTION, get_object_action), (TYPE_ACTION, get_type_action)):
+                action_info = get_action(action)
+                if action_info is None:
+                    continue
+                self._actions[(type_key, kind, action_info['name'], action_info['method'])] = action
+                self._action_methods.setdefault((type_key, kind, action_info['name']), set()).add(action_info['method'])
+
+    def find_action(self, type_key, kind, action_name, method):
+        '''Returns the action of the type class `type_key` for invoking
+        `action_name` with the HTTP `method`. `kind` is `OBJECT_ACTION` or
+        `TYPE_ACTION`. Returns `None` if there's no such action.
+        '''
+        return self._actions.get((type_key, kind, action_name, method), None)
+
+    def action_methods(self, type_key, kind, action_name):
+        '''Returns the HTTP methods that `action_name` supports.'''
+        return self._action_methods.get((type_key, kind, action_name), frozenset())
 
     def __iter__(self):
         return self._type_classes.itervalues()
 
+    def __contains__(self, type_key):
+        return type_key in self._type_classes
+
     def __getitem__(self, item):
         if item in self._type_classes:
             return self._type_classes[item]
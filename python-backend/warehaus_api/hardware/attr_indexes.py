@@ -0,0 +1,125 @@
+import re
+import time
+import binascii
+import rethinkdb as r
+from logging import getLogger
+from ..metrics import metrics
+from ..db.session import run_query
+from .models import Object
+from .models import NO_TYPE
+
+logger = getLogger(__name__)
+
+#----------------------------------------------------------------#
+# Index names                                                    #
+#----------------------------------------------------------------#
+
+# Attribute slugs are chosen by users, so slugs that can't be used in
+# index names as is are hex-encoded under another prefix.
+SAFE_SLUG_RE = re.compile(r'^[A-Za-z0-9_]+$')
+
+def attr_index_name(slug):
+    if SAFE_SLUG_RE.match(slug):
+        return 'attr_' + slug
+    return 'attrx_' + binascii.hexlify(slug.encode('utf-8'))
+
+def _attr_index_function(slug):
+    # Objects without a value for the attribute are left out of the index
+    return lambda doc: [doc['type_id'], doc['attrs'][slug]]
+
+def is_indexed_attr(attr):
+    return attr.get('indexed', False) is True
+
+def indexed_attr_slugs(typeobj):
+    if 'attrs' not in typeobj:
+        return set()
+    return set(attr['slug'] for attr in typeobj.attrs if is_indexed_attr(attr))
+
+#----------------------------------------------------------------#
+# Indexes                                                        #
+#----------------------------------------------------------------#
+
+class AttrIndexes(object):
+    '''Maintains the indexes of user attributes defined with `indexed`.
+
+    Every indexed attribute slug has a single compound index of
+    `[type_id, attrs.<slug>]` on the object table, shared by all type
+    objects that index an attribute with that slug. Indexes are built by
+    RethinkDB in the background after they're created, and can't be
+    queried until they're ready, so `is_ready` polls their status at most
+    every `status_interval` seconds. Ready indexes are also checked again
+    at that interval, in case they were dropped and created again by
+    another process.
+    '''
+    def __init__(self, name, status_interval):
+        super(AttrIndexes, self).__init__()
+        self.status_interval = status_interval
+        self._status = {} # index name -> (is ready, checked at)
+        self._creates = metrics.counter(name + '.creates')
+        self._drops = metrics.counter(name + '.drops')
+        self._status_checks = metrics.counter(name + '.status_checks')
+
+    def configure(self, status_interval):
+        self.status_interval = status_interval
+
+    def _table(self):
+        return Object.query.table()
+
+    def create(self, slug):
+        '''Creates the index of `slug` unless it already exists.'''
+        name = attr_index_name(slug)
+        table = self._table()
+        try:
+            result = run_query(table.index_list().contains(name).branch(
+                None, table.index_create(name, _attr_index_function(slug))))
+        except r.ReqlOpFailedError:
+            # Another process created it meanwhile
+            return
+        if result is not None:
+            logger.info('Building the index {} of attribute {!r}'.format(name, slug))
+            self._creates.inc()
+        self._status.pop(name, None)
+
+    def release(self, slug):
+        '''Drops the index of `slug` unless a type object still defines an
+        indexed attribute with that slug.
+        '''
+        name = attr_index_name(slug)
+        self._status.pop(name, None)
+        table = self._table()
+        still_indexed = table.get_all(NO_TYPE, index='type_id').filter(
+            lambda doc: doc['attrs'].default([]).contains(
+                lambda attr: attr['slug'].eq(slug) & attr['indexed'].default(False).eq(True)))
+        try:
+            result = run_query((still_indexed.is_empty() & table.index_list().contains(name)).branch(
+                table.index_drop(name), None))
+        except r.ReqlOpFailedError:
+            # Another process dropped it meanwhile
+            return
+        if result is not None:
+            logger.info('Dropped the index {} of attribute {!r}'.format(name, slug))
+            self._drops.inc()
+
+    def status(self, slug):
+        '''Returns the RethinkDB status of the index of `slug`, or `None` if
+        there's no such index.
+        '''
+        name = attr_index_name(slug)
+        table = self._table()
+        self._status_checks.inc()
+        status = run_query(table.index_list().contains(name).branch(table.index_status(name).nth(0).without('function'), None))
+        self._status[name] = ((status is not None) and status['ready'], time.time())
+        return status
+
+    def is_ready(self, slug):
+        '''Returns whether the index of `slug` can be queried.'''
+        is_ready, checked_at = self._status.get(attr_index_name(slug), (False, None))
+        if (checked_at is not None) and (time.time() - checked_at < self.status_interval):
+            return is_ready
+        status = self.status(slug)
+        return (status is not None) and status['ready']
+
+attr_indexes = AttrIndexes('attr_indexes', status_interval=10)
+
+def init_attr_indexes(app):
+    attr_indexes.configure(status_interval=app.config['ATTR_INDEX_STATUS_INTERVAL'])
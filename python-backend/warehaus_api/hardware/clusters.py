@@ -2,6 +2,7 @@ import httplib
 from slugify import slugify
 from flask import abort as flask_abort
 from flask import request
+from bunch import Bunch
 from flask_restful.reqparse import RequestParser
 from flask_jwt import current_identity
 from ..auth.roles import require_user
@@ -11,13 +12,16 @@ from ..db.times import now
 from ..events.models import create_event
 from .models import Object
 from .models import create_object
-from .models import get_user_attributes
+from .models import get_user_attributes_of_type
+from .models import get_objects_by_ids
 from .models import ensure_unique_slug
 from .type_class import TypeClass
 from .type_class import type_action
 from .type_class import object_action
 from .labs import get_lab_from_type_object
-from .servers import server_config
+from .servers import server_configs
+from .servers import server_config_sources
+from .config_store import config_store
 
 class Cluster(TypeClass):
     TYPE_VENDOR = 'builtin'
@@ -53,7 +57,7 @@ class Cluster(TypeClass):
             interested_ids = [cluster.id, lab.id],
             title = 'Created **{}** {}'.format(cluster.display_name, typeobj.display_name['singular']),
         )
-        return cluster.as_dict(), httplib.CREATED
+        return cluster, httplib.CREATED
 
     @object_action('DELETE', '')
     def delete_cluster(self, cluster):
@@ -144,26 +148,80 @@ class Cluster(TypeClass):
     @object_action('GET', 'config.json')
     def cluster_config(self, cluster):
         require_user()
-        lab = cluster.get_parent_object()
-        servers = tuple(server_config(server) for server in Object.query.filter(
-            dict(parent_id=lab.id, cluster_id=cluster.id)))
+        return config_store.response(cluster, _build_cluster_config)
+
+    def object_configs(self, clusters):
+        return cluster_configs(clusters)
+
+def _lab_config(lab, lab_typeobj):
+    return dict(
+        id           = lab['id'],
+        slug         = lab['slug'],
+        display_name = lab['display_name'],
+        user_attrs   = get_user_attributes_of_type(lab, lab_typeobj),
+    )
+
+def _build_cluster_config(cluster):
+    sources = cluster_config_sources([cluster])
+    return cluster_configs([cluster], sources)[0], sources.objects
+
+def cluster_config_sources(clusters):
+    '''Looks up what the configs of `clusters` are built from: their labs,
+    their servers (see `server_config_sources`), the owners of the
+    clusters and the type objects of all of these. Everything is looked
+    up in a fixed number of queries, no matter how many clusters and
+    servers there are. `objects` of the result holds all objects the
+    configs depend on (see `conditional_response`).
+    '''
+    clusters = list(clusters)
+    labs = get_objects_by_ids(cluster.parent_id for cluster in clusters)
+    typeobjs = get_objects_by_ids([cluster.type_id for cluster in clusters] + [lab.type_id for lab in labs.itervalues()])
+    cluster_servers = {cluster.id: [] for cluster in clusters}
+    if clusters:
+        cluster_labs = {cluster.id: cluster.parent_id for cluster in clusters}
+        for server in Object.query.read_only.get_all(*cluster_servers.keys(), index='cluster_id'):
+            if server.parent_id == cluster_labs[server.cluster_id]:
+                cluster_servers[server.cluster_id].append(server)
+    servers = [server for cluster in clusters for server in cluster_servers[cluster.id]]
+    server_sources = server_config_sources(servers)
+    owner_ids = set(ownership['owner_id'] for cluster in clusters
+                    for ownership in (cluster['ownerships'] if 'ownerships' in cluster else ()))
+    owners = {user.id: user for user in User.query.get_all(*owner_ids)} if owner_ids else {}
+    return Bunch(
+        labs            = labs,
+        typeobjs        = typeobjs,
+        cluster_servers = cluster_servers,
+        servers         = servers,
+        server_sources  = server_sources,
+        owners          = owners,
+        objects         = clusters + labs.values() + typeobjs.values() + server_sources.objects + owners.values(),
+    )
+
+def cluster_configs(clusters, sources=None):
+    '''Returns the configs of all `clusters`, built from `sources` as
+    returned by `cluster_config_sources`, which are looked up when not
+    given.
+    '''
+    clusters = list(clusters)
+    if sources is None:
+        sources = cluster_config_sources(clusters)
+    typeobjs, cluster_servers, owners = sources.typeobjs, sources.cluster_servers, sources.owners
+    labs = {lab_id: _lab_config(lab, typeobjs.get(lab.type_id, None)) for lab_id, lab in sources.labs.iteritems()}
+    server_configs_by_id = {config['id']: config for config in server_configs(sources.servers, sources.server_sources)}
+    configs = []
+    for cluster in clusters:
         ownerships = tuple(dict(owner_id    = ownership['owner_id'],
                                 obtained_at = ownership['obtained_at'],
-                                username    = User.query.get(ownership['owner_id'])['username'])
-                           for ownership in cluster['ownerships']) if 'ownerships' in cluster else ()
-        config = dict(
+                                username    = owners[ownership['owner_id']]['username'])
+                           for ownership in (cluster['ownerships'] if 'ownerships' in cluster else ()))
+        configs.append(dict(
             id           = cluster['id'],
             slug         = cluster['slug'],
             display_name = cluster['display_name'],
-            user_attrs   = get_user_attributes(cluster),
-            servers      = servers,
+            user_attrs   = get_user_attributes_of_type(cluster, typeobjs.get(cluster.type_id, None)),
+            servers      = [server_configs_by_id[server.id] for server in cluster_servers[cluster.id]],
             status       = cluster['status'] if 'status' in cluster else None,
             ownerships   = ownerships,
-            lab = dict(
-                id           = lab['id'],
-                slug         = lab['slug'],
-                display_name = lab['display_name'],
-                user_attrs   = get_user_attributes(lab),
-            ),
-        )
-        return config
+            lab          = labs[cluster.parent_id],
+        ))
+    return configs
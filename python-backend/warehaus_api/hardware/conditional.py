@@ -0,0 +1,57 @@
+import httplib
+from hashlib import sha1
+from flask import request
+from flask import Response
+from werkzeug.http import http_date
+from ..db.times import epoch_time
+
+# Part of every ETag. Bump it whenever the representation of objects or
+# configs changes, so clients don't keep bodies in the old format.
+REPRESENTATION_VERSION = 1
+
+def object_version(obj, unversioned_fields=()):
+    '''Returns a string that changes whenever `obj` is modified: its id and
+    `modified_at`, and the values of `unversioned_fields`, which can
+    change without touching `modified_at` (see `Model.UNVERSIONED_FIELDS`).
+    '''
+    parts = [obj['id'], repr(epoch_time(obj['modified_at'])) if 'modified_at' in obj else '']
+    parts.extend(repr(obj[field] if field in obj else None) for field in sorted(unversioned_fields))
+    return '\0'.join(parts)
+
+def versions_etag(versions):
+    digest = sha1(str(REPRESENTATION_VERSION))
+    for version in sorted(versions):
+        digest.update('\n' + version)
+    return digest.hexdigest()
+
+def validators(objs, unversioned_fields=()):
+    '''Returns a tuple of `(etag, last_modified)` for a body built only
+    from `objs`: an ETag computed from the versions of `objs` (see
+    `object_version`) and the latest `modified_at` of them in seconds
+    since the epoch, or `None` if they have none.
+    '''
+    objs = list(objs)
+    etag = versions_etag(object_version(obj, unversioned_fields) for obj in objs)
+    modified_times = [epoch_time(obj['modified_at']) for obj in objs if 'modified_at' in obj]
+    return etag, (max(modified_times) if modified_times else None)
+
+def etag_response(etag, last_modified, build):
+    '''Returns the response of a GET action whose body `build()` returns,
+    with a strong ETag and `Last-Modified` (see `validators`).
+
+    When the request has a matching `If-None-Match` the response is
+    `NOT_MODIFIED` and `build` isn't called. `If-Modified-Since` is not
+    used since `Last-Modified` doesn't change when objects are removed
+    from the ones the body is built from, while the ETag does.
+    '''
+    headers = {'ETag': '"{}"'.format(etag)}
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=httplib.NOT_MODIFIED, headers=headers)
+    return build(), httplib.OK, headers
+
+def conditional_response(objs, build, unversioned_fields=()):
+    '''Like `etag_response` for a body built only from `objs`.'''
+    etag, last_modified = validators(objs, unversioned_fields)
+    return etag_response(etag, last_modified, build)
@@ -0,0 +1,187 @@
+import rethinkdb as r
+from logging import getLogger
+from ..metrics import metrics
+from ..db.times import now
+from ..db.times import epoch_time
+from ..db.session import new_id
+from ..db.session import run_query
+from ..db.session import current_session
+from ..db.changes import ChangesWatcher
+from ..auth.models import User
+from .conditional import REPRESENTATION_VERSION
+from .conditional import validators
+from .conditional import etag_response
+
+logger = getLogger(__name__)
+
+class ConfigStore(object):
+    '''Keeps the built config of every server and cluster in a table, so
+    `config.json` is a single primary-key read.
+
+    Every stored config lists the ids of the objects it was built from
+    in `depends_on`. Writes of objects invalidate the configs that
+    depend on them (see `invalidate`), and configs are rebuilt the next
+    time they're read. Invalidated configs stay in the table without
+    their `config`, with a new `invalidation` token. A rebuilt config is
+    only stored if the token didn't change while it was built and all
+    objects it was built from are still at the version they were read in
+    (see `_unchanged`), so a config built from objects that changed
+    meanwhile is never stored. The new `depends_on` is written before the
+    versions are checked, so objects that change after the check always
+    find the config through the index and change its token.
+
+    Documents:
+
+        {id: obj_id, config: {...} or null, invalidation: token,
+         depends_on: [obj_id, ...], etag: ..., last_modified: ...,
+         built_at: time, representation_version: ...}
+    '''
+    def __init__(self, name, table_name):
+        super(ConfigStore, self).__init__()
+        self.table_name = table_name
+        self.app = None
+        self._hits = metrics.counter(name + '.hits')
+        self._builds = metrics.counter(name + '.builds')
+        self._lost_builds = metrics.counter(name + '.lost_builds')
+        self._invalidations = metrics.counter(name + '.invalidations')
+
+    def configure(self, app):
+        self.app = app
+
+    def _table(self):
+        return r.table(self.table_name)
+
+    #----------------------------------------------------------------#
+    # Invalidation                                                   #
+    #----------------------------------------------------------------#
+
+    def invalidate(self, obj_ids, deleted_ids=()):
+        '''Invalidates the configs of `obj_ids` and the configs that
+        depend on them, and removes the configs of `deleted_ids`. With an
+        active session this is done once its writes are flushed.
+        '''
+        session = current_session()
+        if session is None:
+            self._invalidate(set(obj_ids))
+            self._delete(set(deleted_ids))
+            return
+        session.after_flush(self._invalidate, obj_ids, self.table_name)
+        if deleted_ids:
+            session.after_flush(self._delete, deleted_ids, self.table_name)
+
+    def _invalidate(self, obj_ids):
+        obj_ids = list(obj_ids)
+        if not obj_ids:
+            return
+        dependents = self._table().get_all(*obj_ids, index='depends_on')['id'].coerce_to('array')
+        # Configs that are being built get a new token as well, so their
+        # builds are not stored
+        result = run_query(self._table().get_all(r.args(dependents.set_union(obj_ids)))
+                           .update(dict(config=None, invalidation=new_id())))
+        self._invalidations.inc(result['replaced'])
+
+    def _delete(self, obj_ids):
+        if obj_ids:
+            run_query(self._table().get_all(*obj_ids).delete())
+
+    #----------------------------------------------------------------#
+    # Reads                                                          #
+    #----------------------------------------------------------------#
+
+    def _unchanged(self, objs):
+        '''Returns a ReQL expression of whether all `objs` still exist with
+        the `modified_at` they were read with. Times are compared in
+        milliseconds, which is how RethinkDB keeps them.
+        '''
+        versions_by_table = {}
+        for obj in objs:
+            modified_at = int(round(epoch_time(obj['modified_at']) * 1000)) if 'modified_at' in obj else None
+            versions_by_table.setdefault(obj._table_name, {})[obj['id']] = modified_at
+        checks = []
+        for table_name, versions in versions_by_table.iteritems():
+            current = r.table(table_name).get_all(r.args(versions.keys())).map(
+                lambda doc: [doc['id'], doc['modified_at'].to_epoch_time().mul(1000).round().default(None)])
+            checks.append(current.coerce_to('object').eq(versions))
+        return r.and_(*checks)
+
+    def _is_valid(self, doc):
+        return ((doc is not None) and (doc.get('config', None) is not None) and
+                (doc.get('representation_version', None) == REPRESENTATION_VERSION))
+
+    def _build(self, obj, build, doc):
+        if doc is None:
+            invalidation = new_id()
+            result = run_query(self._table().insert(dict(id=obj.id, config=None, invalidation=invalidation)))
+            if result['inserted'] != 1:
+                # Another request is building the config as well
+                invalidation = run_query(self._table().get(obj.id))['invalidation']
+        else:
+            invalidation = doc['invalidation']
+        config, objs = build(obj)
+        objs = list(objs)
+        etag, last_modified = validators(objs)
+        built = dict(
+            id                     = obj.id,
+            config                 = config,
+            invalidation           = invalidation,
+            depends_on             = sorted(set(each['id'] for each in objs)),
+            etag                   = etag,
+            last_modified          = last_modified,
+            built_at               = now(),
+            representation_version = REPRESENTATION_VERSION,
+        )
+        self._builds.inc()
+        # Objects that change after the version check find the config
+        # through `depends_on` and change its token, so it has to be
+        # written first. Objects that changed before it fail the check.
+        run_query(self._table().get(obj.id).update(
+            lambda old: r.branch(old['invalidation'].eq(invalidation), dict(depends_on=built['depends_on']), {})))
+        if not run_query(self._unchanged(objs)):
+            self._lost_builds.inc()
+            return built
+        result = run_query(self._table().get(obj.id).replace(
+            lambda old: r.branch(old.ne(None) & old['invalidation'].eq(invalidation), built, old)))
+        if result['replaced'] != 1:
+            self._lost_builds.inc()
+        return built
+
+    def response(self, obj, build):
+        '''Returns the response of the `config.json` action of `obj` (see
+        `etag_response`). `build(obj)` is called when there's no valid
+        stored config and returns a tuple of `(config, objs)` where `objs`
+        are all objects the config was built from.
+        '''
+        doc = run_query(self._table().get(obj.id))
+        if self._is_valid(doc):
+            self._hits.inc()
+        else:
+            doc = self._build(obj, build, doc)
+        return etag_response(doc['etag'], doc['last_modified'], lambda: doc['config'])
+
+config_store = ConfigStore('config_store', table_name='object_config')
+
+#----------------------------------------------------------------#
+# Users                                                          #
+#----------------------------------------------------------------#
+
+# Users are modified by the Node backend, so their changes come from a
+# changes feed rather than from `Object.save`. Configs only hold their
+# usernames.
+
+def _on_user_change(old_val, new_val):
+    if (old_val is not None) and ((new_val is None) or (new_val.get('username') != old_val.get('username'))):
+        try:
+            with config_store.app.app_context():
+                config_store.invalidate([old_val['id']])
+        except Exception:
+            logger.exception('Could not invalidate configs of user {}'.format(old_val['id']))
+
+_user_watcher = ChangesWatcher(
+    name       = 'config_store.user',
+    make_query = lambda: User.query.table(),
+    on_change  = _on_user_change,
+)
+
+def init_config_store(app):
+    config_store.configure(app)
+    _user_watcher.start(app)
@@ -12,6 +12,8 @@ from .labs import get_lab_from_type_object
 from .models import create_object
 from .models import ensure_unique_slug
 from .models import get_user_attributes
+from .models import get_user_attributes_of_type
+from .models import get_objects_by_ids
 
 class GenericObject(TypeClass):
     TYPE_VENDOR = 'builtin'
@@ -46,7 +48,7 @@ class GenericObject(TypeClass):
             interested_ids = [generic_object.id, lab.id],
             title = 'Created **{}** {}'.format(generic_object.display_name, typeobj.display_name['singular']),
         )
-        return generic_object.as_dict(), httplib.CREATED
+        return generic_object, httplib.CREATED
 
     @object_action('DELETE', '')
     def delete_generic_object(self, generic_object):
@@ -72,3 +74,14 @@ class GenericObject(TypeClass):
             display_name = generic_object['display_name'],
             user_attrs   = get_user_attributes(generic_object),
         )
+
+    def object_configs(self, generic_objects):
+        generic_objects = list(generic_objects)
+        typeobjs = get_objects_by_ids(generic_object.type_id for generic_object in generic_objects)
+        return [dict(
+            id           = generic_object['id'],
+            type_id      = generic_object['type_id'],
+            slug         = generic_object['slug'],
+            display_name = generic_object['display_name'],
+            user_attrs   = get_user_attributes_of_type(generic_object, typeobjs.get(generic_object.type_id, None)),
+        ) for generic_object in generic_objects]
@@ -0,0 +1,212 @@
+import json
+import time
+import gevent
+from hashlib import sha1
+from logging import getLogger
+from gevent.queue import Queue
+from gevent.queue import Empty
+from ..metrics import metrics
+
+logger = getLogger(__name__)
+
+# The latest heartbeat protocol, see `Server.heartbeat_call`
+HEARTBEAT_PROTOCOL = 2
+
+def agent_info_digest(section):
+    '''Returns a stable digest of one section of the `agent_info` sent
+    by the heartbeat code.
+    '''
+    return sha1(json.dumps(section, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+def heartbeat_protocol(heartbeat):
+    return heartbeat.get('protocol', 1)
+
+def merge_heartbeats(older, newer):
+    '''Returns a heartbeat equivalent to applying `older` and then `newer`.
+
+    Heartbeats of the first protocol always carry the full info, so the
+    newer one is enough. With the second protocol the newer heartbeat
+    might not include sections that were only sent with the older one,
+    so those are carried over as long as they match the digests of the
+    newer heartbeat.
+    '''
+    if heartbeat_protocol(newer) < HEARTBEAT_PROTOCOL:
+        return newer
+    info = {section: value for section, value in older.get('info', {}).iteritems()
+            if (section in newer['digests']) and (agent_info_digest(value) == newer['digests'][section])}
+    info.update(newer.get('info', {}))
+    return dict(newer, info=info)
+
+class HeartbeatQueue(object):
+    '''Coalescing write-behind queue for heartbeats.
+
+    While a worker has fewer than `inline_limit` heartbeats in flight,
+    heartbeats are applied right away and agents get an authoritative
+    reply. Once more heartbeats arrive (for example, when all agents
+    reconnect after a network blip) heartbeats of servers that are known
+    to exist are queued instead and acknowledged immediately. A pool of
+    `num_workers` greenlets applies queued heartbeats in batches of up to
+    `batch_size`, and only the newest heartbeat of every server is kept
+    while it waits in the queue.
+
+    Heartbeats of new servers are never queued, so a server is always
+    created by the time its first heartbeat is acknowledged.
+
+    Queued heartbeats live in the memory of the worker process, so they
+    are lost if the worker exits before applying them. The agent sends
+    another heartbeat on its next interval anyway.
+    '''
+    def __init__(self, name):
+        super(HeartbeatQueue, self).__init__()
+        self.app = None
+        self.num_workers = 0
+        self.inline_limit = 0
+        self.batch_size = 1
+        self._keys = Queue()
+        self._pending = {}
+        self._known = set()
+        self._applying = set()
+        self._deferred = set()
+        self._inflight = 0
+        self._workers = []
+        self._enqueued = metrics.counter(name + '.enqueued')
+        self._coalesced = metrics.counter(name + '.coalesced')
+        self._applied = metrics.counter(name + '.applied')
+        self._failed = metrics.counter(name + '.failed')
+        self._inline = metrics.counter(name + '.inline')
+        self._apply_latency = metrics.timer(name + '.apply_latency')
+        self._queue_latency = metrics.timer(name + '.queue_latency')
+        metrics.gauge(name + '.depth', lambda: len(self._pending))
+        metrics.gauge(name + '.inflight', lambda: self._inflight)
+
+    def configure(self, app, num_workers, inline_limit, batch_size):
+        self.app = app
+        self.num_workers = num_workers
+        self.inline_limit = inline_limit
+        self.batch_size = max(batch_size, 1)
+
+    @property
+    def enabled(self):
+        return (self.app is not None) and (self.num_workers > 0)
+
+    #----------------------------------------------------------------#
+    # Request side                                                   #
+    #----------------------------------------------------------------#
+
+    def should_queue(self, key):
+        '''Returns whether the heartbeat of the server identified by `key`
+        should be queued rather than applied inline. Once a heartbeat of
+        a server is queued, its next heartbeats are queued as well until
+        the queued one is applied, so they are applied in order.
+        '''
+        if not self.enabled:
+            return False
+        if (key in self._pending) or (key in self._applying):
+            return True
+        return (key in self._known) and (self._inflight >= self.inline_limit)
+
+    def apply_inline(self, key, apply_func):
+        '''Applies a heartbeat right away. `apply_func` is called with no
+        arguments and returns a tuple of `(reply, is_synced)`, where
+        `is_synced` says whether the server has everything the agent
+        thinks it has.
+        '''
+        self._inflight += 1
+        try:
+            reply, is_synced = apply_func()
+        finally:
+            self._inflight -= 1
+        self._inline.inc()
+        self._update_known(key, is_synced)
+        return reply
+
+    def enqueue(self, key, heartbeat, apply_func):
+        '''Queues `heartbeat` to be applied later by calling `apply_func`
+        with the heartbeat (see `apply_inline` for the return value).
+        '''
+        self._start_workers()
+        self._enqueued.inc()
+        if key in self._pending:
+            self._coalesced.inc()
+            _, older, queued_at = self._pending[key]
+            self._pending[key] = (apply_func, merge_heartbeats(older, heartbeat), queued_at)
+        else:
+            self._pending[key] = (apply_func, heartbeat, time.time())
+            self._keys.put(key)
+
+    def _update_known(self, key, is_synced):
+        if is_synced:
+            self._known.add(key)
+        else:
+            # Make sure the next heartbeat is applied inline so the agent
+            # gets an authoritative reply and resyncs
+            self._known.discard(key)
+
+    #----------------------------------------------------------------#
+    # Workers                                                        #
+    #----------------------------------------------------------------#
+
+    def _start_workers(self):
+        # Workers are started lazily so they're always spawned in the
+        # process that serves requests (and not before gunicorn forks).
+        while len(self._workers) < self.num_workers:
+            self._workers.append(gevent.spawn(self._work))
+
+    def _next_batch(self):
+        '''Returns up to `batch_size` queued heartbeats. Heartbeats of
+        servers whose previous heartbeat is still being applied by another
+        worker are left pending, and are queued again once it's done (see
+        `_done`), so a server never has two heartbeats applied at once.
+        '''
+        batch = []
+        while not batch:
+            keys = [self._keys.get()]
+            while len(keys) < self.batch_size:
+                try:
+                    keys.append(self._keys.get_nowait())
+                except Empty:
+                    break
+            for key in keys:
+                if key in self._applying:
+                    self._deferred.add(key)
+                    continue
+                self._applying.add(key)
+                batch.append((key,) + self._pending.pop(key))
+        return batch
+
+    def _done(self, key):
+        self._applying.discard(key)
+        if key in self._deferred:
+            self._deferred.discard(key)
+            self._keys.put(key)
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            with self.app.app_context():
+                for key, apply_func, heartbeat, queued_at in batch:
+                    self._queue_latency.record(time.time() - queued_at)
+                    self._inflight += 1
+                    try:
+                        with self._apply_latency.time():
+                            _, is_synced = apply_func(heartbeat)
+                    except Exception:
+                        self._failed.inc()
+                        self._known.discard(key)
+                        logger.exception('Could not apply queued heartbeat of {!r}'.format(key))
+                    else:
+                        self._applied.inc()
+                        self._update_known(key, is_synced)
+                    finally:
+                        self._inflight -= 1
+                        self._done(key)
+
+heartbeat_queue = HeartbeatQueue('heartbeat_queue')
+
+def init_heartbeat_queue(app):
+    heartbeat_queue.configure(
+        app          = app,
+        num_workers  = app.config['HEARTBEAT_QUEUE_WORKERS'],
+        inline_limit = app.config['HEARTBEAT_QUEUE_INLINE_LIMIT'],
+        batch_size   = app.config['HEARTBEAT_QUEUE_BATCH_SIZE'],
+    )
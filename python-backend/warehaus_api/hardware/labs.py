@@ -1,15 +1,50 @@
 import httplib
-from flask import abort as flask_abort
+from itertools import islice
 from flask import request
+from flask import Response
+from flask import stream_with_context
 from flask_jwt import current_identity
+from ..auth.roles import require_user
 from ..auth.roles import require_admin
+from ..serialization import iter_json_lines
 from ..events.models import create_event
 from .type_class import TypeClass
 from .type_class import object_action
+from .models import ensure_valid_slug
 from .models import ensure_unique_slug
 from .models import Object
+from .models import type_cache
+from .models import get_objects_by_ids
 from .all_type_classes import all_type_classes
 
+# Number of lab children for which configs are built together when
+# streaming `config.ndjson`
+CONFIG_CHUNK_SIZE = 200
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _object_configs(objs):
+    '''Returns the configs of `objs` (see `TypeClass.object_configs`) in
+    the order of `objs`. Objects with no config are skipped.
+    '''
+    typeobjs = get_objects_by_ids(obj.type_id for obj in objs)
+    objs_by_type_key = {}
+    for obj in objs:
+        typeobj = typeobjs.get(obj.type_id, None)
+        if (typeobj is not None) and ('type_key' in typeobj) and (typeobj.type_key in all_type_classes):
+            objs_by_type_key.setdefault(typeobj.type_key, []).append(obj)
+    configs = {}
+    for type_key, objs_of_type in objs_by_type_key.iteritems():
+        for config in all_type_classes[type_key].object_configs(objs_of_type):
+            configs[config['id']] = config
+    return [configs[obj.id] for obj in objs if obj.id in configs]
+
 class Lab(TypeClass):
     TYPE_VENDOR = 'builtin'
     TYPE_NAME = 'lab'
@@ -29,12 +64,30 @@ class Lab(TypeClass):
             slug         = slug,
             display_name = request.json['display_name'],
         )
-        return type_object.as_dict(), httplib.CREATED
+        return type_object, httplib.CREATED
+
+    @object_action('GET', 'config.ndjson')
+    def lab_config(self, lab):
+        '''Streams the config of every object in the lab, one JSON document
+        per line. The children of the lab are read with a cursor and their
+        configs are built `CONFIG_CHUNK_SIZE` objects at a time, so memory
+        use doesn't depend on the size of the lab.
+        '''
+        require_user()
+        def generate_configs():
+            for objs in _chunks(Object.query.read_only.get_all(lab.id, index='parent_id'), CONFIG_CHUNK_SIZE):
+                for config in _object_configs(objs):
+                    yield config
+        # Ask nginx not to buffer the response so chunks reach the client
+        # as soon as they're produced
+        return Response(stream_with_context(iter_json_lines(generate_configs())), status=httplib.OK, mimetype='application/x-ndjson',
+                        headers={'X-Accel-Buffering': 'no'})
 
     @object_action('PUT', 'name')
     def rename_lab(self, lab):
         require_admin()
         slug = request.json['slug']
+        ensure_valid_slug(slug)
         ensure_unique_slug(lab.get_parent_object(), slug)
         old_name = lab.display_name
         lab.display_name = request.json['display_name']
@@ -66,4 +119,10 @@ def get_lab_from_type_object(typeobj):
     was created by `Lab().create_type_object`.
     '''
     error = 'Found more than one lab for type_id={!r}'.format(typeobj.id)
+    if type_cache.ready:
+        labs = type_cache.get_root_objects_of_type(typeobj.parent_id)
+        if len(labs) == 1:
+            return Object.query.wrap(labs[0])
+    else:
+        type_cache.count_miss()
     return Object.query.get_exactly_one(typeobj.parent_id, index='type_id', error=error)
@@ -1,7 +1,12 @@
 import httplib
+import rethinkdb as r
 from logging import getLogger
 from flask import abort as flask_abort
 from .. import db
+from ..db.session import current_session
+from ..db.changes import ChangesWatcher
+from .type_cache import TypeObjectCache
+from .config_store import config_store
 
 logger = getLogger(__name__)
 
@@ -11,6 +16,9 @@ NO_TYPE = 'NO_TYPE'
 class Object(db.Model):
     _allow_additional_items = True
 
+    # Heartbeats update `last_seen` of servers every few seconds
+    UNVERSIONED_FIELDS = frozenset(['last_seen'])
+
     slug = db.Field()
     type_id = db.Field(default=NO_TYPE) # Points to Object
     parent_id = db.Field(default=TREE_ROOT) # Points to Object
@@ -39,6 +47,92 @@ class Object(db.Model):
             raise TypeError('subtype argument must be of Object instance')
         return Object.query.get_all([self.id, subtype.id], index='parent_type')
 
+    def is_cached(self):
+        return (self.type_id == NO_TYPE) or (self.parent_id == TREE_ROOT)
+
+    def _config_related_ids(self, is_added_or_removed):
+        # The configs that might depend on this object without listing it
+        # in `depends_on` yet: its own, its parent's when it's a new child
+        # and its cluster's when it's a new member. See `ConfigStore`.
+        related_ids = [self.id]
+        if is_added_or_removed:
+            related_ids.append(self.parent_id)
+        if ('cluster_id' in self) and (self.cluster_id is not None):
+            related_ids.append(self.cluster_id)
+        return related_ids
+
+    def save(self, force_insert=False):
+        self._check_writable()
+        is_new = force_insert or ('id' not in self)
+        is_modified = is_new or (bool(self._dirty_data) and not self.UNVERSIONED_FIELDS.issuperset(self._dirty_data))
+        super(Object, self).save(force_insert=force_insert)
+        if self.is_cached():
+            _after_write(_cache_saved, [self])
+        if is_modified:
+            config_store.invalidate(self._config_related_ids(is_added_or_removed=is_new))
+
+    def delete(self):
+        obj_id = self.id
+        related_ids = self._config_related_ids(is_added_or_removed=True)
+        super(Object, self).delete()
+        _after_write(_cache_deleted, [obj_id])
+        config_store.invalidate(related_ids, deleted_ids=[obj_id])
+
+#----------------------------------------------------------#
+# Type object cache                                        #
+#----------------------------------------------------------#
+
+type_cache = TypeObjectCache('type_cache', root_id=TREE_ROOT)
+
+def _is_cached_object(doc):
+    return doc['type_id'].eq(NO_TYPE) | doc['parent_id'].eq(TREE_ROOT)
+
+_type_cache_watcher = ChangesWatcher(
+    name            = 'type_cache',
+    make_query      = lambda: Object.query.table().filter(_is_cached_object),
+    on_change       = type_cache.on_change,
+    on_ready        = type_cache.on_ready,
+    on_lost         = type_cache.on_lost,
+    include_initial = True,
+)
+
+def _after_write(func, values):
+    '''Calls `func` with `values` once the writes of the active session
+    are flushed, or right away without a session, so the cache never
+    holds writes that failed.
+    '''
+    session = current_session()
+    if session is None:
+        func(set(values))
+    else:
+        session.after_flush(func, values)
+
+def _cache_saved(objs):
+    for obj in objs:
+        # Objects deleted after they were saved no longer have an id
+        if 'id' in obj._data:
+            type_cache.saved(obj._data)
+
+def _cache_deleted(obj_ids):
+    for obj_id in obj_ids:
+        type_cache.deleted(obj_id)
+
+def init_type_cache(app):
+    _type_cache_watcher.start(app)
+
+def _children_are_cached(parent):
+    '''Children of the root and of type objects are always type objects
+    or labs, so they're all in `type_cache`.
+    '''
+    return (parent is None) or (not parent.has_type())
+
+def _wrap_cached(doc):
+    return None if doc is None else Object.query.wrap(doc)
+
+#----------------------------------------------------------#
+# Object lookup                                            #
+#----------------------------------------------------------#
+
 def create_object(**kwargs):
     if 'parent_id' in kwargs:
         raise TypeError("You can't pass 'parent_id' to create_object(). Please use 'parent' argument only")
@@ -63,6 +157,22 @@ def get_object_by_id(obj_id):
         flask_abort(httplib.NOT_FOUND, 'Could not find object with id={!r}'.format(obj_id))
     return obj
 
+def get_objects_by_ids(obj_ids):
+    '''Returns a dict of the objects with any of `obj_ids` keyed by their
+    id, fetching all objects that are not cached with a single query.
+    Objects that don't exist are missing from the dict.
+    '''
+    obj_ids = set(obj_ids) - set([TREE_ROOT, NO_TYPE])
+    objs = {}
+    if type_cache.ready:
+        objs.update((obj_id, _wrap_cached(doc)) for obj_id, doc in type_cache.get_many(obj_ids).iteritems())
+    else:
+        type_cache.count_miss()
+    missing = obj_ids - set(objs)
+    if missing:
+        objs.update((obj.id, obj) for obj in Object.query.get_all(*missing))
+    return objs
+
 def get_type_object(obj):
     '''Finds and returns the type object of `obj`. If `obj` doesn't
     have a type object or the type object is not found, `None` is returned.
@@ -73,6 +183,12 @@ def get_type_object(obj):
     logger.debug('  get_type_object(obj.id={!r}, obj.type_id={!r})'.format(obj.id, obj.type_id))
     if obj.type_id == NO_TYPE:
         return None
+    if type_cache.ready:
+        doc = type_cache.get(obj.type_id)
+        if doc is not None:
+            return _wrap_cached(doc)
+    else:
+        type_cache.count_miss()
     return Object.query.get(obj.type_id)
 
 def get_object_child(parent, child_slug):
@@ -83,8 +199,97 @@ def get_object_child(parent, child_slug):
     parent_id = TREE_ROOT if parent is None else parent.id
     logger.debug('  get_object_child(parent_id={!r}, child_slug={!r})'.format(parent_id, child_slug))
     error = 'Got multiple results for slug={!r} parent_id={!r}'.format(child_slug, parent_id)
+    if _children_are_cached(parent):
+        if type_cache.ready:
+            docs = type_cache.get_children(parent_id, child_slug)
+            if len(docs) == 1:
+                return _wrap_cached(docs[0])
+        else:
+            type_cache.count_miss()
     return Object.query.get_one_or_none([child_slug, parent_id], index='slug_parent', error=error)
 
+TYPE_PATH_PART = '~'
+
+def _path_candidates_query(parent, part):
+    '''Builds a ReQL expression for the objects matching the path part
+    `part` under `parent`, which is either `None` for the tree root or
+    a ReQL expression evaluating to the parent document.
+    '''
+    if part == TYPE_PATH_PART:
+        if parent is None:
+            return r.expr([])
+        return r.branch(parent['type_id'].eq(NO_TYPE), r.expr([]),
+                        r.expr([Object.query.table().get(parent['type_id'])]).filter(lambda doc: doc.ne(None)))
+    parent_id = TREE_ROOT if parent is None else parent['id']
+    return Object.query.table().get_all([part, parent_id], index='slug_parent').coerce_to('array')
+
+def _cached_path_candidates(parent, part):
+    '''Returns the objects matching the path part `part` under `parent`
+    from `type_cache`, or `None` if the cache can't answer. Only a single
+    match is trusted, anything else is left to the database.
+    '''
+    if part == TYPE_PATH_PART and (parent is None or not parent.has_type()):
+        return []
+    if not type_cache.ready:
+        return None
+    if part == TYPE_PATH_PART:
+        doc = type_cache.get(parent.type_id)
+        return None if doc is None else [_wrap_cached(doc)]
+    if not _children_are_cached(parent):
+        return None
+    parent_id = TREE_ROOT if parent is None else parent.id
+    docs = type_cache.get_children(parent_id, part)
+    return [_wrap_cached(docs[0])] if len(docs) == 1 else None
+
+def _path_query(path_parts, parent=None):
+    '''Compiles the whole path into a single query. The query returns a
+    list with the candidates found for each of the path parts, stopping
+    right after the first part that doesn't resolve into exactly one
+    object.
+    '''
+    if not path_parts:
+        return r.expr([])
+    first, rest = path_parts[0], path_parts[1:]
+    return _path_candidates_query(parent, first).do(lambda found: r.branch(
+        found.count().eq(1),
+        r.expr([found]).add(_path_query(rest, found.nth(0))),
+        r.expr([found])))
+
+def resolve_object_path(path_parts):
+    '''Resolves the list of slugs in `path_parts` with at most one round
+    trip to the database. A `~` part stands for the type object of the previous
+    object. Returns the list of objects along the path, where the last
+    one is the object the path points to.
+    If one of the parts is missing the request is aborted with
+    `NOT_FOUND`, and if a part is ambiguous it's aborted with
+    `INTERNAL_SERVER_ERROR`.
+    '''
+    logger.debug('  resolve_object_path(path_parts={!r})'.format(path_parts))
+    chain = []
+    def _add_to_chain(part, candidates):
+        if len(candidates) == 0:
+            flask_abort(httplib.NOT_FOUND, 'Could not find an object for {!r}'.format(part))
+        if len(candidates) > 1:
+            parent_id = TREE_ROOT if not chain else chain[-1].id
+            flask_abort(httplib.INTERNAL_SERVER_ERROR, 'Got multiple results for slug={!r} parent_id={!r}'.format(part, parent_id))
+        chain.append(candidates[0])
+    # Resolve as much of the path as possible from the cache (usually the
+    # lab and the type objects) and only then go to the database.
+    remaining = list(path_parts)
+    while remaining:
+        candidates = _cached_path_candidates(chain[-1] if chain else None, remaining[0])
+        if candidates is None:
+            break
+        _add_to_chain(remaining.pop(0), candidates)
+    if remaining:
+        if not type_cache.ready:
+            type_cache.count_miss()
+        parent = r.expr(dict(id=chain[-1].id, type_id=chain[-1].type_id)) if chain else None
+        for part, candidates in zip(remaining, Object.query.run(_path_query(remaining, parent))):
+            _add_to_chain(part, [Object.query.wrap(doc) for doc in candidates])
+    assert len(chain) == len(path_parts)
+    return chain
+
 def get_objects_of_type(typeobj):
     '''Returns all objects of type `typeobj`.'''
     type_id = NO_TYPE if typeobj is None else typeobj.id
@@ -95,6 +300,21 @@ def get_object_children(obj):
     obj_id = TREE_ROOT if obj is None else obj.id
     return Object.query.get_all(obj_id, index='parent_id')
 
+def get_children_of_objects(objs):
+    '''Returns an iterator for all children of all `objs` in one query.'''
+    obj_ids = [obj.id for obj in objs]
+    if not obj_ids:
+        return iter(())
+    return Object.query.read_only.get_all(*obj_ids, index='parent_id')
+
+def ensure_valid_slug(slug):
+    '''Makes sure `slug` can be used in object paths: it must be a non-empty
+    string without `/` or `~` (see `TYPE_PATH_PART`), otherwise we abort
+    with `httplib.BAD_REQUEST`.
+    '''
+    if not isinstance(slug, basestring) or not slug or ('/' in slug) or (TYPE_PATH_PART in slug):
+        flask_abort(httplib.BAD_REQUEST, 'Invalid slug {!r}: slugs must not be empty or contain "/" or "{}"'.format(slug, TYPE_PATH_PART))
+
 def ensure_unique_slug(parent, slug):
     '''Makes sure the `slug` is unique as a child of `parent`. If
     `slug` is not unique, we abort with `httplib.CONFLICT`.
@@ -108,7 +328,12 @@ def get_user_attributes(obj):
     returns all attributes with the value as defined in `obj` or with
     `None` to indicate no value.
     '''
-    typeobj = get_type_object(obj)
+    return get_user_attributes_of_type(obj, get_type_object(obj))
+
+def get_user_attributes_of_type(obj, typeobj):
+    '''Like `get_user_attributes` for callers that already have the type
+    object of `obj`.
+    '''
     if typeobj is None:
         return {}
     if 'attrs' not in typeobj:
@@ -0,0 +1,125 @@
+import json
+import base64
+import httplib
+import rethinkdb as r
+from flask import request
+from flask import Response
+from flask import stream_with_context
+from flask import abort as flask_abort
+from ..db.times import epoch_time
+from ..db.times import parse_iso8601
+from ..serialization import iter_json_list
+from ..events.timeline import get_events_page
+from .models import Object
+
+MAX_PAGE_SIZE = 1000
+
+DEFAULT_EVENTS_PAGE_SIZE = 50
+
+#----------------------------------------------------------#
+# Cursors                                                  #
+#----------------------------------------------------------#
+
+# A cursor points at the last document of a page. It holds the id of
+# the document and its creation time, in case the document is deleted
+# before the next page is requested. Clients should treat cursors as
+# opaque strings.
+
+def encode_cursor(doc):
+    return base64.urlsafe_b64encode(json.dumps(dict(id=doc['id'], created_at=epoch_time(doc['created_at']))))
+
+def decode_cursor(cursor):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        return data['id'], float(data['created_at'])
+    except (TypeError, ValueError, KeyError) as error:
+        flask_abort(httplib.BAD_REQUEST, 'Invalid cursor {!r}: {}'.format(cursor, error))
+
+def _after_key(cursor):
+    '''Returns the `[created_at, id]` to continue listing from. The
+    creation time is read from the document itself when it still
+    exists.
+    '''
+    obj_id, created_at = decode_cursor(cursor)
+    return [Object.query.table().get(obj_id)['created_at'].default(r.epoch_time(created_at)), obj_id]
+
+#----------------------------------------------------------#
+# Listings                                                 #
+#----------------------------------------------------------#
+
+def _parse_limit(default=None):
+    limit = request.args.get('limit', None)
+    if limit is None:
+        return default
+    try:
+        limit = int(limit)
+    except ValueError:
+        flask_abort(httplib.BAD_REQUEST, 'limit must be a number, got {!r}'.format(limit))
+    if not (0 < limit <= MAX_PAGE_SIZE):
+        flask_abort(httplib.BAD_REQUEST, 'limit must be between 1 and {}'.format(MAX_PAGE_SIZE))
+    return limit
+
+def _parse_fields():
+    fields = request.args.get('fields', None)
+    if fields is None:
+        return None
+    return [field for field in fields.split(',') if field]
+
+def _parse_time(arg_name):
+    value = request.args.get(arg_name, None)
+    if value is None:
+        return None
+    try:
+        return parse_iso8601(value)
+    except ValueError:
+        flask_abort(httplib.BAD_REQUEST, '{} must be an ISO 8601 time with a timezone, got {!r}'.format(arg_name, value))
+
+def object_listing(key, index, prefix, filter=None):
+    '''Returns a response listing the objects found in the compound `index`
+    (see `Query.page`) under `prefix`, in the format `{key: [...]}`.
+
+    The listing is controlled by the request arguments:
+    - `fields`: comma separated fields to return for every object.
+    - `limit`: the maximal number of objects to return. When given, the
+      response also has `next` with a cursor to pass in `after` for the
+      next page, or `null` when there are no more objects.
+    - `after`: a cursor returned by a previous page.
+
+    Listings with no `limit` are streamed (see `iter_json_list`).
+    '''
+    fields = _parse_fields()
+    limit = _parse_limit()
+    after = request.args.get('after', None)
+    docs = Object.query.page(index, prefix,
+                             after  = None if after is None else _after_key(after),
+                             fields = fields,
+                             limit  = limit,
+                             filter = filter)
+    if limit is None:
+        return Response(stream_with_context(iter_json_list(key, docs)), status=httplib.OK, mimetype='application/json')
+    docs = list(docs)
+    return {
+        key: docs,
+        'next': encode_cursor(docs[-1]) if len(docs) == limit else None,
+    }
+
+def event_listing(obj_id):
+    '''Returns a page of the events of `obj_id`, newest first, in the
+    format `{events: [...], next: cursor}`. `next` is `null` on the last
+    page.
+
+    The listing is controlled by the request arguments:
+    - `limit`: the maximal number of events to return.
+    - `before`: a cursor returned by a previous page.
+    - `since`/`until`: only return events created in this time range.
+    '''
+    limit = _parse_limit(default=DEFAULT_EVENTS_PAGE_SIZE)
+    before = request.args.get('before', None)
+    events = get_events_page(obj_id, limit,
+                             before = None if before is None else decode_cursor(before),
+                             since  = _parse_time('since'),
+                             until  = _parse_time('until'))
+    return dict(
+        events = events,
+        next   = encode_cursor(events[-1]) if len(events) == limit else None,
+    )
@@ -0,0 +1,350 @@
+import re
+import json
+import base64
+import httplib
+import rethinkdb as r
+from bunch import Bunch
+from flask import request
+from flask import abort as flask_abort
+from ..db.times import TimeEncoder
+from ..db.times import decode_time
+from ..db.times import parse_iso8601
+from .models import Object
+from .paging import MAX_PAGE_SIZE
+from .attr_indexes import attr_indexes
+from .attr_indexes import attr_index_name
+from .attr_indexes import indexed_attr_slugs
+
+DEFAULT_QUERY_PAGE_SIZE = 100
+
+#----------------------------------------------------------#
+# Fields                                                   #
+#----------------------------------------------------------#
+
+# Fields are named by dotted paths into the object, for example `slug`,
+# `attrs.rack` or `agent_info.hw_mem.MemTotal`. Missing fields are
+# `null`.
+
+FIELD_PATH_RE = re.compile(r'^[A-Za-z0-9_\-]+(?:\.[A-Za-z0-9_\-]+)*$')
+
+# Values compared with these fields are given as ISO 8601 times
+TIME_FIELDS = frozenset(['created_at', 'modified_at', 'last_seen'])
+
+def _parse_path(path):
+    if not isinstance(path, basestring) or not FIELD_PATH_RE.match(path):
+        flask_abort(httplib.BAD_REQUEST, 'Invalid field {!r}'.format(path))
+    return path
+
+def _get_child(name):
+    # Paths through values that are not objects are missing as well
+    return lambda value: r.branch(value.type_of().eq('OBJECT'), value[name].default(None), None)
+
+def _field(doc, path):
+    field = doc
+    for name in path.split('.'):
+        field = field.do(_get_child(name))
+    return field
+
+def _get_path(doc, path):
+    for name in path.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(name, None)
+    return doc
+
+def _pluck_spec(paths):
+    '''Returns the argument of `pluck` that keeps the dotted `paths`.'''
+    spec = {}
+    for path in paths:
+        names = path.split('.')
+        node = spec
+        for name in names[:-1]:
+            if node.get(name, None) is True:
+                break
+            node = node.setdefault(name, {})
+        else:
+            node[names[-1]] = True
+    return spec
+
+#----------------------------------------------------------#
+# Filters                                                  #
+#----------------------------------------------------------#
+
+def _is_of_type(field, type_name):
+    return field.type_of().eq(type_name)
+
+OPERATORS = {
+    'eq'       : lambda field, value: field.eq(value),
+    'ne'       : lambda field, value: field.ne(value),
+    'lt'       : lambda field, value: field.lt(value),
+    'le'       : lambda field, value: field.le(value),
+    'gt'       : lambda field, value: field.gt(value),
+    'ge'       : lambda field, value: field.ge(value),
+    'in'       : lambda field, value: r.expr(value).contains(field),
+    'contains' : lambda field, value: r.branch(_is_of_type(field, 'ARRAY'), field.contains(value), False),
+    'match'    : lambda field, value: r.branch(_is_of_type(field, 'STRING'), field.match(value).ne(None), False),
+    'exists'   : lambda field, value: field.ne(None) if value else field.eq(None),
+}
+
+def _parse_time_value(path, value):
+    try:
+        return parse_iso8601(value)
+    except (TypeError, ValueError):
+        flask_abort(httplib.BAD_REQUEST, 'Values of {} must be ISO 8601 times with a timezone, got {!r}'.format(path, value))
+
+def _parse_condition(condition):
+    if not isinstance(condition, dict):
+        flask_abort(httplib.BAD_REQUEST, 'Conditions must be objects, got {!r}'.format(condition))
+    try:
+        path, op, value = condition['field'], condition['op'], condition['value']
+    except KeyError as error:
+        flask_abort(httplib.BAD_REQUEST, 'Missing "{}" in condition {!r}'.format(error, condition))
+    path = _parse_path(path)
+    if op not in OPERATORS:
+        flask_abort(httplib.BAD_REQUEST, 'Unknown operator {!r}, expected one of: {}'.format(op, ', '.join(sorted(OPERATORS))))
+    if (op == 'in') and not isinstance(value, list):
+        flask_abort(httplib.BAD_REQUEST, 'The value of "in" must be a list, got {!r}'.format(value))
+    if (op == 'match') and not isinstance(value, basestring):
+        flask_abort(httplib.BAD_REQUEST, 'The value of "match" must be a regular expression, got {!r}'.format(value))
+    if (op == 'exists') and not isinstance(value, bool):
+        flask_abort(httplib.BAD_REQUEST, 'The value of "exists" must be true or false, got {!r}'.format(value))
+    if (path in TIME_FIELDS) and (op in ('eq', 'ne', 'lt', 'le', 'gt', 'ge')):
+        value = _parse_time_value(path, value)
+    elif (path in TIME_FIELDS) and (op == 'in'):
+        value = [_parse_time_value(path, item) for item in value]
+    return Bunch(path=path, op=op, value=value)
+
+def _filter_predicate(conditions):
+    def predicate(doc):
+        return r.and_(*(OPERATORS[condition.op](_field(doc, condition.path), condition.value)
+                        for condition in conditions))
+    return predicate
+
+#----------------------------------------------------------#
+# Sorting and cursors                                      #
+#----------------------------------------------------------#
+
+# Results are sorted by the requested fields and then by `created_at`
+# and `id`, so every object has a single place in the order. A cursor
+# holds the sort values of the last object of a page.
+
+def _parse_sort_key(key):
+    if not isinstance(key, basestring):
+        flask_abort(httplib.BAD_REQUEST, 'Sort keys must be field names, got {!r}'.format(key))
+    if key.startswith('-'):
+        return _parse_path(key[1:]), True
+    return _parse_path(key), False
+
+def _sort_keys(sort):
+    '''Returns a list of `(path, descending)` for the `sort` of a query.
+    The tie-breaking `created_at` and `id` are sorted in the direction of
+    the last requested key.
+    '''
+    keys = [_parse_sort_key(key) for key in sort]
+    descending = keys[-1][1] if keys else False
+    paths = set(path for path, _ in keys)
+    keys.extend((path, descending) for path in ('created_at', 'id') if path not in paths)
+    return keys
+
+def encode_query_cursor(keys, doc):
+    return base64.urlsafe_b64encode(json.dumps([_get_path(doc, path) for path, _ in keys], cls=TimeEncoder))
+
+def decode_query_cursor(keys, cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)), object_hook=decode_time)
+    except (TypeError, ValueError) as error:
+        flask_abort(httplib.BAD_REQUEST, 'Invalid cursor {!r}: {}'.format(cursor, error))
+    if not isinstance(values, list) or (len(values) != len(keys)):
+        flask_abort(httplib.BAD_REQUEST, 'Invalid cursor {!r}: it belongs to a query with a different sort'.format(cursor))
+    return values
+
+def _after_predicate(keys, values):
+    '''Returns a predicate for the objects that come after `values` in the
+    order of `keys`.
+    '''
+    def predicate(doc):
+        fields = [_field(doc, path) for path, _ in keys]
+        clauses = []
+        for i, (_, descending) in enumerate(keys):
+            clause = fields[i].lt(values[i]) if descending else fields[i].gt(values[i])
+            clauses.append(r.and_(*([fields[j].eq(values[j]) for j in xrange(i)] + [clause])))
+        return r.or_(*clauses)
+    return predicate
+
+def _order_by(keys):
+    return [(r.desc if descending else r.asc)(lambda doc, path=path: _field(doc, path)) for path, descending in keys]
+
+#----------------------------------------------------------#
+# Planning                                                 #
+#----------------------------------------------------------#
+
+# Equality conditions on these fields use an index. Typed indexes are
+# compound indexes of `[field, type_id]`; the others only index the
+# field, so the objects they select are filtered by type as well.
+TYPED_INDEXES = {
+    'slug'      : 'slug_type',
+    'parent_id' : 'parent_type',
+}
+UNTYPED_INDEXES = {
+    'id'         : None, # The primary key
+    'cluster_id' : 'cluster_id',
+}
+
+def _unique(values):
+    # `get_all` returns an object once for every key it matches
+    unique = []
+    for value in values:
+        if value not in unique:
+            unique.append(value)
+    return unique
+
+def _attr_index(typeobj, path):
+    '''Returns the name of the index of the attribute at `path` when the
+    attribute is indexed by `typeobj` and its index is ready (see
+    `AttrIndexes`), or `None`.
+    '''
+    names = path.split('.')
+    if (len(names) != 2) or (names[0] != 'attrs'):
+        return None
+    slug = names[1]
+    if (slug not in indexed_attr_slugs(typeobj)) or not attr_indexes.is_ready(slug):
+        return None
+    return attr_index_name(slug)
+
+def _attr_range(type_id, condition):
+    '''Returns the arguments of `between` for a range `condition` on an
+    attribute index.
+    '''
+    if condition.op in ('gt', 'ge'):
+        return ([type_id, condition.value], [type_id, r.maxval]), dict(left_bound='open' if condition.op == 'gt' else 'closed')
+    return ([type_id, r.minval], [type_id, condition.value]), dict(right_bound='open' if condition.op == 'lt' else 'closed')
+
+def _index_selection(table, typeobj, conditions):
+    '''Returns the objects selected by an index for one of `conditions`
+    and the conditions left to filter them with, or `None` and all
+    `conditions` when no index can be used. Equality conditions are
+    preferred over ranges, which can only use attribute indexes.
+    '''
+    for condition in conditions:
+        if (condition.op not in ('eq', 'in')) or (condition.op == 'in' and not condition.value):
+            continue
+        values = [condition.value] if condition.op == 'eq' else _unique(condition.value)
+        rest = [other for other in conditions if other is not condition]
+        attr_index = _attr_index(typeobj, condition.path)
+        # Objects with no value for an attribute are not in its index
+        if (attr_index is not None) and (None not in values):
+            return table.get_all(r.args([[typeobj.id, value] for value in values]), index=attr_index), rest
+        if condition.path in TYPED_INDEXES:
+            keys = [[value, typeobj.id] for value in values]
+            return table.get_all(r.args(keys), index=TYPED_INDEXES[condition.path]), rest
+        if condition.path in UNTYPED_INDEXES:
+            index = UNTYPED_INDEXES[condition.path]
+            kwargs = {} if index is None else dict(index=index)
+            return table.get_all(r.args(values), **kwargs), rest + [Bunch(path='type_id', op='eq', value=typeobj.id)]
+    for condition in conditions:
+        if (condition.op not in ('lt', 'le', 'gt', 'ge')) or (condition.value is None):
+            continue
+        attr_index = _attr_index(typeobj, condition.path)
+        if attr_index is not None:
+            args, kwargs = _attr_range(typeobj.id, condition)
+            return table.between(*args, index=attr_index, **kwargs), conditions
+    return None, conditions
+
+def compile_query(typeobj, conditions, keys, after=None, paths=None, limit=None):
+    '''Compiles a query for the objects of `typeobj` that match all
+    `conditions`, in the order of `keys` (see `_sort_keys`), starting
+    after the cursor values `after`. Only the `paths` of every object are
+    returned, along with the paths of `keys`.
+
+    Queries that are only sorted by creation time scan the `type_created`
+    index in order, and stop as soon as `limit` objects were found. Other
+    queries select their objects with an index on one of `conditions`
+    when there's one (see `_index_selection`), or with the `type_id`
+    index, and sort them in memory.
+    '''
+    table = Object.query.table()
+    selection, conditions = _index_selection(table, typeobj, conditions)
+    if (selection is None) and ([path for path, _ in keys] == ['created_at', 'id']):
+        descending = keys[0][1]
+        lower, upper = [typeobj.id, r.minval, r.minval], [typeobj.id, r.maxval, r.maxval]
+        if after is not None:
+            if descending:
+                upper = [typeobj.id] + after
+            else:
+                lower = [typeobj.id] + after
+        query = table.between(lower, upper, index='type_created', left_bound='open', right_bound='open')
+        query = query.order_by(index=r.desc('type_created') if descending else 'type_created')
+        if conditions:
+            query = query.filter(_filter_predicate(conditions))
+    else:
+        query = table.get_all(typeobj.id, index='type_id') if selection is None else selection
+        if conditions:
+            query = query.filter(_filter_predicate(conditions))
+        if after is not None:
+            query = query.filter(_after_predicate(keys, after))
+        query = query.order_by(*_order_by(keys))
+    if paths is not None:
+        query = query.pluck(_pluck_spec(list(paths) + [path for path, _ in keys]))
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+#----------------------------------------------------------#
+# Requests                                                 #
+#----------------------------------------------------------#
+
+def _parse_list(body, name, parse_item):
+    items = body.get(name, None)
+    if items is None:
+        return None
+    if not isinstance(items, list):
+        flask_abort(httplib.BAD_REQUEST, '"{}" must be a list, got {!r}'.format(name, items))
+    return [parse_item(item) for item in items]
+
+def _parse_query_limit(body):
+    limit = body.get('limit', DEFAULT_QUERY_PAGE_SIZE)
+    if not isinstance(limit, (int, long)) or isinstance(limit, bool) or not (0 < limit <= MAX_PAGE_SIZE):
+        flask_abort(httplib.BAD_REQUEST, 'limit must be a number between 1 and {}, got {!r}'.format(MAX_PAGE_SIZE, limit))
+    return limit
+
+def object_query(typeobj):
+    '''Returns a page of the objects of `typeobj` that match the query in
+    the request body, in the format `{objects: [...], next: cursor}`.
+    `next` is `null` on the last page. The query is an object with:
+
+    - `filter`: a list of conditions that objects must all match, each in
+      the format `{field, op, value}`. `op` is one of `OPERATORS`, and
+      `field` a dotted path such as `attrs.rack`, `status` or
+      `agent_info.hw_mem.MemTotal`.
+      Conditions on attributes defined with `indexed` use the index of
+      the attribute.
+    - `sort`: a list of fields to sort by, with a `-` prefix to sort in
+      descending order. Objects are sorted by creation time by default.
+    - `fields`: the fields to return for every object.
+    - `limit`: the maximal number of objects to return.
+    - `after`: the `next` cursor of a previous page, with the same query.
+
+    For example:
+
+        {"filter": [{"field": "attrs.rack", "op": "eq", "value": "B3"},
+                    {"field": "status", "op": "eq", "value": "online"}],
+         "sort": ["display_name"], "fields": ["slug", "attrs"]}
+    '''
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        flask_abort(httplib.BAD_REQUEST, 'Expected a query object in the request body')
+    conditions = _parse_list(body, 'filter', _parse_condition) or []
+    keys = _sort_keys(_parse_list(body, 'sort', lambda key: key) or [])
+    paths = _parse_list(body, 'fields', _parse_path)
+    limit = _parse_query_limit(body)
+    after = body.get('after', None)
+    after = None if after is None else decode_query_cursor(keys, after)
+    try:
+        docs = list(Object.query.run(compile_query(typeobj, conditions, keys, after=after, paths=paths, limit=limit)))
+    except r.ReqlQueryLogicError as error:
+        # For example, an invalid regular expression
+        flask_abort(httplib.BAD_REQUEST, 'Invalid query: {}'.format(error.message))
+    return dict(
+        objects = docs,
+        next    = encode_query_cursor(keys, docs[-1]) if len(docs) == limit else None,
+    )
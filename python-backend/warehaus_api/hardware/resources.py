@@ -1,4 +1,5 @@
 import httplib
+import rethinkdb as r
 from uuid import uuid4
 from logging import getLogger
 from flask import request
@@ -8,15 +9,19 @@ from flask_restful.reqparse import RequestParser
 from flask_jwt import current_identity
 from ..auth.roles import require_user
 from ..auth.roles import require_admin
+from ..db.session import session_scope
 from ..events.models import create_event
 from .models import Object
+from .models import TREE_ROOT
+from .models import NO_TYPE
 from .models import create_object
+from .models import ensure_valid_slug
 from .models import get_object_by_id
-from .models import get_type_object
-from .models import get_object_child
 from .models import get_object_children
-from .type_class import get_object_action
-from .type_class import get_type_action
+from .models import resolve_object_path
+from .type_class import OBJECT_ACTION
+from .type_class import TYPE_ACTION
+from .paging import object_listing
 from .all_type_classes import all_type_classes
 from .labs import Lab
 
@@ -51,7 +56,7 @@ def _object_path_parts(obj_path):
         flask_abort(httplib.NOT_FOUND, 'Path {!r} is too short'.format(obj_path))
     return path_parts[:-1], path_parts[-1]
 
-def get_object_by_path(obj_path):
+def get_object_chain_by_path(obj_path):
     '''Finds an object by walking the object hierarchy. For example,
     a valid path can be:
 
@@ -72,24 +77,24 @@ def get_object_by_path(obj_path):
 
         X/Y/Z/labels
 
+    The whole walk is done with a single database query. Returns the
+    list of objects along the path (the last one is the object the path
+    points to) and the action name.
     '''
     logger.debug('Looking for object+action with path={!r}'.format(obj_path))
-    cur_obj = None
     path_parts, action = _object_path_parts(obj_path)
-    for part in path_parts:
-        if part == '~':
-            cur_obj = get_type_object(cur_obj)
-        else:
-            cur_obj = get_object_child(cur_obj, part)
-        if cur_obj is None:
-            flask_abort(httplib.NOT_FOUND, 'Could not find an object for {!r}'.format(part))
-    # cur_obj must not be None. We must enter the for loop at least once
-    # so we should call flask_abort if something is wrong.
-    assert cur_obj is not None
-    return cur_obj, action
-
-def serialize_object(obj):
-    return obj.as_dict()
+    chain = resolve_object_path(path_parts)
+    # chain must not be empty. There's at least one path part and
+    # resolve_object_path calls flask_abort if something is wrong.
+    assert chain
+    return chain, action
+
+def get_object_by_path(obj_path):
+    '''Same as `get_object_chain_by_path` but only returns the object
+    the path points to and the action name.
+    '''
+    chain, action = get_object_chain_by_path(obj_path)
+    return chain[-1], action
 
 #----------------------------------------------------------#
 # Resources                                                #
@@ -103,10 +108,11 @@ class ObjectTreeRoot(Resource):
     '''
     def get(self):
         '''Returns all labs. In the object tree, the root is actually
-        "null" so labs are the only objects with no parent.
+        "null" so labs are the only objects with no parent. See
+        `object_listing` for paging and selecting fields.
         '''
         require_user()
-        return dict(labs=list(serialize_object(lab) for lab in self._all_labs()))
+        return object_listing('labs', 'parent_created', TREE_ROOT, filter=r.row['type_id'] != NO_TYPE)
 
     def _all_labs(self):
         return (obj for obj in get_object_children(None) if obj.has_type())
@@ -121,6 +127,7 @@ class ObjectTreeRoot(Resource):
         return lab_type
 
     def _create_lab(self, slug, display_name):
+        ensure_valid_slug(slug)
         if any(lab['slug'] == slug for lab in self._all_labs()):
             flask_abort(httplib.CONFLICT, "There's already a lab with this name")
         lab_type_obj = self._create_lab_type_object(slug)
@@ -136,53 +143,47 @@ class ObjectTreeRoot(Resource):
     def post(self):
         require_admin()
         args = self.create_lab_parser.parse_args()
-        lab = self._create_lab(args['slug'], args['display_name'])
-        create_event(
-            obj_id = lab.id,
-            user_id = current_identity.id,
-            interested_ids = [lab.id],
-            title = 'Created the **{}** lab'.format(lab.display_name),
-        )
-        return serialize_object(lab), httplib.CREATED
+        with session_scope():
+            lab = self._create_lab(args['slug'], args['display_name'])
+            create_event(
+                obj_id = lab.id,
+                user_id = current_identity.id,
+                interested_ids = [lab.id],
+                title = 'Created the **{}** lab'.format(lab.display_name),
+            )
+        return lab, httplib.CREATED
 
 class ObjectTreeNode(Resource):
     '''An object resource that allows for:
     - Accessing an object by its place in the object hierarchy
     - Invoking actions supported by the object type
     '''
-    def _find_type_class(self, type_key):
-        try:
-            return all_type_classes[type_key]
-        except LookupError as error:
-            flask_abort(httplib.INTERNAL_SERVER_ERROR, error)
-
-    def _find_and_invoke_from_type_class(self, type_class, get_action, obj, action_name):
-        http_error = httplib.NOT_FOUND
-        for attr in dir(type_class):
-            action = getattr(type_class, attr)
-            action_info = get_action(action)
-            if action_info is None:
-                continue
-            if action_info['name'] == action_name:
-                http_error = httplib.METHOD_NOT_ALLOWED
-                if action_info['method'] == request.method:
-                    return action(obj)
-        flask_abort(http_error, 'Could not find handler for {!r}'.format(action_name))
+    def _find_and_invoke_action(self, type_key, kind, obj, action_name):
+        if type_key not in all_type_classes:
+            flask_abort(httplib.INTERNAL_SERVER_ERROR, 'No such type with key {!r}'.format(type_key))
+        action = all_type_classes.find_action(type_key, kind, action_name, request.method)
+        if action is None:
+            http_error = (httplib.METHOD_NOT_ALLOWED if all_type_classes.action_methods(type_key, kind, action_name)
+                          else httplib.NOT_FOUND)
+            flask_abort(http_error, 'Could not find handler for {!r}'.format(action_name))
+        return action(obj)
 
     def invoke_type_action(self, type_obj, action_name):
-        type_class = self._find_type_class(type_obj.type_key)
-        return self._find_and_invoke_from_type_class(type_class, get_type_action, type_obj, action_name)
+        return self._find_and_invoke_action(type_obj.type_key, TYPE_ACTION, type_obj, action_name)
 
     def invoke_object_action(self, obj, action_name):
         type_obj = obj.get_type_object()
-        type_class = self._find_type_class(type_obj.type_key)
-        return self._find_and_invoke_from_type_class(type_class, get_object_action, obj, action_name)
+        return self._find_and_invoke_action(type_obj.type_key, OBJECT_ACTION, obj, action_name)
 
     def invoke_action(self, path):
+        '''Invokes the action. All writes of the action are sent to the
+        database together when it returns (see `Session`).
+        '''
         obj, action_name = get_object_by_path(path)
-        if obj.has_type():
-            return self.invoke_object_action(obj, action_name)
-        return self.invoke_type_action(obj, action_name)
+        with session_scope():
+            if obj.has_type():
+                return self.invoke_object_action(obj, action_name)
+            return self.invoke_type_action(obj, action_name)
 
     get    = invoke_action
     post   = invoke_action
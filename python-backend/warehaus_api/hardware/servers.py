@@ -8,27 +8,54 @@ from slugify import slugify
 from flask import request
 from flask import Response
 from flask import abort as flask_abort
+from bunch import Bunch
 from flask_restful.reqparse import RequestParser
 from flask_jwt import current_identity
 from ..db.times import now
+from ..db.session import session_scope
 from ..auth.roles import require_user
+from ..request_body import read_json_body
 from ..events.models import create_event
 from .type_class import TypeClass
 from .type_class import type_action
 from .type_class import object_action
+from .models import Object
 from .models import create_object
-from .models import get_user_attributes
+from .models import get_user_attributes_of_type
 from .models import get_object_by_id
+from .models import get_objects_by_ids
+from .models import get_children_of_objects
 from .models import get_object_children
 from .models import get_object_child
-from .models import get_type_object
 from .labs import get_lab_from_type_object
+from .config_store import config_store
+from .heartbeats import HEARTBEAT_PROTOCOL
+from .heartbeats import agent_info_digest
+from .heartbeats import heartbeat_protocol
+from .heartbeats import heartbeat_queue
 
 logger = getLogger(__name__)
 
 class ServerError(Exception):
     pass
 
+_MISSING = object()
+
+MAX_HEARTBEAT_SIZE = 32 * 1024 * 1024
+
+def _check_heartbeat(heartbeat):
+    if not isinstance(heartbeat, dict):
+        flask_abort(httplib.BAD_REQUEST, 'Heartbeat must be a JSON object')
+    if not isinstance(heartbeat.get('hostname', None), basestring):
+        flask_abort(httplib.BAD_REQUEST, 'Missing "hostname" in heartbeat')
+    if heartbeat_protocol(heartbeat) >= HEARTBEAT_PROTOCOL:
+        if not isinstance(heartbeat.get('digests', None), dict):
+            flask_abort(httplib.BAD_REQUEST, 'Missing "digests" in heartbeat')
+        if not isinstance(heartbeat.get('info', {}), dict):
+            flask_abort(httplib.BAD_REQUEST, '"info" must be an object')
+    elif not isinstance(heartbeat.get('info', None), dict):
+        flask_abort(httplib.BAD_REQUEST, 'Missing "info" in heartbeat')
+
 class PciDevice(TypeClass):
     SLUG = 'pci-device'
     TYPE_VENDOR = 'builtin'
@@ -117,64 +144,213 @@ class Server(TypeClass):
     def _get_disk_provider_info(self, agent_info, disk):
         pass
 
-    def _sync_sub_objects(self, server, subtype, get_provider_info_func, last_update):
-        '''Query for all subobjects with type `subtype` of the `server`.
-        The `last_update` is a `dict` of `slug -> fields`. If `slug`
-        doesn't exist, it's created with the desired `fields`. If it
+    def _sync_sub_objects(self, server, subtype, subobjs, get_provider_info_func, last_update):
+        '''Syncs `subobjs`, the subobjects with type `subtype` of the
+        `server`. The `last_update` is a `dict` of `slug -> fields`. If
+        `slug` doesn't exist, it's created with the desired `fields`. If it
         exists, the current object is updated. If a subobject exists but
         not found in `last_update` it's removed from the `server`.
+
+        The differences are computed locally and written to the active
+        session, which sends all inserts, updates and deletes of the
+        request together.
         '''
-        remaining = {subobj.id: subobj for subobj in server.get_children_with_subtype(subtype)}
+        remaining = {subobj.id: subobj for subobj in subobjs}
         existing_slugs = {subobj.slug: subobj for subobj in remaining.itervalues()}
+        new_subobjs = []
+        changed = False
         for slug, expected_fields in last_update.iteritems():
+            provider_info = get_provider_info_func(expected_fields)
             if slug in existing_slugs:
-                subobj = existing_slugs[slug]
-                subobj.update(**expected_fields)
-                remaining.pop(subobj.id)
+                subobj = remaining.pop(existing_slugs[slug].id)
+                current = subobj.data_view()
+                if (current.get('provider', _MISSING) != provider_info) or \
+                   any(current.get(key, _MISSING) != value for key, value in expected_fields.iteritems()):
+                    subobj.update(**expected_fields)
+                    # `provider` is replaced rather than merged
+                    subobj.provider = r.literal(provider_info)
+                    subobj.save()
+                    changed = True
             else:
                 subobj = create_object(parent=server, type=subtype, slug=slug)
                 subobj.update(**expected_fields)
-            provider_info = get_provider_info_func(subobj)
-            if 'id' in subobj:
-                subobj.provider = r.literal(provider_info)
-            else:
                 subobj.provider = provider_info
-            subobj.save()
-        for subobj in remaining.itervalues():
-            subobj.delete()
-
-    def _update_sub_objects(self, server, typeobj, agent_info):
-        self._sync_sub_objects(server, typeobj.get_object_child(PciDevice.SLUG),
-                               partial(self._get_pci_provider_info, agent_info),
-                               {('pci-' + pcidev['address']): pcidev for pcidev in agent_info.get('hw_pci_devices', [])})
-        self._sync_sub_objects(server, typeobj.get_object_child(NetworkInterface.SLUG),
-                               partial(self._get_net_provider_info, agent_info),
-                               {('net-' + net['dev']): net for net in agent_info.get('hw_net', [])})
-        self._sync_sub_objects(server, typeobj.get_object_child(Disk.SLUG),
-                               partial(self._get_disk_provider_info, agent_info),
-                               {('disk-' + disk['name']): disk for disk in agent_info.get('hw_disks', [])})
+                new_subobjs.append(subobj)
+        Object.query.insert_many(new_subobjs)
+        Object.query.delete_many(remaining.itervalues())
+        if new_subobjs or changed or remaining:
+            # The sub-objects are written directly rather than saved
+            config_store.invalidate([server.id])
+
+    def _sub_object_syncs(self, agent_info):
+        '''Returns a tuple of `(subtype_class, sections, get_provider_info_func, last_update)`
+        for each kind of sub-object, where `sections` are the sections of
+        `agent_info` the sub-objects are created from.
+        '''
+        return (
+            (PciDevice, ('hw_pci_devices',),
+             partial(self._get_pci_provider_info, agent_info),
+             {('pci-' + pcidev['address']): pcidev for pcidev in agent_info.get('hw_pci_devices', [])}),
+            (NetworkInterface, ('hw_net', 'provider_info'),
+             partial(self._get_net_provider_info, agent_info),
+             {('net-' + net['dev']): net for net in agent_info.get('hw_net', [])}),
+            (Disk, ('hw_disks',),
+             partial(self._get_disk_provider_info, agent_info),
+             {('disk-' + disk['name']): disk for disk in agent_info.get('hw_disks', [])}),
+        )
+
+    def _update_sub_objects(self, server, typeobj, agent_info, changed_sections, is_new):
+        '''Syncs the sub-objects of `server` that were created from any of
+        the `changed_sections` of `agent_info`. All sub-objects are read
+        in one query before any of them is written, so the writes are
+        sent together when the session is flushed.
+        '''
+        syncs = [(typeobj.get_object_child(subtype_class.SLUG), get_provider_info_func, last_update)
+                 for subtype_class, sections, get_provider_info_func, last_update in self._sub_object_syncs(agent_info)
+                 if not changed_sections.isdisjoint(sections)]
+        if not syncs:
+            return
+        subobjs_by_type = {}
+        if not is_new:
+            for subobj in get_object_children(server):
+                subobjs_by_type.setdefault(subobj.type_id, []).append(subobj)
+        for subtype, get_provider_info_func, last_update in syncs:
+            self._sync_sub_objects(server, subtype, subobjs_by_type.get(subtype.id, []), get_provider_info_func, last_update)
+
+    def _update_agent_info(self, server, sent_info, agent_digests=None):
+        '''Updates/keeps agent_info in the server object. We always keep a
+        copy of the last keepalive even after creating sub-objects from it.
+
+        `sent_info` holds the sections the agent sent. With the first
+        heartbeat protocol the agent always sends all sections and
+        `agent_digests` is `None`. With the second protocol the agent
+        only sends the sections that changed since the last heartbeat,
+        and `agent_digests` holds the digests of all sections the agent
+        currently has.
+
+        A digest of every section is kept with the server, and sections
+        with an unchanged digest are not written again. The digests are
+        only stored by `_update_agent_info_digests` once the sub-objects
+        were synced from the sections. Returns a tuple
+        of `(changed_sections, agent_info, digests, resync_sections)`
+        where `agent_info` and `digests` are the full agent_info of the
+        server and its digests after the update, and `resync_sections`
+        are the sections the agent didn't send but we don't have either
+        (for example, after the server object was deleted).
+        '''
+        sent_digests = {section: agent_info_digest(value) for section, value in sent_info.iteritems()}
+        agent_digests = sent_digests if agent_digests is None else dict(agent_digests, **sent_digests)
+        is_new = 'id' not in server
+        has_digests = (not is_new) and ('agent_info_digests' in server)
+        stored_info = server.agent_info if (not is_new) and ('agent_info' in server) else {}
+        stored_digests = server.agent_info_digests if has_digests else {}
+        agent_info = {}
+        digests = {}
+        resync_sections = set()
+        for section, digest in agent_digests.iteritems():
+            if section in sent_info:
+                agent_info[section] = sent_info[section]
+                digests[section] = digest
+            else:
+                if stored_digests.get(section, None) != digest:
+                    resync_sections.add(section)
+                if (section in stored_digests) and (section in stored_info):
+                    agent_info[section] = stored_info[section]
+                    digests[section] = stored_digests[section]
+        changed_sections = set(section for section in set(digests) | set(stored_digests)
+                               if digests.get(section, None) != stored_digests.get(section, None))
+        if is_new:
+            server.agent_info = agent_info
+        elif not has_digests:
+            # Servers from before we kept digests (or whose sub-objects
+            # were never synced) get their agent_info replaced as a whole
+            server.agent_info = r.literal(agent_info)
+            changed_sections |= set(stored_info) | set(agent_info)
+        elif changed_sections:
+            server.agent_info = {section: (r.literal(agent_info[section]) if section in agent_info else r.literal())
+                                 for section in changed_sections}
+        return changed_sections, agent_info, digests, resync_sections
+
+    def _update_agent_info_digests(self, server, digests):
+        '''Stores the digests returned by `_update_agent_info`. This is
+        called only after the sub-objects were synced: if the sync fails
+        the stored digests still differ from the ones the agent sends, so
+        the next heartbeat syncs the changed sections again.
+        '''
+        stored_digests = server.agent_info_digests if 'agent_info_digests' in server else None
+        if stored_digests != digests:
+            server.agent_info_digests = r.literal(digests)
 
     @type_action('POST', 'heartbeat')
     def heartbeat_call(self, typeobj):
-        display_name = request.json['hostname']
+        '''Receives a heartbeat from an agent (see `heartbeat.py.txt`).
+
+        Agents using protocol 2 send `digests` with the digest of every
+        `agent_info` section and only the changed sections in `info`.
+        They get back the digests we hold, which become the baseline for
+        their next heartbeat, and the list of sections we asked them to
+        send again in `resync`. Agents that don't send a `protocol` send
+        the full `info` every time and get back `'ok'`.
+
+        The body may be sent with `Content-Encoding: gzip`, and is limited
+        to `MAX_HEARTBEAT_SIZE` bytes after decompression.
+
+        The heartbeat may be applied later by the heartbeat queue (see
+        `HeartbeatQueue`), in which case the reply is `ACCEPTED` and holds
+        the digests the agent sent.
+        '''
+        heartbeat = read_json_body(MAX_HEARTBEAT_SIZE)
+        _check_heartbeat(heartbeat)
         logger.info('Processing heartbeat from {!r}'.format(request.headers.getlist("X-Forwarded-For")[0] if request.headers.getlist("X-Forwarded-For") else request.remote_addr))
-        agent_info = request.json['info']
+        key = (typeobj.id, slugify(heartbeat['hostname']))
+        if not heartbeat_queue.should_queue(key):
+            return heartbeat_queue.apply_inline(key, partial(self._apply_heartbeat, typeobj, heartbeat))
+        heartbeat_queue.enqueue(key, heartbeat, partial(self._apply_queued_heartbeat, typeobj.id))
+        if heartbeat_protocol(heartbeat) < HEARTBEAT_PROTOCOL:
+            return 'ok', httplib.ACCEPTED
+        return dict(
+            protocol = HEARTBEAT_PROTOCOL,
+            digests  = heartbeat['digests'],
+            resync   = [],
+        ), httplib.ACCEPTED
+
+    def _apply_queued_heartbeat(self, typeobj_id, heartbeat):
+        with session_scope():
+            typeobj = get_object_by_id(typeobj_id)
+            return self._apply_heartbeat(typeobj, heartbeat)
+
+    def _apply_heartbeat(self, typeobj, heartbeat):
+        '''Applies `heartbeat` to the server it was sent from. Returns a tuple
+        of `(reply, is_synced)` where `is_synced` is whether we hold all the
+        sections the agent has.
+        '''
+        protocol = heartbeat_protocol(heartbeat)
+        display_name = heartbeat['hostname']
+        sent_info = heartbeat.get('info', {}) if protocol >= HEARTBEAT_PROTOCOL else heartbeat['info']
+        agent_digests = heartbeat['digests'] if protocol >= HEARTBEAT_PROTOCOL else None
         slug = slugify(display_name)
         server, lab = self._get_server(typeobj, slug)
         server.display_name = display_name
-        server.errors = request.json.get('errors', [])
-        # Update/keep agent_info in the server object. We always keep
-        # a copy of the last keepalive even after creating sub-objects
-        # from it.
+        server.errors = heartbeat.get('errors', [])
         is_new = 'id' not in server
-        if is_new:
-            server.agent_info = agent_info
-        else:
-            server.agent_info = r.literal(agent_info)
+        changed_sections, agent_info, digests, resync_sections = self._update_agent_info(server, sent_info, agent_digests)
+        if is_new and resync_sections:
+            # Servers are only created once we have all their sections,
+            # so we ask the agent for all of them
+            return dict(
+                protocol = HEARTBEAT_PROTOCOL,
+                digests  = {},
+                resync   = sorted(agent_digests),
+            ), False
         server.last_seen = now()
         server.status = 'online'
+        if is_new:
+            # New servers get their id when saved, and have no sub-objects
+            # to read
+            server.save()
+        self._update_sub_objects(server, typeobj, agent_info, changed_sections, is_new)
+        self._update_agent_info_digests(server, digests)
         server.save()
-        self._update_sub_objects(server, typeobj, agent_info)
         if is_new:
             create_event(
                 obj_id = server.id,
@@ -182,7 +358,14 @@ class Server(TypeClass):
                 interested_ids = [server.id, lab.id],
                 title = 'Created **{}** {}'.format(server.display_name, typeobj.display_name['singular']),
             )
-        return 'ok'
+        is_synced = not resync_sections
+        if protocol < HEARTBEAT_PROTOCOL:
+            return 'ok', is_synced
+        return dict(
+            protocol = HEARTBEAT_PROTOCOL,
+            digests  = digests,
+            resync   = sorted(resync_sections),
+        ), is_synced
 
     set_cluster_pareser = RequestParser()
     set_cluster_pareser.add_argument('cluster_id', required=True)
@@ -193,59 +376,105 @@ class Server(TypeClass):
         args = self.set_cluster_pareser.parse_args()
         lab = server.get_parent_object()
         previous_cluster_id = server.cluster_id if 'cluster_id' in server else None
+        # The clusters are read before the server is saved, so the write
+        # is sent along with the rest of the session
+        if previous_cluster_id is not None:
+            previous_cluster = get_object_by_id(previous_cluster_id)
+        if args['cluster_id'] is not None:
+            cluster = get_object_by_id(args['cluster_id'])
         server.cluster_id = args['cluster_id']
         server.save()
         if previous_cluster_id is not None or server.cluster_id is not None:
-            if previous_cluster_id is not None:
-                previous_cluster = get_object_by_id(previous_cluster_id)
-            if server.cluster_id is not None:
-                cluster = get_object_by_id(server.cluster_id)
             create_event(
                 obj_id = server.id,
                 user_id = current_identity.id,
                 interested_ids = [server.id, lab.id] + [some_id for some_id in (previous_cluster_id, server.cluster_id) if some_id is not None],
                 title = ('Added **{}** to **{}**'.format(server.display_name, cluster.display_name)
                          if previous_cluster_id is None else
-                         'Removed **{}** from **{}**'.format(server.display_name, cluster.display_name)
+                         'Removed **{}** from **{}**'.format(server.display_name, previous_cluster.display_name)
                          if server.cluster_id is None else
                          'Moved **{}** from **{}** to **{}**'.format(server.display_name, previous_cluster.display_name, cluster.display_name)),
             )
-        return server.as_dict(), httplib.OK
+        return server, httplib.OK
 
     @object_action('GET', 'config.json')
     def server_config(self, server):
         require_user()
-        return server_config(server)
+        return config_store.response(server, _build_server_config)
+
+    def object_configs(self, servers):
+        return server_configs(servers)
 
 def server_config(server):
-    typeobj = get_type_object(server)
-    net_if_type = get_object_child(typeobj, NetworkInterface.SLUG)
-    pci_dev_type = get_object_child(typeobj, PciDevice.SLUG)
-    disk_type = get_object_child(typeobj, Disk.SLUG)
-    hw = dict(
-        cpu  = server['agent_info']['hw_cpu'],
-        mem  = server['agent_info']['hw_mem'],
-        fs   = server['agent_info']['hw_fs'],
-        net  = [],
-        pci  = [],
-        disk = [],
-    )
-    for childobj in get_object_children(server):
-        childobj_data = childobj.as_dict()
-        childobj_data['user_attrs'] = get_user_attributes(childobj)
-        if childobj.type_id == net_if_type.id:
-            hw['net'].append(childobj_data)
-        elif childobj.type_id == pci_dev_type.id:
-            hw['pci'].append(childobj_data)
-        elif childobj.type_id == disk_type.id:
-            hw['disk'].append(childobj_data)
-    config = dict(
-        id           = server['id'],
-        type_id      = server['type_id'],
-        slug         = server['slug'],
-        display_name = server['display_name'],
-        user_attrs   = get_user_attributes(server),
-        provider     = server['agent_info']['provider_info'],
-        hw           = hw,
+    return server_configs([server])[0]
+
+def _build_server_config(server):
+    sources = server_config_sources([server])
+    return server_configs([server], sources)[0], sources.objects
+
+def server_config_sources(servers):
+    '''Looks up what the configs of `servers` are built from: the type
+    objects of the servers, their children and the type objects of the
+    children. Everything is looked up in a fixed number of queries, no
+    matter how many servers there are. `objects` of the result holds all
+    objects the configs depend on (see `conditional_response`).
+    '''
+    servers = list(servers)
+    typeobjs = get_objects_by_ids(server.type_id for server in servers)
+    subtype_kinds = {}
+    for typeobj in typeobjs.itervalues():
+        for kind, subtype_class in (('net', NetworkInterface), ('pci', PciDevice), ('disk', Disk)):
+            subtype = get_object_child(typeobj, subtype_class.SLUG)
+            if subtype is not None:
+                subtype_kinds[subtype.id] = kind
+    children = {server.id: [] for server in servers}
+    for childobj in get_children_of_objects(servers):
+        children[childobj.parent_id].append(childobj)
+    child_typeobjs = get_objects_by_ids(childobj.type_id for server_children in children.itervalues()
+                                        for childobj in server_children)
+    objects = servers + typeobjs.values() + child_typeobjs.values()
+    objects.extend(childobj for server_children in children.itervalues() for childobj in server_children)
+    return Bunch(
+        typeobjs       = typeobjs,
+        subtype_kinds  = subtype_kinds,
+        children       = children,
+        child_typeobjs = child_typeobjs,
+        objects        = objects,
     )
-    return config
+
+def server_configs(servers, sources=None):
+    '''Returns the configs of all `servers`, built from `sources` as
+    returned by `server_config_sources`, which are looked up when not
+    given.
+    '''
+    servers = list(servers)
+    if sources is None:
+        sources = server_config_sources(servers)
+    typeobjs, subtype_kinds, children, child_typeobjs = (
+        sources.typeobjs, sources.subtype_kinds, sources.children, sources.child_typeobjs)
+    configs = []
+    for server in servers:
+        hw = dict(
+            cpu  = server['agent_info']['hw_cpu'],
+            mem  = server['agent_info']['hw_mem'],
+            fs   = server['agent_info']['hw_fs'],
+            net  = [],
+            pci  = [],
+            disk = [],
+        )
+        for childobj in children[server.id]:
+            kind = subtype_kinds.get(childobj.type_id, None)
+            if kind is None:
+                continue
+            hw[kind].append(dict(childobj.as_dict(),
+                                 user_attrs=get_user_attributes_of_type(childobj, child_typeobjs.get(childobj.type_id, None))))
+        configs.append(dict(
+            id           = server['id'],
+            type_id      = server['type_id'],
+            slug         = server['slug'],
+            display_name = server['display_name'],
+            user_attrs   = get_user_attributes_of_type(server, typeobjs.get(server.type_id, None)),
+            provider     = server['agent_info']['provider_info'],
+            hw           = hw,
+        ))
+    return configs
@@ -0,0 +1,128 @@
+import rethinkdb as r
+from copy import deepcopy
+from logging import getLogger
+from ..metrics import metrics
+
+logger = getLogger(__name__)
+
+class TypeObjectCache(object):
+    '''A process-local copy of the skeleton of the object tree: all type
+    objects and all objects in the root of the tree (labs and their type
+    objects). These objects rarely change but almost every request needs
+    some of them, so each worker keeps them in memory.
+
+    The cache is filled and kept coherent by a changes feed (see
+    `ChangesWatcher`) which first reports all existing documents and
+    then every change. Until the feed reports it's ready the cache can't
+    answer anything and callers should go to the database instead.
+    Even once it's ready the feed lags behind writes made by other
+    workers, so only entries found in the cache can be trusted: when an
+    object is missing (or a slug is ambiguous) callers should ask the
+    database as well.
+
+    All lookups return copies of the documents so callers are free to
+    modify and save the objects they get.
+    '''
+    def __init__(self, name, root_id):
+        super(TypeObjectCache, self).__init__()
+        self.name = name
+        self.root_id = root_id
+        self._hits = metrics.counter(name + '.hits')
+        self._misses = metrics.counter(name + '.misses')
+        metrics.gauge(name + '.size', lambda: len(self._by_id))
+        self._reset()
+
+    def _reset(self):
+        self.ready = False
+        self._by_id = {}
+        self._by_slug_parent = {}
+        self._root_by_type = {}
+
+    #----------------------------------------------------------------#
+    # Feed callbacks                                                 #
+    #----------------------------------------------------------------#
+
+    def on_change(self, old_val, new_val):
+        if old_val is not None:
+            self._remove(old_val)
+        if new_val is not None:
+            self._add(new_val)
+
+    def on_ready(self):
+        self.ready = True
+
+    def on_lost(self):
+        self._reset()
+
+    def _add(self, doc):
+        self._by_id[doc['id']] = doc
+        self._by_slug_parent.setdefault((doc['slug'], doc['parent_id']), set()).add(doc['id'])
+        if doc['parent_id'] == self.root_id:
+            self._root_by_type.setdefault(doc['type_id'], set()).add(doc['id'])
+
+    def _remove(self, doc):
+        stored = self._by_id.pop(doc['id'], None)
+        if stored is not None:
+            self._by_slug_parent.get((stored['slug'], stored['parent_id']), set()).discard(stored['id'])
+            self._root_by_type.get(stored['type_id'], set()).discard(stored['id'])
+
+    #----------------------------------------------------------------#
+    # Local writes                                                   #
+    #----------------------------------------------------------------#
+
+    # Changes made by this process are applied right away so that the
+    # next request handled by this worker sees them even if the feed
+    # didn't deliver them yet.
+
+    def saved(self, doc):
+        if not self.ready or any(isinstance(value, r.ast.RqlQuery) for value in doc.itervalues()):
+            return
+        self._remove(doc)
+        self._add(deepcopy(doc))
+
+    def deleted(self, obj_id):
+        if self.ready:
+            self._remove(dict(id=obj_id))
+
+    #----------------------------------------------------------------#
+    # Lookups                                                        #
+    #----------------------------------------------------------------#
+
+    def _copies(self, ids):
+        return [deepcopy(self._by_id[obj_id]) for obj_id in ids]
+
+    def count_miss(self):
+        self._misses.inc()
+
+    def _count(self, found):
+        if found:
+            self._hits.inc()
+        else:
+            self._misses.inc()
+
+    def get(self, obj_id):
+        '''Returns the document with `obj_id` or `None` if it's not cached.'''
+        doc = self._by_id.get(obj_id, None)
+        self._count(doc is not None)
+        return None if doc is None else deepcopy(doc)
+
+    def get_many(self, obj_ids):
+        '''Returns a dict of the documents with any of `obj_ids`, keyed by
+        their id. Ids of documents that are not in the cache are missing
+        from the dict.
+        '''
+        docs = {obj_id: deepcopy(self._by_id[obj_id]) for obj_id in obj_ids if obj_id in self._by_id}
+        self._count(len(docs) == len(obj_ids))
+        return docs
+
+    def get_children(self, parent_id, slug):
+        '''Returns a list of the cached documents with `slug` under `parent_id`.'''
+        ids = self._by_slug_parent.get((slug, parent_id), ())
+        self._count(len(ids) == 1)
+        return self._copies(ids)
+
+    def get_root_objects_of_type(self, type_id):
+        '''Returns a list of the cached root documents with type `type_id`.'''
+        ids = self._root_by_type.get(type_id, ())
+        self._count(len(ids) == 1)
+        return self._copies(ids)
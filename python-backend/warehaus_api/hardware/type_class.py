@@ -9,15 +9,23 @@ from ..auth.roles import require_user
 from ..auth.roles import require_admin
 from ..events.models import create_event
 from .models import create_object
-from .models import get_objects_of_type
-from .models import get_object_children
 from .models import ensure_unique_slug
+from .paging import object_listing
+from .paging import event_listing
+from .query import object_query
+from .conditional import conditional_response
+from .attr_indexes import attr_indexes
+from .attr_indexes import is_indexed_attr
+from .attr_indexes import indexed_attr_slugs
 
 logger = getLogger(__name__)
 
 OBJ_ACTION_ATTR = '_warehaus_object_action'
 TYPE_ACTION_ATTR = '_warehaus_type_action'
 
+OBJECT_ACTION = 'object'
+TYPE_ACTION = 'type'
+
 def _add_attr_to_func(attr, value):
     def decorator(func):
         setattr(func, attr, value)
@@ -113,6 +121,19 @@ class TypeClass(object):
         for slug, typeclass in self.subtypes().iteritems():
             typeclass.create_type_object(parent=type_object, slug=slug)
 
+    #----------------------------------------------------------------#
+    # Configs                                                        #
+    #----------------------------------------------------------------#
+
+    def object_configs(self, objs):
+        '''Returns a list with the config of each of `objs`, as returned by
+        the `config.json` action of objects of this type class. Type classes
+        should look up whatever the configs need for all objects together
+        rather than per object. Type classes with no configs return an
+        empty list.
+        '''
+        return []
+
     #----------------------------------------------------------------#
     # Actions supported on all objects and type-objects              #
     #----------------------------------------------------------------#
@@ -120,50 +141,91 @@ class TypeClass(object):
     @object_action('GET', '')
     def get_object(self, obj):
         '''Returns the object from the database. This action is automatically
-        supported for all objects of all types.
+        supported for all objects of all types. Clients can poll it with
+        `If-None-Match` (see `conditional_response`).
         '''
         require_user()
-        return obj.as_dict()
+        return conditional_response([obj], lambda: obj, obj.UNVERSIONED_FIELDS)
+
+    @object_action('GET', 'events')
+    def get_events(self, obj):
+        '''Returns the events of the object, newest first. See
+        `event_listing` for paging and time ranges.
+        '''
+        require_user()
+        return event_listing(obj.id)
 
     @type_action('GET', '')
     def get_type(self, typeobj):
         '''Same as `get_object` but for type objects.'''
         require_user()
-        return typeobj.as_dict()
+        return conditional_response([typeobj], lambda: typeobj, typeobj.UNVERSIONED_FIELDS)
 
     @type_action('GET', 'objects')
     def get_objects_of_type(self, typeobj):
-        '''Returns all objects of this type object.'''
+        '''Returns the objects of this type object, oldest first. See
+        `object_listing` for paging and selecting fields.
+        '''
         require_user()
-        return dict(objects=list(obj.as_dict() for obj in get_objects_of_type(typeobj)))
+        return object_listing('objects', 'type_created', typeobj.id)
+
+    @type_action('POST', 'query')
+    def query_objects(self, typeobj):
+        '''Returns the objects of this type object that match the query in
+        the request body. See `object_query` for the query format.
+        '''
+        require_user()
+        return object_query(typeobj)
 
     @type_action('GET', 'children')
     def get_type_children(self, typeobj):
         '''Get all type-objects which are children of this type-object.'''
         require_user()
-        return dict(children=list(child.as_dict() for child in get_object_children(typeobj)))
+        return object_listing('children', 'parent_created', typeobj.id)
 
     @type_action('DELETE', '')
     def delete_type(self, typeobj):
         '''Deletes this object.'''
         require_admin()
+        indexed_slugs = indexed_attr_slugs(typeobj)
         typeobj.delete()
+        for slug in indexed_slugs:
+            attr_indexes.release(slug)
         return None, httplib.NO_CONTENT
 
     #----------------------------------------------------------------#
     # User-based attribute support                                   #
     #----------------------------------------------------------------#
 
+    def _check_indexed_flag(self, attr):
+        if ('indexed' in attr) and not isinstance(attr['indexed'], bool):
+            flask_abort(httplib.BAD_REQUEST, 'The "indexed" property of attributes must be true or false')
+
+    def _update_attr_indexes(self, old_attr, new_attr):
+        '''Creates or drops the indexes of attributes that started or
+        stopped being indexed (see `AttrIndexes`). `old_attr` is `None`
+        for new attributes and `new_attr` is `None` for deleted ones.
+        '''
+        was_indexed = (old_attr is not None) and is_indexed_attr(old_attr)
+        is_indexed = (new_attr is not None) and is_indexed_attr(new_attr)
+        if is_indexed and not (was_indexed and old_attr['slug'] == new_attr['slug']):
+            attr_indexes.create(new_attr['slug'])
+        if was_indexed and not (is_indexed and old_attr['slug'] == new_attr['slug']):
+            attr_indexes.release(old_attr['slug'])
+
     @type_action('POST', 'attrs')
     def add_attribute(self, typeobj):
         '''Add an attribute to this type-object. After this attribute has been
         added, users can get/set this attribute from all objects of this type.
+        Attributes defined with `indexed: true` get an index, so queries that
+        filter by them don't scan all objects of the type.
         '''
         require_admin()
         try:
             new_attr = request.json['attr']
         except LookupError as error:
             flask_abort(httplib.BAD_REQUEST, 'Missing "{}" parameter'.format(error))
+        self._check_indexed_flag(new_attr)
         if 'attrs' in typeobj:
             if any(attr['slug'] == new_attr['slug'] for attr in typeobj.attrs):
                 flask_abort(httplib.CONFLICT, "There's already an attribute with slug '{}'".format(new_attr['slug']))
@@ -171,7 +233,8 @@ class TypeClass(object):
         else:
             typeobj.attrs = [new_attr]
         typeobj.save()
-        return typeobj.as_dict(), httplib.CREATED
+        self._update_attr_indexes(None, new_attr)
+        return typeobj, httplib.CREATED
 
     @type_action('PUT', 'attrs')
     def update_attribute(self, typeobj):
@@ -184,13 +247,16 @@ class TypeClass(object):
             flask_abort(httplib.BAD_REQUEST, 'Missing "{}" parameter'.format(error))
         if 'slug' not in updated_attr:
             flask_abort(httplib.BAD_REQUEST, 'Updated attribute must have a "slug" property')
+        self._check_indexed_flag(updated_attr)
         if 'attrs' not in typeobj or not any(attr['slug'] == attr_slug for attr in typeobj.attrs):
             flask_abort(httplib.NOT_FOUND, 'No such attribute {!r}'.format(updated_attr['slug']))
         if (attr_slug != updated_attr['slug']) and any(attr['slug'] == updated_attr['slug'] for attr in typeobj.attrs):
             flask_abort(httplib.CONFLICT, "There's already an attribute with slug '{}'".format(updated_attr['slug']))
+        old_attr = next(attr for attr in typeobj.attrs if attr['slug'] == attr_slug)
         typeobj.attrs = [updated_attr if attr['slug'] == attr_slug else attr for attr in typeobj.attrs]
         typeobj.save()
-        return typeobj.as_dict()
+        self._update_attr_indexes(old_attr, updated_attr)
+        return typeobj
 
     @type_action('DELETE', 'attrs')
     def delete_attribute(self, typeobj):
@@ -202,10 +268,21 @@ class TypeClass(object):
             flask_abort(httplib.BAD_REQUEST, 'Missing "{}" parameter'.format(error))
         if ('attrs' not in typeobj) or all(attr['slug'] != attr_slug for attr in typeobj.attrs):
             flask_abort(httplib.NOT_FOUND, 'No such attribute {!r}'.format(attr_slug))
+        old_attr = next(attr for attr in typeobj.attrs if attr['slug'] == attr_slug)
         typeobj.attrs = list(attr for attr in typeobj.attrs if attr['slug'] != attr_slug)
         typeobj.save()
+        self._update_attr_indexes(old_attr, None)
         return None, httplib.NO_CONTENT
 
+    @type_action('GET', 'attr-indexes')
+    def get_attr_indexes(self, typeobj):
+        '''Returns the status of the index of every indexed attribute of this
+        type-object, in the format `{slug: status}`. Indexes can be used once
+        their status is `ready`.
+        '''
+        require_user()
+        return {slug: attr_indexes.status(slug) for slug in indexed_attr_slugs(typeobj)}
+
     def _get_typeobj_attr(self, typeobj, attr_slug):
         if 'attrs' in typeobj:
             for attr in typeobj.attrs:
@@ -236,7 +313,7 @@ class TypeClass(object):
             title = 'Set the **{}** attribute of **{}**'.format(attr_type['display_name'], obj.display_name),
             content = attr_value,
         )
-        return obj.as_dict()
+        return obj
 
     @object_action('DELETE', 'attrs')
     def delete_attr(self, obj):
@@ -0,0 +1,86 @@
+import os
+import time
+from contextlib import contextmanager
+
+class Counter(object):
+    def __init__(self):
+        super(Counter, self).__init__()
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+class Gauge(object):
+    '''A value which is computed by calling `func` whenever the metrics
+    are collected (for example, the current length of a queue).
+    '''
+    def __init__(self, func):
+        super(Gauge, self).__init__()
+        self.func = func
+
+    def snapshot(self):
+        return self.func()
+
+class Timer(object):
+    def __init__(self):
+        super(Timer, self).__init__()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @contextmanager
+    def time(self):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(time.time() - start)
+
+    def snapshot(self):
+        return dict(
+            count = self.count,
+            total = self.total,
+            max   = self.max,
+            avg   = (self.total / self.count) if self.count else 0.0,
+        )
+
+class MetricsRegistry(object):
+    '''Holds the metrics of the current process. Every gunicorn worker
+    has its own registry so all values are per-worker.
+    '''
+    def __init__(self):
+        super(MetricsRegistry, self).__init__()
+        self._metrics = {}
+
+    def _get_or_create(self, name, metric_type, *args):
+        if name not in self._metrics:
+            self._metrics[name] = metric_type(*args)
+        metric = self._metrics[name]
+        if not isinstance(metric, metric_type):
+            raise TypeError('Metric {!r} is already registered as a {}'.format(name, type(metric).__name__))
+        return metric
+
+    def counter(self, name):
+        return self._get_or_create(name, Counter)
+
+    def gauge(self, name, func):
+        return self._get_or_create(name, Gauge, func)
+
+    def timer(self, name):
+        return self._get_or_create(name, Timer)
+
+    def snapshot(self):
+        return dict(
+            pid     = os.getpid(),
+            metrics = {name: metric.snapshot() for name, metric in self._metrics.iteritems()},
+        )
+
+metrics = MetricsRegistry()
@@ -0,0 +1,66 @@
+import json
+import zlib
+import httplib
+from flask import request
+from flask import abort as flask_abort
+
+CHUNK_SIZE = 64 * 1024
+
+# Add 16 to the window bits to make zlib expect a gzip header
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+def iter_decompressed(chunks, max_size):
+    '''Decompresses the gzip data in `chunks` incrementally and yields the
+    decompressed chunks. Raises `ValueError` once the decompressed data
+    exceeds `max_size` bytes, without decompressing any further.
+    '''
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    size = 0
+    for chunk in chunks:
+        data = decompressor.decompress(chunk, max_size - size + 1)
+        size += len(data)
+        if size > max_size or decompressor.unconsumed_tail:
+            raise ValueError('Decompressed data is larger than {} bytes'.format(max_size))
+        yield data
+    data = decompressor.flush()
+    size += len(data)
+    if size > max_size:
+        raise ValueError('Decompressed data is larger than {} bytes'.format(max_size))
+    yield data
+
+def _iter_request_stream(max_size):
+    size = 0
+    while True:
+        chunk = request.stream.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        size += len(chunk)
+        if size > max_size:
+            raise ValueError('Request body is larger than {} bytes'.format(max_size))
+        yield chunk
+
+def read_json_body(max_size):
+    '''Reads and parses the JSON body of the current request. Bodies sent
+    with `Content-Encoding: gzip` are decompressed while they're read.
+    Bodies larger than `max_size` bytes (before or after decompression)
+    fail the request with `REQUEST_ENTITY_TOO_LARGE` as soon as the limit
+    is crossed.
+    '''
+    encoding = request.headers.get('Content-Encoding', 'identity').strip().lower()
+    if encoding not in ('identity', 'gzip'):
+        flask_abort(httplib.UNSUPPORTED_MEDIA_TYPE, 'Unsupported Content-Encoding {!r}'.format(encoding))
+    if (request.content_length is not None) and (request.content_length > max_size):
+        flask_abort(httplib.REQUEST_ENTITY_TOO_LARGE, 'Request body is larger than {} bytes'.format(max_size))
+    try:
+        chunks = _iter_request_stream(max_size)
+        if encoding == 'gzip':
+            chunks = iter_decompressed(chunks, max_size)
+        body = ''.join(chunks)
+    except ValueError as error:
+        flask_abort(httplib.REQUEST_ENTITY_TOO_LARGE, str(error))
+    except zlib.error as error:
+        flask_abort(httplib.BAD_REQUEST, 'Could not decompress request body: {}'.format(error))
+    try:
+        return json.loads(body)
+    except ValueError as error:
+        flask_abort(httplib.BAD_REQUEST, 'Could not parse request body: {}'.format(error))
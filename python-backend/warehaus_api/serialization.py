@@ -0,0 +1,97 @@
+import json
+from datetime import datetime
+from .db import Model
+from .db.times import UTC
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+#----------------------------------------------------------------#
+# Encoders                                                       #
+#----------------------------------------------------------------#
+
+# Times are encoded in UTC in the ISO 8601 format of `isoformat()`, for
+# example `2016-05-01T12:30:00.123000+00:00`. Naive times are taken to
+# be in UTC. All encoders produce the same compact output, so which one
+# is used doesn't show in responses.
+
+def encode_datetime(dt):
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=UTC)
+    return dt.astimezone(UTC).isoformat()
+
+def _encode_default(obj):
+    if isinstance(obj, datetime):
+        return encode_datetime(obj)
+    if isinstance(obj, Model):
+        return obj.data_view()
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+class CustomJSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, (datetime, Model)):
+            return _encode_default(obj)
+        return json.JSONEncoder.default(self, obj)
+
+_stdlib_encoder = CustomJSONEncoder(separators=(',', ':'))
+
+def stdlib_dumps(data):
+    return _stdlib_encoder.encode(data)
+
+# simplejson's C encoder is faster than the one of the stdlib on Python 2.
+# Neither encodes times natively, so times and models go through
+# `_encode_default` with both.
+_simplejson_encoder = None if simplejson is None else simplejson.JSONEncoder(
+    separators=(',', ':'), default=_encode_default, namedtuple_as_object=False)
+
+def simplejson_dumps(data):
+    return _simplejson_encoder.encode(data)
+
+def available_encoders():
+    '''Returns a list of `(name, dumps)` of the encoders that can be used
+    in this process, fastest first.
+    '''
+    encoders = []
+    if simplejson is not None:
+        encoders.append(('simplejson', simplejson_dumps))
+    encoders.append(('json', stdlib_dumps))
+    return encoders
+
+ENCODER_NAME, dumps = available_encoders()[0]
+
+#----------------------------------------------------------------#
+# Streaming                                                      #
+#----------------------------------------------------------------#
+
+# Streamed JSON is yielded in pieces of about this many bytes
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def _iter_pieces(head, encoded_items, separator, tail, chunk_size):
+    pieces = [head]
+    size = len(head)
+    for index, encoded in enumerate(encoded_items):
+        if index > 0:
+            pieces.append(separator)
+        pieces.append(encoded)
+        size += len(encoded)
+        if size >= chunk_size:
+            yield ''.join(pieces)
+            pieces = []
+            size = 0
+    pieces.append(tail)
+    last_piece = ''.join(pieces)
+    if last_piece:
+        yield last_piece
+
+def iter_json_list(key, items, chunk_size=STREAM_CHUNK_SIZE):
+    '''Yields the JSON of `{key: [items]}` in pieces, encoding `items` one
+    by one as they're iterated. Nothing is kept besides the piece being
+    built, so `items` can be a database cursor of any size.
+    '''
+    return _iter_pieces('{' + dumps(key) + ':[', (dumps(item) for item in items), ',', ']}', chunk_size)
+
+def iter_json_lines(items, chunk_size=STREAM_CHUNK_SIZE):
+    '''Like `iter_json_list` but yields one JSON document per line.'''
+    return _iter_pieces('', (dumps(item) + '\n' for item in items), '', '', chunk_size)
@@ -11,6 +11,12 @@ def database_config():
         RETHINKDB_PORT = os.environ.get('RETHINKDB_PORT_28015_TCP_PORT', None)
         RETHINKDB_AUTH = os.environ.get('RETHINKDB_AUTH', '')
         RETHINKDB_DB   = os.environ.get('RETHINKDB_DB', 'warehaus')
+
+        # See `ConnectionPool`
+        RETHINKDB_POOL_SIZE                  = int(os.environ.get('WAREHAUS_DB_POOL_SIZE', '10'))
+        RETHINKDB_POOL_MAX_IDLE_TIME         = float(os.environ.get('WAREHAUS_DB_POOL_MAX_IDLE_TIME', '300'))
+        RETHINKDB_POOL_CHECKOUT_TIMEOUT      = float(os.environ.get('WAREHAUS_DB_POOL_CHECKOUT_TIMEOUT', '10'))
+        RETHINKDB_POOL_HEALTH_CHECK_INTERVAL = float(os.environ.get('WAREHAUS_DB_POOL_HEALTH_CHECK_INTERVAL', '30'))
     return DatabaseConfig
 
 def full_config():
@@ -22,4 +28,31 @@ def full_config():
     class FullConfig(object):
         SECRET_KEY = settings.jwt_secret
 
+        # See `add_query_count`, only meant for tests
+        QUERY_COUNT_HEADER = os.environ.get('WAREHAUS_QUERY_COUNT_HEADER', '') == '1'
+
+        # See `IdentityCache`, a zero TTL disables the cache
+        AUTH_CACHE_TTL  = float(os.environ.get('WAREHAUS_AUTH_CACHE_TTL', '30'))
+        AUTH_CACHE_SIZE = int(os.environ.get('WAREHAUS_AUTH_CACHE_SIZE', '1000'))
+
+        # See `AttrIndexes`
+        ATTR_INDEX_STATUS_INTERVAL = float(os.environ.get('WAREHAUS_ATTR_INDEX_STATUS_INTERVAL', '10'))
+
+        # See `HeartbeatQueue`, zero workers applies all heartbeats inline
+        HEARTBEAT_QUEUE_WORKERS      = int(os.environ.get('WAREHAUS_HEARTBEAT_WORKERS', '2'))
+        HEARTBEAT_QUEUE_INLINE_LIMIT = int(os.environ.get('WAREHAUS_HEARTBEAT_INLINE_LIMIT', '8'))
+        HEARTBEAT_QUEUE_BATCH_SIZE   = int(os.environ.get('WAREHAUS_HEARTBEAT_BATCH_SIZE', '20'))
+
+        # See `EventWriter`
+        EVENT_WRITER_BATCH_SIZE     = int(os.environ.get('WAREHAUS_EVENT_BATCH_SIZE', '100'))
+        EVENT_WRITER_FLUSH_INTERVAL = float(os.environ.get('WAREHAUS_EVENT_FLUSH_INTERVAL', '0.5'))
+        EVENT_WRITER_INSERT_TIMEOUT = float(os.environ.get('WAREHAUS_EVENT_INSERT_TIMEOUT', '5'))
+        EVENT_WRITER_SPILL_DIR      = os.environ.get('WAREHAUS_EVENT_SPILL_DIR', '/var/lib/warehaus/events')
+
+        # See `archive_old_events`, zero days keeps all events in the database
+        EVENT_RETENTION_DAYS       = int(os.environ.get('WAREHAUS_EVENT_RETENTION_DAYS', '90'))
+        EVENT_RETENTION_INTERVAL   = float(os.environ.get('WAREHAUS_EVENT_RETENTION_INTERVAL', '3600'))
+        EVENT_RETENTION_BATCH_SIZE = int(os.environ.get('WAREHAUS_EVENT_RETENTION_BATCH_SIZE', '1000'))
+        EVENT_ARCHIVE_DIR          = os.environ.get('WAREHAUS_EVENT_ARCHIVE_DIR', '/var/lib/warehaus/archive')
+
     return FullConfig
@@ -138,6 +138,10 @@ class Warehaus(object):
             command = command,
             image = os.environ['TEST_IMAGE'],
             volumes = volumes,
+            environment = {
+                # Tests compare the number of queries requests make
+                'WAREHAUS_QUERY_COUNT_HEADER': '1',
+            },
             host_config = self._docker.create_host_config(**host_config),
         )
         if self._container['Warnings']:
@@ -160,6 +164,16 @@ class Warehaus(object):
             time.sleep(0.1)
         raise error
 
+    def run_python(self, script):
+        '''Runs the Python `script` in the container, where the backend is
+        installed, and returns its output. Fails if the script fails.
+        '''
+        exec_id = self._docker.exec_create(container=self._container['Id'], cmd=['python', '-c', script])
+        output = self._docker.exec_start(exec_id)
+        exit_code = self._docker.exec_inspect(exec_id)['ExitCode']
+        assert exit_code == 0, 'SCRIPT FAILED WITH: {}, OUTPUT: {}'.format(exit_code, output)
+        return output
+
     def stop(self):
         self._docker.stop(container=self._container['Id'])
         self._docker.remove_container(container=self._container['Id'], v=True)
@@ -1,5 +1,10 @@
+import time
 import random
+import threading
+import json
+import urllib
 import httplib
+import requests
 from urlparse import urljoin
 
 def test_cluster_operations(warehaus):
@@ -86,3 +91,284 @@ def test_cluster_status(warehaus):
         warehaus.api.delete(cluster_uri + '/status')
         config = warehaus.api.get(cluster_uri + '/config.json')
         assert config['status'] is None
+
+def _server_info(i):
+    return dict(hw_cpu=[], hw_mem=dict(MemTotal=1), hw_fs={}, provider_info={},
+                hw_net=[dict(dev='eth0', mac='00:00:00:00:00:{:02x}'.format(i))],
+                hw_disks=[dict(name='sda', size=1)])
+
+def _config_query_count(warehaus, config_url, repeat=5):
+    url = warehaus.api.app_url(config_url)
+    counts = []
+    for _ in range(repeat):
+        response = requests.get(url, headers=warehaus.api.current_user.auth_headers())
+        assert response.status_code == httplib.OK, response.text
+        counts.append(int(response.headers['X-Query-Count']))
+    return min(counts)
+
+def test_cluster_config_query_count(warehaus):
+    '''The number of queries needed to build a cluster config should not
+    depend on the number of servers in the cluster.'''
+    with warehaus.temp_lab() as lab:
+        server_type = warehaus.create_type_object(lab, type_key='builtin-server', slug='server',
+                                                  name_singular='Server', name_plural='Servers')
+        cluster_type = warehaus.create_type_object(lab, type_key='builtin-cluster', slug='cluster',
+                                                   name_singular='Cluster', name_plural='Clusters')
+        cluster = warehaus.api.post(cluster_type, dict(display_name='Big Cluster'))
+        config_url = '/api/v1/labs/{}/big-cluster/config.json'.format(lab['slug'])
+        def add_server(i):
+            hostname = 'qc{}'.format(i)
+            warehaus.api.post(urljoin(server_type, 'heartbeat'), dict(hostname=hostname, info=_server_info(i)),
+                              expected_status=httplib.OK)
+            warehaus.api.put('/api/v1/labs/{}/{}/cluster'.format(lab['slug'], hostname), dict(cluster_id=cluster['id']))
+        add_server(0)
+        small_count = _config_query_count(warehaus, config_url)
+        for i in range(1, 5):
+            add_server(i)
+        assert len(warehaus.api.get(config_url)['servers']) == 5
+        assert _config_query_count(warehaus, config_url) == small_count
+
+def test_lab_config_ndjson(warehaus):
+    '''Export the configs of all objects in a lab.'''
+    NUM_SERVERS = 3
+    with warehaus.temp_lab() as lab:
+        server_type = warehaus.create_type_object(lab, type_key='builtin-server', slug='server',
+                                                  name_singular='Server', name_plural='Servers')
+        cluster_type = warehaus.create_type_object(lab, type_key='builtin-cluster', slug='cluster',
+                                                   name_singular='Cluster', name_plural='Clusters')
+        for i in range(NUM_SERVERS):
+            warehaus.api.post(urljoin(server_type, 'heartbeat'), dict(hostname='nd{}'.format(i), info=_server_info(i)),
+                              expected_status=httplib.OK)
+        cluster = warehaus.api.post(cluster_type, dict(display_name='Export Cluster'))
+        warehaus.api.put('/api/v1/labs/{}/nd0/cluster'.format(lab['slug']), dict(cluster_id=cluster['id']))
+        response = requests.get(warehaus.api.app_url('/api/v1/labs/{}/config.ndjson'.format(lab['slug'])),
+                                headers=warehaus.api.current_user.auth_headers())
+        assert response.status_code == httplib.OK, response.text
+        configs = {config['slug']: config for config in (json.loads(line) for line in response.text.splitlines())}
+        assert set(configs) == set(['nd{}'.format(i) for i in range(NUM_SERVERS)] + ['export-cluster'])
+        for i in range(NUM_SERVERS):
+            expected = warehaus.api.get('/api/v1/labs/{}/nd{}/config.json'.format(lab['slug'], i))
+            assert configs['nd{}'.format(i)]['hw']['disk'][0]['slug'] == expected['hw']['disk'][0]['slug']
+        assert [server['slug'] for server in configs['export-cluster']['servers']] == ['nd0']
+
+def test_paged_listing(warehaus):
+    '''Page through the objects of a type with selected fields.'''
+    NUM_CLUSTERS = 5
+    with warehaus.temp_lab() as lab:
+        cluster_type = warehaus.create_type_object(lab, type_key='builtin-cluster', slug='cluster',
+                                                   name_singular='Cluster', name_plural='Clusters')
+        created = [warehaus.api.post(cluster_type, dict(display_name='Paged {}'.format(i)))['id']
+                   for i in range(NUM_CLUSTERS)]
+        objects_url = urljoin(cluster_type, 'objects')
+        listed = []
+        page = warehaus.api.get(objects_url + '?limit=2&fields=slug,display_name')
+        while True:
+            assert len(page['objects']) <= 2
+            for obj in page['objects']:
+                assert set(obj) == set(['id', 'created_at', 'slug', 'display_name'])
+            listed.extend(obj['id'] for obj in page['objects'])
+            if page['next'] is None:
+                break
+            page = warehaus.api.get(objects_url + '?limit=2&fields=slug,display_name&after=' + page['next'])
+        assert listed == created
+        warehaus.api.get(objects_url + '?limit=0', expected_status=httplib.BAD_REQUEST)
+        warehaus.api.get(objects_url + '?limit=2&after=garbage', expected_status=httplib.BAD_REQUEST)
+        labs = warehaus.api.get('/api/v1/labs?fields=slug&limit={}'.format(1000))['labs']
+        assert lab['slug'] in [each['slug'] for each in labs]
+
+def test_event_timeline(warehaus):
+    '''Page through the events of a lab, newest first.'''
+    NUM_CLUSTERS = 5
+    with warehaus.temp_lab() as lab:
+        cluster_type = warehaus.create_type_object(lab, type_key='builtin-cluster', slug='cluster',
+                                                   name_singular='Cluster', name_plural='Clusters')
+        for i in range(NUM_CLUSTERS):
+            warehaus.api.post(cluster_type, dict(display_name='Timeline {}'.format(i)))
+        events_url = '/api/v1/labs/{}/events'.format(lab['slug'])
+        # Events are written in the background
+        for _ in range(50):
+            events = warehaus.api.get(events_url + '?limit=1000')['events']
+            if len(events) >= NUM_CLUSTERS:
+                break
+            time.sleep(0.1)
+        assert len(events) >= NUM_CLUSTERS
+        assert [event['created_at'] for event in events] == sorted((event['created_at'] for event in events), reverse=True)
+        listed = []
+        page = warehaus.api.get(events_url + '?limit=2')
+        while True:
+            assert len(page['events']) <= 2
+            listed.extend(event['id'] for event in page['events'])
+            if page['next'] is None:
+                break
+            page = warehaus.api.get(events_url + '?limit=2&before=' + page['next'])
+        assert listed == [event['id'] for event in events]
+        assert warehaus.api.get(events_url + '?until=2000-01-01T00:00:00Z')['events'] == []
+        warehaus.api.get(events_url + '?since=yesterday', expected_status=httplib.BAD_REQUEST)
+
+# Exercises `EventArchive` on its own, in a temporary directory
+ARCHIVE_SCRIPT = """
+import shutil
+import tempfile
+from datetime import datetime
+from datetime import timedelta
+from warehaus_api.db.times import UTC
+from warehaus_api.db.times import epoch_time
+from warehaus_api.events.archive import EventArchive
+from warehaus_api.events.archive import day_of
+
+archive = EventArchive('test_archive')
+archive.configure(tempfile.mkdtemp())
+try:
+    first_day = datetime(2016, 5, 1, 12, tzinfo=UTC)
+    def event(num, day, interested_ids):
+        return dict(id='e{}'.format(num), created_at=first_day + timedelta(days=day, minutes=num),
+                    interested_ids=interested_ids, title='Event {}'.format(num))
+    events = [event(0, 0, ['a']), event(1, 0, ['a', 'b']), event(2, 1, ['a']), event(3, 1, ['b'])]
+    def ids(page):
+        return [doc['id'] for doc in page]
+    # Archiving a day again merges the events with the archived ones
+    archive.archive_day(day_of(first_day), events[:1])
+    archive.archive_day(day_of(first_day), events[:2])
+    archive.archive_day(day_of(first_day + timedelta(days=1)), events[2:])
+    assert archive.days() == ['2016-05-01', '2016-05-02']
+    assert archive._index('2016-05-01')['count'] == 2
+    assert ids(archive.read_page('a', 10)) == ['e2', 'e1', 'e0']
+    assert ids(archive.read_page('b', 10)) == ['e3', 'e1']
+    assert archive.read_page('c', 10) == []
+    assert archive.read_page('a', 1)[0]['created_at'] == events[2]['created_at']
+    # Pages continue across days
+    assert ids(archive.read_page('a', 2)) == ['e2', 'e1']
+    assert ids(archive.read_page('a', 2, before=('e1', epoch_time(events[1]['created_at'])))) == ['e0']
+    assert ids(archive.read_page('a', 10, before=('e2', epoch_time(events[2]['created_at'])))) == ['e1', 'e0']
+    assert ids(archive.read_page('a', 10, since=events[1]['created_at'])) == ['e2', 'e1']
+    assert ids(archive.read_page('a', 10, until=events[1]['created_at'])) == ['e1', 'e0']
+    assert ids(archive.read_page('a', 10, since=events[1]['created_at'], until=events[1]['created_at'])) == ['e1']
+finally:
+    shutil.rmtree(archive.archive_dir)
+"""
+
+def test_event_archive(warehaus):
+    '''Archive events by day and page through them.'''
+    warehaus.run_python(ARCHIVE_SCRIPT)
+
+# Moves all events from the database to the archive of the server
+ARCHIVE_ALL_EVENTS_SCRIPT = """
+from warehaus_api.app import create_db_app
+from warehaus_api.events.archive import event_archive
+from warehaus_api.events.archive import init_event_archive
+from warehaus_api.events.retention import archive_old_events
+
+app = create_db_app()
+init_event_archive(app)
+with app.app_context():
+    archive_old_events(event_archive, retention_days=-1, batch_size=100)
+"""
+
+def _wait_for_events(warehaus, events_url, count):
+    # Events are written in the background
+    for _ in range(50):
+        events = warehaus.api.get(events_url + '?limit=1000')['events']
+        if len(events) >= count:
+            break
+        time.sleep(0.1)
+    assert len(events) >= count
+    return events
+
+def test_archived_event_timeline(warehaus):
+    '''Page through events in the database and then in the archive.'''
+    with warehaus.temp_lab() as lab:
+        cluster_type = warehaus.create_type_object(lab, type_key='builtin-cluster', slug='cluster',
+                                                   name_singular='Cluster', name_plural='Clusters')
+        events_url = '/api/v1/labs/{}/events'.format(lab['slug'])
+        for i in range(3):
+            warehaus.api.post(cluster_type, dict(display_name='Archived {}'.format(i)))
+        archived = [event['id'] for event in _wait_for_events(warehaus, events_url, 3)]
+        warehaus.run_python(ARCHIVE_ALL_EVENTS_SCRIPT)
+        assert [event['id'] for event in warehaus.api.get(events_url + '?limit=1000')['events']] == archived
+        # New events are in the database and come before the archived ones
+        warehaus.api.post(cluster_type, dict(display_name='Not Archived'))
+        events = _wait_for_events(warehaus, events_url, len(archived) + 1)
+        assert [event['id'] for event in events][1:] == archived
+        listed = []
+        page = warehaus.api.get(events_url + '?limit=2')
+        while True:
+            listed.extend(event['id'] for event in page['events'])
+            if page['next'] is None:
+                break
+            page = warehaus.api.get(events_url + '?limit=2&before=' + page['next'])
+        assert listed == [event['id'] for event in events]
+        since = urllib.quote(events[1]['created_at'])
+        assert [event['id'] for event in warehaus.api.get(events_url + '?since=' + since)['events']] == [event['id'] for event in events[:2]]
+
+def test_config_etag(warehaus):
+    '''Configs are only sent again when an object they're built from changed.'''
+    with warehaus.temp_lab() as lab:
+        server_type = warehaus.create_type_object(lab, type_key='builtin-server', slug='server',
+                                                  name_singular='Server', name_plural='Servers')
+        cluster_type = warehaus.create_type_object(lab, type_key='builtin-cluster', slug='cluster',
+                                                   name_singular='Cluster', name_plural='Clusters')
+        heartbeat = dict(hostname='etag0', info=_server_info(0))
+        warehaus.api.post(urljoin(server_type, 'heartbeat'), heartbeat, expected_status=httplib.OK)
+        cluster = warehaus.api.post(cluster_type, dict(display_name='ETag Cluster'))
+        config_url = warehaus.api.app_url('/api/v1/labs/{}/etag-cluster/config.json'.format(lab['slug']))
+        def get_config(etag=None):
+            headers = warehaus.api.current_user.auth_headers()
+            if etag is not None:
+                headers['If-None-Match'] = etag
+            return requests.get(config_url, headers=headers)
+        first = get_config()
+        assert first.status_code == httplib.OK
+        assert 'Last-Modified' in first.headers
+        assert get_config(first.headers['ETag']).status_code == httplib.NOT_MODIFIED
+        # Heartbeats with nothing new don't change the config
+        warehaus.api.post(urljoin(server_type, 'heartbeat'), heartbeat, expected_status=httplib.OK)
+        assert get_config(first.headers['ETag']).status_code == httplib.NOT_MODIFIED
+        warehaus.api.put('/api/v1/labs/{}/etag0/cluster'.format(lab['slug']), dict(cluster_id=cluster['id']))
+        second = get_config(first.headers['ETag'])
+        assert second.status_code == httplib.OK
+        assert second.headers['ETag'] != first.headers['ETag']
+        assert [server['slug'] for server in second.json()['servers']] == ['etag0']
+
+def test_stored_config_invalidation(warehaus):
+    '''Stored configs are rebuilt when any object they're built from changes.'''
+    with warehaus.temp_lab() as lab:
+        server_type = warehaus.create_type_object(lab, type_key='builtin-server', slug='server',
+                                                  name_singular='Server', name_plural='Servers')
+        cluster_type = warehaus.create_type_object(lab, type_key='builtin-cluster', slug='cluster',
+                                                   name_singular='Cluster', name_plural='Clusters')
+        warehaus.api.post(urljoin(server_type, 'heartbeat'), dict(hostname='st0', info=_server_info(0)),
+                          expected_status=httplib.OK)
+        cluster = warehaus.api.post(cluster_type, dict(display_name='Stored Cluster'))
+        warehaus.api.put('/api/v1/labs/{}/st0/cluster'.format(lab['slug']), dict(cluster_id=cluster['id']))
+        config_url = '/api/v1/labs/{}/stored-cluster/config.json'.format(lab['slug'])
+        assert warehaus.api.get(config_url)['servers'][0]['user_attrs'] == {}
+        # A change of the server type
+        warehaus.api.post(urljoin(server_type, 'attrs'), dict(attr=dict(slug='rack', type='text', display_name='Rack')))
+        assert warehaus.api.get(config_url)['servers'][0]['user_attrs'] == dict(rack=None)
+        # A change of the server
+        warehaus.api.put('/api/v1/labs/{}/st0/attrs'.format(lab['slug']), dict(slug='rack', value='r1'))
+        assert warehaus.api.get(config_url)['servers'][0]['user_attrs'] == dict(rack='r1')
+        # A change of a sub-object of the server
+        info = _server_info(0)
+        info['hw_disks'].append(dict(name='sdb', size=2))
+        warehaus.api.post(urljoin(server_type, 'heartbeat'), dict(hostname='st0', info=info), expected_status=httplib.OK)
+        assert len(warehaus.api.get(config_url)['servers'][0]['hw']['disk']) == 2
+
+def test_stored_config_concurrent_change(warehaus):
+    '''A dependency that changes while a config is first built (before the
+    stored config lists it) must not leave a stale config behind.'''
+    with warehaus.temp_lab() as lab:
+        cluster_type = warehaus.create_type_object(lab, type_key='builtin-cluster', slug='cluster',
+                                                   name_singular='Cluster', name_plural='Clusters')
+        lab_name_url = '/api/v1/labs/{}/name'.format(lab['slug'])
+        for i in range(10):
+            cluster = warehaus.api.post(cluster_type, dict(display_name='Racing Cluster {}'.format(i)))
+            config_url = '/api/v1/labs/{}/{}/config.json'.format(lab['slug'], cluster['slug'])
+            readers = [threading.Thread(target=warehaus.api.get, args=(config_url,)) for _ in range(4)]
+            for reader in readers:
+                reader.start()
+            display_name = 'Lab {}'.format(i)
+            warehaus.api.put(lab_name_url, dict(slug=lab['slug'], display_name=display_name))
+            for reader in readers:
+                reader.join()
+            assert warehaus.api.get(config_url)['lab']['display_name'] == display_name
@@ -1,5 +1,9 @@
 import os
+import json
+import zlib
+import httplib
 import requests
+from hashlib import sha1
 from urlparse import urljoin
 from subprocess import Popen, PIPE
 
@@ -32,3 +36,116 @@ def test_server_operations(warehaus):
             run_agent(agent_code)
             servers_after = warehaus.api.get(urljoin(server_type_path, 'objects'))
             assert len(servers_after['objects']) == 1
+
+def test_heartbeat_sections(warehaus):
+    '''Send heartbeats with changing sections and make sure only the
+    changed sections are updated.
+    '''
+    with warehaus.temp_lab() as lab:
+        server_type_path = warehaus.create_type_object(lab, type_key='builtin-server', slug='srvr',
+                                                       name_singular='Server', name_plural='Servers')
+        heartbeat_url = urljoin(server_type_path, 'heartbeat')
+        server_url = '/api/v1/labs/{}/digested/'.format(lab['slug'])
+        disks_url = urljoin(server_type_path, 'disk/objects')
+        info = dict(hw_disks=[dict(name='sda', size=1)], hw_mem=dict(MemTotal=1))
+        warehaus.api.post(heartbeat_url, dict(hostname='digested', info=info), expected_status=httplib.OK)
+        first = warehaus.api.get(server_url)
+        assert set(first['agent_info_digests']) == set(info)
+        assert len(warehaus.api.get(disks_url)['objects']) == 1
+        warehaus.api.post(heartbeat_url, dict(hostname='digested', info=info), expected_status=httplib.OK)
+        second = warehaus.api.get(server_url)
+        assert second['agent_info_digests'] == first['agent_info_digests']
+        assert second['last_seen'] >= first['last_seen']
+        del info['hw_disks']
+        warehaus.api.post(heartbeat_url, dict(hostname='digested', info=info), expected_status=httplib.OK)
+        third = warehaus.api.get(server_url)
+        assert set(third['agent_info']) == set(['hw_mem'])
+        assert third['agent_info_digests']['hw_mem'] == first['agent_info_digests']['hw_mem']
+        assert len(warehaus.api.get(disks_url)['objects']) == 0
+
+def _section_digest(section):
+    return sha1(json.dumps(section, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+def test_heartbeat_protocol_2(warehaus):
+    '''Send delta heartbeats: only changed sections are sent and the
+    server asks to resync sections it doesn't have.
+    '''
+    with warehaus.temp_lab() as lab:
+        server_type_path = warehaus.create_type_object(lab, type_key='builtin-server', slug='srvr',
+                                                       name_singular='Server', name_plural='Servers')
+        heartbeat_url = urljoin(server_type_path, 'heartbeat')
+        info = dict(hw_disks=[dict(name='sda', size=1)], hw_mem=dict(MemTotal=1))
+        digests = {section: _section_digest(value) for section, value in info.iteritems()}
+        # A new server that only sends digests must be asked to resync
+        reply = warehaus.api.post(heartbeat_url, dict(protocol=2, hostname='delta', digests=digests, info={}),
+                                  expected_status=httplib.OK)
+        assert set(reply['resync']) == set(info)
+        assert reply['digests'] == {}
+        # ...and isn't created until it sends them
+        warehaus.api.get('/api/v1/labs/{}/delta/'.format(lab['slug']), expected_status=httplib.NOT_FOUND)
+        warehaus.api.post(heartbeat_url, dict(protocol=2, hostname='delta', info=info), expected_status=httplib.BAD_REQUEST)
+        reply = warehaus.api.post(heartbeat_url, dict(protocol=2, hostname='delta', digests=digests, info=info),
+                                  expected_status=httplib.OK)
+        assert reply['resync'] == []
+        assert reply['digests'] == digests
+        # A liveness-only heartbeat keeps everything
+        reply = warehaus.api.post(heartbeat_url, dict(protocol=2, hostname='delta', digests=digests, info={}),
+                                  expected_status=httplib.OK)
+        assert reply['resync'] == []
+        assert reply['digests'] == digests
+        server = warehaus.api.get('/api/v1/labs/{}/delta/'.format(lab['slug']))
+        assert server['agent_info'] == info
+        # Send only the changed section
+        info['hw_mem'] = dict(MemTotal=2)
+        digests['hw_mem'] = _section_digest(info['hw_mem'])
+        reply = warehaus.api.post(heartbeat_url, dict(protocol=2, hostname='delta', digests=digests, info=dict(hw_mem=info['hw_mem'])),
+                                  expected_status=httplib.OK)
+        assert reply['digests'] == digests
+        server = warehaus.api.get('/api/v1/labs/{}/delta/'.format(lab['slug']))
+        assert server['agent_info'] == info
+        assert len(warehaus.api.get(urljoin(server_type_path, 'disk/objects'))['objects']) == 1
+
+def _gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def test_gzip_heartbeat(warehaus):
+    '''Send gzip-compressed heartbeats.'''
+    with warehaus.temp_lab() as lab:
+        server_type_path = warehaus.create_type_object(lab, type_key='builtin-server', slug='srvr',
+                                                       name_singular='Server', name_plural='Servers')
+        heartbeat_url = warehaus.api.app_url(urljoin(server_type_path, 'heartbeat'))
+        headers = {'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        body = json.dumps(dict(hostname='gzipped', info=dict(hw_mem=dict(MemTotal=1))))
+        response = requests.post(heartbeat_url, data=_gzip(body), headers=headers)
+        assert response.status_code == httplib.OK, response.text
+        server = warehaus.api.get('/api/v1/labs/{}/gzipped/'.format(lab['slug']))
+        assert server['agent_info'] == dict(hw_mem=dict(MemTotal=1))
+        response = requests.post(heartbeat_url, data='not gzip', headers=headers)
+        assert response.status_code == httplib.BAD_REQUEST, response.text
+        huge_body = json.dumps(dict(hostname='huge', info=dict(padding=' ' * (40 * 1024 * 1024))))
+        response = requests.post(heartbeat_url, data=_gzip(huge_body), headers=headers)
+        assert response.status_code == httplib.REQUEST_ENTITY_TOO_LARGE, response.text
+
+def _disks_info(num_disks, size):
+    return dict(hw_cpu=[], hw_mem=dict(MemTotal=1), hw_fs={}, provider_info={}, hw_net=[],
+                hw_disks=[dict(name='sd{}'.format(i), size=size) for i in xrange(num_disks)])
+
+def _heartbeat_query_count(warehaus, heartbeat_url, info):
+    response = requests.post(warehaus.api.app_url(heartbeat_url), json=dict(hostname='qc-server', info=info),
+                             headers=warehaus.api.current_user.auth_headers())
+    assert response.status_code == httplib.OK, response.text
+    return int(response.headers['X-Query-Count'])
+
+def test_heartbeat_query_count(warehaus):
+    '''The writes of a heartbeat are sent together, so the number of
+    queries doesn't depend on the number of changed sub-objects.'''
+    with warehaus.temp_lab() as lab:
+        server_type_path = warehaus.create_type_object(lab, type_key='builtin-server', slug='srvr',
+                                                       name_singular='Server', name_plural='Servers')
+        heartbeat_url = urljoin(server_type_path, 'heartbeat')
+        _heartbeat_query_count(warehaus, heartbeat_url, _disks_info(1, size=1))
+        one_changed = _heartbeat_query_count(warehaus, heartbeat_url, _disks_info(1, size=2))
+        _heartbeat_query_count(warehaus, heartbeat_url, _disks_info(20, size=2))
+        all_changed = _heartbeat_query_count(warehaus, heartbeat_url, _disks_info(20, size=3))
+        assert all_changed == one_changed
@@ -64,3 +64,36 @@ def test_type_objects_with_same_slug(warehaus):
         warehaus.create_type_object(lab1, expected_status=httplib.CONFLICT, **fixed_kwargs)
         with warehaus.temp_lab() as lab2:
             warehaus.create_type_object(lab2, **fixed_kwargs)
+
+def test_metrics(warehaus):
+    '''Metrics are available to admins only.'''
+    with warehaus.temp_lab() as lab:
+        warehaus.api.get('/api/v1/labs/{}/~/'.format(lab['slug']))
+    snapshot = warehaus.api.get('/api/v1/labs/~metrics')
+    assert 'type_cache.hits' in snapshot['metrics']
+    assert 'type_cache.misses' in snapshot['metrics']
+    with warehaus.api.current_user('login', warehaus.USER):
+        warehaus.api.get('/api/v1/labs/~metrics', expected_status=httplib.FORBIDDEN)
+    # ...and no lab can be called "~metrics"
+    warehaus.api.post('/api/v1/labs', dict(slug='~metrics', display_name='Metrics'), expected_status=httplib.BAD_REQUEST)
+    with warehaus.temp_lab() as lab:
+        warehaus.api.put('/api/v1/labs/{}/name'.format(lab['slug']), dict(slug='~metrics', display_name='Metrics'),
+                         expected_status=httplib.BAD_REQUEST)
+    # Metrics don't hide a lab called "Metrics"
+    lab = warehaus.create_lab('metrics')
+    try:
+        assert warehaus.api.get('/api/v1/labs/metrics')['id'] == lab['id']
+    finally:
+        warehaus.delete_lab('metrics')
+
+def test_action_dispatch(warehaus):
+    '''Unknown actions are not found, known actions with the wrong
+    method are not allowed.
+    '''
+    with warehaus.temp_lab() as lab:
+        server_type_path = warehaus.create_type_object(lab, type_key='builtin-server', slug='srvr',
+                                                       name_singular='Server', name_plural='Servers')
+        warehaus.api.get(server_type_path + 'nosuchaction', expected_status=httplib.NOT_FOUND)
+        warehaus.api.get(server_type_path + 'heartbeat', expected_status=httplib.METHOD_NOT_ALLOWED)
+        warehaus.api.get('/api/v1/labs/{}/nosuchaction'.format(lab['slug']), expected_status=httplib.NOT_FOUND)
+        warehaus.api.put('/api/v1/labs/{}/type-objects'.format(lab['slug']), dict(), expected_status=httplib.METHOD_NOT_ALLOWED)
@@ -1,3 +1,4 @@
+import time
 import random
 import httplib
 from urlparse import urljoin
@@ -134,3 +135,90 @@ def test_user_attributes(warehaus):
         warehaus.api.delete(_cluster_attrs_url(lab, c5), dict(slug=random_attr1))
         _ensure_correct_attributes((c5['slug'], random_attr2, 'mantises'),
                                    (c5['slug'], random_attr3, 'are'))
+
+def test_object_query(warehaus):
+    '''Query objects by their attributes:
+    - Filter by an attribute and a core field
+    - Sort by an attribute and page through the results
+    - Select fields
+    - Treat paths through non-objects as missing
+    - Reject invalid queries
+    '''
+    with warehaus.temp_lab() as lab:
+        type_path = warehaus.create_type_object(lab, type_key='builtin-cluster', slug='cluster1',
+                                                name_singular='Cluster', name_plural='Clusters')
+        query_url = urljoin(type_path, 'query')
+        warehaus.api.post(urljoin(type_path, 'attrs'), dict(attr=dict(slug='rack', type='text', display_name='Rack')))
+        clusters = tuple(warehaus.api.post(type_path, dict(display_name='Cluster {}'.format(i))) for i in range(10))
+        for i, cluster in enumerate(clusters):
+            warehaus.api.put(_cluster_attrs_url(lab, cluster), dict(slug='rack', value='B{}'.format(i % 3)))
+
+        def query(expected_status=httplib.OK, **body):
+            return warehaus.api.post(query_url, body, expected_status=expected_status)
+
+        in_b1 = [cluster['slug'] for i, cluster in enumerate(clusters) if i % 3 == 1]
+        result = query(filter=[dict(field='attrs.rack', op='eq', value='B1')])
+        assert [obj['slug'] for obj in result['objects']] == in_b1
+        assert result['next'] is None
+        result = query(filter=[dict(field='attrs.rack', op='eq', value='B1'),
+                               dict(field='slug', op='eq', value=in_b1[0])])
+        assert [obj['slug'] for obj in result['objects']] == in_b1[:1]
+        result = query(filter=[dict(field='attrs.rack', op='in', value=['B0', 'B2']),
+                               dict(field='attrs.rack', op='ne', value='B2')])
+        assert len(result['objects']) == 4
+
+        # Page through all clusters sorted by rack, newest first in each rack
+        expected = [cluster['slug'] for i, cluster in sorted(enumerate(clusters), key=lambda (i, c): (-(i % 3), -i))]
+        slugs = []
+        result = query(sort=['-attrs.rack'], fields=['slug'], limit=4)
+        while True:
+            assert all(set(obj) <= set(['id', 'slug', 'attrs', 'created_at']) for obj in result['objects'])
+            slugs.extend(obj['slug'] for obj in result['objects'])
+            if result['next'] is None:
+                break
+            result = query(sort=['-attrs.rack'], fields=['slug'], limit=4, after=result['next'])
+        assert slugs == expected
+
+        # Paths through values that are not objects are missing
+        assert query(filter=[dict(field='attrs.rack.x', op='eq', value='B1')])['objects'] == []
+        assert len(query(filter=[dict(field='slug.x', op='exists', value=False)], sort=['attrs.rack.x'])['objects']) == 10
+
+        query(filter=[dict(field='attrs.rack', op='like', value='B')], expected_status=httplib.BAD_REQUEST)
+        query(filter=[dict(field='attrs.rack', op='match', value='B(')], expected_status=httplib.BAD_REQUEST)
+        query(filter=[dict(field='attrs..rack', op='eq', value='B')], expected_status=httplib.BAD_REQUEST)
+        query(filter=[dict(field='created_at', op='gt', value='yesterday')], expected_status=httplib.BAD_REQUEST)
+        query(sort=['slug'], after='bm90IGEgY3Vyc29y', expected_status=httplib.BAD_REQUEST)
+
+def test_indexed_attribute(warehaus):
+    '''Define an indexed attribute, query objects through its index and
+    delete it.'''
+    with warehaus.temp_lab() as lab:
+        type_path = warehaus.create_type_object(lab, type_key='builtin-cluster', slug='cluster1',
+                                                name_singular='Cluster', name_plural='Clusters')
+        attrs_url = urljoin(type_path, 'attrs')
+        indexes_url = urljoin(type_path, 'attr-indexes')
+        warehaus.api.post(attrs_url, dict(attr=dict(slug='rack', type='text', display_name='Rack', indexed='yes')),
+                          expected_status=httplib.BAD_REQUEST)
+        warehaus.api.post(attrs_url, dict(attr=dict(slug='rack', type='text', display_name='Rack', indexed=True)))
+        warehaus.api.post(attrs_url, dict(attr=dict(slug='units', type='number', display_name='Units', indexed=True)))
+        clusters = tuple(warehaus.api.post(type_path, dict(display_name='Cluster {}'.format(i))) for i in range(6))
+        for i, cluster in enumerate(clusters):
+            warehaus.api.put(_cluster_attrs_url(lab, cluster), dict(slug='rack', value='R{}'.format(i % 2)))
+            warehaus.api.put(_cluster_attrs_url(lab, cluster), dict(slug='units', value=i))
+        for _ in range(100):
+            statuses = warehaus.api.get(indexes_url)
+            if all(status['ready'] for status in statuses.itervalues()):
+                break
+            time.sleep(0.1)
+        assert set(statuses) == set(['rack', 'units'])
+        assert all(status['ready'] for status in statuses.itervalues())
+
+        def query_slugs(*conditions):
+            result = warehaus.api.post(urljoin(type_path, 'query'), dict(filter=list(conditions)), expected_status=httplib.OK)
+            return [obj['slug'] for obj in result['objects']]
+        assert query_slugs(dict(field='attrs.rack', op='eq', value='R1')) == [c['slug'] for c in clusters[1::2]]
+        assert query_slugs(dict(field='attrs.units', op='ge', value=2),
+                           dict(field='attrs.units', op='lt', value=4)) == [c['slug'] for c in clusters[2:4]]
+
+        warehaus.api.delete(attrs_url, dict(slug='rack'))
+        assert set(warehaus.api.get(indexes_url)) == set(['units'])